@@ -0,0 +1,462 @@
+"""
+性能与精度基准
+
+用法:
+    python benchmarks.py tokens [文件或目录 ...] [--fit]
+        用真实的 cl100k_base 分词器评估 estimate_tokens 的误差和速度。
+        默认语料为仓库内的 README.md、docs/*.md 以及源码，按段落切分；
+        gettext 翻译文件（.mo）按条读取译文，可用系统的 /usr/share/locale 作为多语言语料。
+        --fit 按语料最小二乘（相对误差）拟合估算系数（TOKEN_ESTIMATE_* 环境变量），
+        并给出拟合后的误差。默认系数的校准过程和结果见 docs/token_estimate.md。
+        需要能加载真实分词器（TIKTOKEN_BPE_FILE 或可联网），否则无法比较。
+
+    python benchmarks.py bundles [bundle文件 ...] [--base-url URL] [--repeat N]
+        比较 scan_js_bundle 与原来的 parse_models_from_js + extract_links（本文件中）的耗时和结果。
+        bundle可以先从官网保存下来，例如:
+            curl -s https://www.degpt.ai/ | grep -o '/assets/[^"]*\.js'
+            curl -o index.js https://www.degpt.ai/assets/index-xxxx.js
+        不指定文件时使用生成的Vite风格bundle（仅供对比，不代表真实数据）。
+        tests/fixtures/degpt/ 中的测试数据和已记录的结果见 docs/js_bundle_scan.md。
+"""
+import argparse
+import gettext
+import os
+import random
+import re
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urljoin, urlparse
+
+from bs4 import BeautifulSoup
+
+import degpt as dg
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 默认语料之外补充的样例，覆盖纯中文、日文、中英混排
+BUILTIN_SAMPLES = [
+    "人工智能是计算机科学的一个分支，它企图了解智能的实质，并生产出一种新的能以人类智能相似的方式做出反应的智能机器。",
+    "请帮我把下面这段话翻译成英文：今天天气很好，我们一起去公园散步吧。",
+    "東京は日本の首都であり、世界有数の大都市です。",
+    "使用 FastAPI 和 uvicorn 部署服务时，workers 参数需要通过 import string 启动。",
+    "The quick brown fox jumps over the lazy dog. " * 4,
+    '{"model": "deepseek-chat", "messages": [{"role": "user", "content": "hello"}], "stream": true}',
+    "Напиши, пожалуйста, короткое письмо коллеге о переносе встречи на следующую неделю.",
+    "Объясни простыми словами, чем отличается процесс от потока в операционной системе.",
+    "Könnten Sie mir bitte erklären, wie die Rückgabe eines Artikels funktioniert? Danke schön!",
+    "Je voudrais réserver une table pour deux personnes ce soir à vingt heures, c'est possible ?",
+    "Η τεχνητή νοημοσύνη αλλάζει τον τρόπο που εργαζόμαστε και μαθαίνουμε.",
+    "今天天气真好☀️我们去公园吧🌳🌸 记得带水💧",
+    "Great job team! 🎉🎉 The release is live 🚀 Thanks everyone 🙏❤️",
+    "好的👌 收到👍 明天见😊",
+]
+
+
+def read_mo(path: str) -> List[str]:
+    """读取gettext翻译文件中的译文"""
+    with open(path, "rb") as f:
+        catalog = gettext.GNUTranslations(f)._catalog
+    return [text for key, text in catalog.items() if key and isinstance(text, str)]
+
+
+def load_corpus(paths: List[str]) -> List[str]:
+    """读取语料文件，文本按空行切分为段落，.mo 按条读取"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.endswith((".md", ".txt", ".py", ".json", ".mo")))
+        elif os.path.isfile(path):
+            files.append(path)
+
+    samples = list(BUILTIN_SAMPLES)
+    for file in files:
+        try:
+            if file.endswith(".mo"):
+                parts = read_mo(file)
+            else:
+                with open(file, "r", encoding="utf-8") as f:
+                    parts = f.read().split("\n\n")
+        except (OSError, UnicodeDecodeError, ValueError, LookupError):
+            # 无法解析的文件（例如头部格式不规范的.mo）跳过
+            continue
+        samples.extend(p.strip() for p in parts if len(p.strip()) >= 20)
+    return samples
+
+
+def category(text: str) -> str:
+    """按UTF-8字节长度分类：纯ASCII、以ASCII为主（mixed），或占多数的非ASCII类别"""
+    ascii_chars, two, three, four = dg.utf8_char_counts(text)
+    if ascii_chars == len(text):
+        return "ascii"
+    if ascii_chars > 0.7 * len(text):
+        return "mixed"
+    return max((two, "2byte"), (three, "cjk"), (four, "4byte"))[1]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def report(rows: List[Tuple[str, int, int]]) -> Dict[str, float]:
+    """rows: (类别, 精确token数, 估算token数)"""
+    errors = [abs(est - exact) / exact for _, exact, est in rows if exact]
+    total_exact = sum(exact for _, exact, _ in rows)
+    total_est = sum(est for _, _, est in rows)
+    return {
+        "samples": len(rows),
+        "mape": sum(errors) / len(errors) if errors else 0.0,
+        "p50": percentile(errors, 0.5),
+        "p95": percentile(errors, 0.95),
+        "bias": total_est / total_exact - 1 if total_exact else 0.0,
+    }
+
+
+# 估算系数对应的环境变量，顺序与 dg.utf8_char_counts 的返回值一致
+COEFFICIENTS = ("TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN", "TOKEN_ESTIMATE_2BYTE_TOKENS_PER_CHAR",
+                "TOKEN_ESTIMATE_CJK_TOKENS_PER_CHAR", "TOKEN_ESTIMATE_4BYTE_TOKENS_PER_CHAR")
+
+
+def current_weights() -> List[float]:
+    """当前系数换算为每类字符的token数"""
+    return [1 / dg.TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN] + [getattr(dg, name) for name in COEFFICIENTS[1:]]
+
+
+def estimate(counts: Tuple[int, ...], weights: List[float]) -> int:
+    return max(1, int(sum(c * w for c, w in zip(counts, weights)) + 0.5))
+
+
+def fit(counts: List[Tuple[int, ...]], exact_counts: List[int]) -> List[float]:
+    """
+    最小二乘拟合 tokens ≈ Σ 每类字符数 × 每字符token数（无截距）
+
+    按 1/tokens² 加权，即最小化相对误差的平方和，与报告的MAPE一致；
+    语料中没有出现的字符类别保留当前系数。
+    """
+    weights = current_weights()
+    columns = [i for i in range(len(weights)) if any(c[i] for c in counts)]
+    size = len(columns)
+    # 正规方程 A·w = b
+    a = [[0.0] * size for _ in range(size)]
+    b = [0.0] * size
+    for row, tokens in zip(counts, exact_counts):
+        if not tokens:
+            continue
+        scale = 1.0 / (tokens * tokens)
+        for i, ci in enumerate(columns):
+            b[i] += scale * row[ci] * tokens
+            for j, cj in enumerate(columns):
+                a[i][j] += scale * row[ci] * row[cj]
+    # 高斯消元（列主元）
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(a[r][col]))
+        if not a[pivot][col]:
+            raise ValueError("语料不足以拟合所有系数")
+        a[col], a[pivot] = a[pivot], a[col]
+        b[col], b[pivot] = b[pivot], b[col]
+        for r in range(size):
+            if r != col and a[r][col]:
+                factor = a[r][col] / a[col][col]
+                a[r] = [x - factor * y for x, y in zip(a[r], a[col])]
+                b[r] -= factor * b[col]
+    for i, ci in enumerate(columns):
+        weights[ci] = b[i] / a[i][i]
+    return weights
+
+
+def print_report(rows: List[Tuple[str, int, int]]) -> None:
+    print(f"{'类别':<8}{'样本':>8}{'MAPE':>9}{'P50':>9}{'P95':>9}{'总偏差':>9}")
+    for name in ("ascii", "mixed", "2byte", "cjk", "4byte", "all"):
+        selected = [row for row in rows if name == "all" or row[0] == name]
+        if not selected:
+            continue
+        r = report(selected)
+        print(f"{name:<8}{r['samples']:>8}{r['mape']:>9.1%}{r['p50']:>9.1%}{r['p95']:>9.1%}{r['bias']:>+9.1%}")
+
+
+def bench_tokens(args) -> int:
+    tokenizer = dg.Tokenizer(modes="exact")
+    if not tokenizer.is_exact():
+        print(f"无法加载真实分词器: {tokenizer.error}")
+        print("请设置 TIKTOKEN_BPE_FILE 指向 cl100k_base.tiktoken")
+        return 1
+
+    paths = args.paths or [os.path.join(ROOT, "README.md"), os.path.join(ROOT, "docs"),
+                           os.path.join(ROOT, "degpt.py"), os.path.join(ROOT, "more_core.py")]
+    samples = load_corpus(paths)
+
+    started = time.perf_counter()
+    exact_counts = [tokenizer.count(text) for text in samples]
+    exact_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    estimated = [dg.estimate_tokens(text) for text in samples]
+    estimate_time = time.perf_counter() - started
+
+    categories = [category(text) for text in samples]
+    print(f"语料: {len(samples)} 段, {sum(len(t) for t in samples)} 字符, {sum(exact_counts)} tokens")
+    print("系数: " + " ".join(f"{name}={getattr(dg, name)}" for name in COEFFICIENTS))
+    print_report(list(zip(categories, exact_counts, estimated)))
+    print(f"耗时: 分词 {exact_time * 1000:.1f} ms, 估算 {estimate_time * 1000:.1f} ms, "
+          f"快 {exact_time / max(estimate_time, 1e-9):.0f} 倍")
+
+    if args.fit:
+        counts = [dg.utf8_char_counts(text) for text in samples]
+        weights = fit(counts, exact_counts)
+        fitted = [1 / weights[0]] + weights[1:]
+        print("拟合: " + " ".join(f"{name}={value:.2f}" for name, value in zip(COEFFICIENTS, fitted)))
+        # 按四舍五入后的系数（即写入环境变量的值）重新计算误差
+        rounded = [1 / round(fitted[0], 2)] + [round(w, 2) for w in fitted[1:]]
+        print_report([(cat, exact, estimate(c, rounded))
+                      for cat, exact, c in zip(categories, exact_counts, counts)])
+    return 0
+
+
+def synthetic_bundle(size: int = 3 * 1024 * 1024, seed: int = 1) -> str:
+    """生成Vite风格的bundle：大量函数和字符串、依赖数组、动态import，模型数组在末尾"""
+    rng = random.Random(seed)
+    chunks = [f"assets/chunk-{i:03d}-{rng.getrandbits(32):08x}.js" for i in range(300)]
+    parts = ['const __vite__mapDeps=(i,m=__vite__mapDeps,d=(m.f||(m.f=[' +
+             ",".join(f'"{c}"' for c in chunks) + '])))=>i.map(i=>d[i]);']
+    total = len(parts[0])
+    i = 0
+    while total < size:
+        i += 1
+        words = " ".join(rng.choice(["data", "value", "render", "props", "state", "请稍候", "模型"])
+                         for _ in range(8))
+        piece = (f'function f{i}(e,t){{const n=[e,t,{i}],r={{key:"k{i}",label:"{words}",list:[1,2,3]}};'
+                 f'if(n.length>{i % 7})return import("./{rng.choice(chunks)[7:]}");'
+                 f'return e?r.label+`${{t}}`:"./x{i}"}}\n')
+        parts.append(piece)
+        total += len(piece)
+    parts.append("const cfg={models:[{name:'DeepSeek',model:'deepseek-chat',tip:'DeepSeek',support:'text',"
+                 "desc:'Suitable for most tasks'},{name:'DouBao',model:'doubao-seed',support:'image'}]};")
+    return "".join(parts)
+
+
+def best_time(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+# 原来的 parse_models_from_js + extract_links，已被 degpt.scan_js_bundle 替代，
+# 只保留在这里作为对照：bundles 基准和 tests/test_js_bundle_scan.py 的等价测试使用
+
+
+def parse_models_from_js(content: str, url: str) -> List[Dict]:
+    """解析JS内容中的模型信息"""
+    try:
+        # 匹配模型数据
+        pattern = r'models\s*:\s*\[([^\]]+)\]'
+        match = re.search(pattern, content)
+
+        if not match:
+            return []
+        return dg._parse_models_literal(match.group(1), url)
+    except Exception as e:
+        if dg.debug:
+            print(f"解析模型失败 {url}: {e}")
+        return []
+
+
+def extract_links(content: str, url: str) -> Set[str]:
+    """
+    提取页面中的所有有效链接，处理特殊情况和无效URL
+
+    Args:
+        content: 页面内容
+        url: 当前页面URL
+
+    Returns:
+        Set[str]: 提取的有效链接集合
+    """
+    links = set()
+    base_domain = urlparse(url).netloc
+
+    def is_valid_path(path: str) -> bool:
+        """
+        验证路径是否有效
+
+        Args:
+            path: 要验证的路径
+
+        Returns:
+            bool: 路径是否有效
+        """
+        # 排除无效路径模式
+        invalid_patterns = [
+            r'\$\{.*?\}',  # 模板字面量
+            r'\{.*?\}',  # 其他变量
+            r'^\(.*?\)',  # 括号开头
+            r'^\).*?',  # 右括号开头
+            r'^[\s\.,]+$',  # 仅包含空白或标点
+            r'^[a-z]+\=',  # 属性赋值
+            r'^\w+\(',  # 函数调用
+        ]
+
+        if not path or path.isspace():
+            return False
+
+        return not any(re.search(pattern, path) for pattern in invalid_patterns)
+
+    def clean_path(path: str) -> Optional[str]:
+        """
+        清理和规范化路径
+
+        Args:
+            path: 原始路径
+
+        Returns:
+            Optional[str]: 清理后的路径，无效则返回None
+        """
+        if not path:
+            return None
+
+        # 基础清理
+        path = path.strip()
+        path = re.sub(r'\s+', '', path)
+        path = re.sub(r'[\(\)]', '', path)
+        path = re.sub(r',.*$', '', path)
+
+        # 处理相对路径
+        if path.startswith('./'):
+            path = path[2:]
+        elif path.startswith('/'):
+            path = path[1:]
+
+        # 验证文件扩展名
+        valid_extensions = ('.js', '.css', '.html', '.htm', '.json')
+        if not any(path.endswith(ext) for ext in valid_extensions):
+            return None
+
+        return path
+
+    try:
+        if not content or url.endswith(('.json', '.css', '.png', '.jpg', '.jpeg', '.gif', '.svg')):
+            return links
+
+        # 处理HTML内容
+        soup = BeautifulSoup(content, 'html.parser')
+
+        # 提取href链接
+        for tag in soup.find_all(href=True):
+            href = tag['href']
+            if is_valid_path(href):
+                cleaned_href = clean_path(href)
+                if cleaned_href:
+                    full_url = urljoin(url, cleaned_href)
+                    if urlparse(full_url).netloc == base_domain:
+                        links.add(full_url)
+                        if dg.debug:
+                            print(f"添加有效链接: {full_url}")
+
+        # 处理script标签
+        for tag in soup.find_all('script', src=True):
+            src = tag['src']
+            if is_valid_path(src):
+                cleaned_src = clean_path(src)
+                if cleaned_src:
+                    full_url = urljoin(url, cleaned_src)
+                    if urlparse(full_url).netloc == base_domain:
+                        links.add(full_url)
+
+        # 处理JS文件内容
+        if url.endswith('.js'):
+            # 处理各种导入模式
+            import_patterns = [
+                (r'import\s*[^"\']*["\']([^"\']+)["\']', 1),
+                (r'from\s+["\']([^"\']+)["\']', 1),
+                (r'import\s*\(["\']([^"\']+)["\']\)', 1),
+                (r'require\s*\(["\']([^"\']+)["\']\)', 1),
+                (r'(?:url|src|href)\s*:\s*["\']([^"\']+)["\']', 1),
+                (r'@import\s+["\']([^"\']+)["\']', 1),
+                (r'url\(["\']?([^"\'()]+)["\']?\)', 1),
+            ]
+
+            for pattern, group in import_patterns:
+                for match in re.finditer(pattern, content):
+                    path = match.group(group)
+                    if is_valid_path(path):
+                        cleaned_path = clean_path(path)
+                        if cleaned_path:
+                            full_url = urljoin(url, cleaned_path)
+                            if urlparse(full_url).netloc == base_domain:
+                                links.add(full_url)
+
+            # 处理数组形式的导入
+            for array_match in re.finditer(r'\[([\s\S]*?)\]', content):
+                array_content = array_match.group(1)
+                paths = re.findall(r'["\']([^"\']+?\.[a-zA-Z0-9]+)["\']', array_content)
+                for path in paths:
+                    if is_valid_path(path):
+                        cleaned_path = clean_path(path)
+                        if cleaned_path and not cleaned_path.startswith(('http:', 'https:', 'data:', 'blob:')):
+                            full_url = urljoin(url, cleaned_path)
+                            if urlparse(full_url).netloc == base_domain:
+                                links.add(full_url)
+
+    except Exception as e:
+        if dg.debug:
+            print(f"提取链接失败 {url}: {e}")
+
+    return links
+
+
+def old_scan(content: str, url: str) -> Tuple[List[Dict], Set[str]]:
+    """原实现的爬取流程：先找模型，找不到再提取链接"""
+    models = parse_models_from_js(content, url)
+    return models, (set() if models else extract_links(content, url))
+
+
+def bench_bundles(args) -> int:
+    bundles = []
+    for path in args.paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            bundles.append((os.path.basename(path), f.read()))
+    if not bundles:
+        print("未指定bundle文件，使用生成的bundle（结果仅供参考）")
+        bundles = [("synthetic-3MB.js", synthetic_bundle()),
+                   ("synthetic-3MB-no-models.js", synthetic_bundle().rsplit("const cfg=", 1)[0])]
+
+    print(f"{'文件':<32}{'大小':>10}{'原实现':>10}{'单次扫描':>10}{'加速':>8}{'模型':>6}{'链接(原/新/共同)':>20}")
+    for name, content in bundles:
+        url = args.base_url.rstrip("/") + "/" + name
+        old_result = old_scan(content, url)
+        new_result = dg.scan_js_bundle(content, url)
+        old_time = best_time(lambda: old_scan(content, url), args.repeat)
+        new_time = best_time(lambda: dg.scan_js_bundle(content, url), args.repeat)
+        same_models = "一致" if old_result[0] == new_result[0] else "不同"
+        links = f"{len(old_result[1])}/{len(new_result[1])}/{len(old_result[1] & new_result[1])}"
+        print(f"{name[:31]:<32}{len(content) / 1024:>8.0f}KB{old_time * 1000:>8.1f}ms{new_time * 1000:>8.1f}ms"
+              f"{old_time / max(new_time, 1e-9):>7.1f}x{same_models:>6}{links:>20}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="degpt 基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    tokens = sub.add_parser("tokens", help="token估算误差与速度")
+    tokens.add_argument("paths", nargs="*", help="语料文件或目录")
+    tokens.add_argument("--fit", action="store_true", help="拟合估算系数")
+    tokens.set_defaults(func=bench_tokens)
+
+    bundles = sub.add_parser("bundles", help="JS bundle扫描速度")
+    bundles.add_argument("paths", nargs="*", help="保存下来的bundle文件")
+    bundles.add_argument("--base-url", default="https://www.degpt.ai/assets/", help="bundle所在目录的URL")
+    bundles.add_argument("--repeat", type=int, default=3, help="每项重复次数（取最快）")
+    bundles.set_defaults(func=bench_bundles)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -107,25 +107,44 @@ curl 'https://www.degpt.ai/api/v1/chat/completion/proxy' \
 """
 import json
 import os
+import sys
+import hashlib
+import ipaddress
+import socket
 import re
 import time
 import base64
 import mimetypes
+import random
+import tempfile
+import threading
+import asyncio
+import concurrent.futures
+import multiprocessing
+import sqlite3
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Set, Optional, List, Dict, Union
+from typing import Set, Optional, List, Dict, Union, AsyncIterator, Iterator
 from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup
 import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 # 禁用 SSL 警告
 import urllib3
 from urllib3.exceptions import InsecureRequestWarning
 try:
-    from PIL import Image
+    from PIL import Image, ImageOps
     import io
 except ImportError:
     Image = None
+    ImageOps = None
     io = None
+try:
+    import redis
+except ImportError:
+    redis = None
 
 
 urllib3.disable_warnings(InsecureRequestWarning)
@@ -136,13 +155,52 @@ debug = os.getenv("DEBUG", "False").lower() in ("true", "1", "t")
 # 全局变量
 last_request_time = 0  # 上次请求的时间戳
 cache_duration = int(os.getenv("CACHE_DURATION", "3600"))  # 缓存有效期，单位：秒 (1小时)
+# 从官网JS中发现模型列表的爬虫
+MODEL_CRAWL_CONCURRENCY = int(os.getenv("MODEL_CRAWL_CONCURRENCY", "8"))  # 同时下载的页面数
+MODEL_CRAWL_MAX_PAGES = int(os.getenv("MODEL_CRAWL_MAX_PAGES", "200"))  # 单次最多下载的页面数
+MODEL_CRAWL_TIMEOUT = float(os.getenv("MODEL_CRAWL_TIMEOUT", "30"))  # 单次爬取的总时间上限（秒）
 
 # 会话存储配置
 SESSION_TIMEOUT = int(os.getenv("SESSION_TIMEOUT", "1800"))  # 会话超时时间30分钟
-SESSION_STORAGE_TYPE = os.getenv("SESSION_STORAGE_TYPE", "memory")  # 存储类型: memory 或 redis
-
-
-SESSION_STORAGE = {}
+SESSION_STORAGE_TYPE = os.getenv("SESSION_STORAGE_TYPE", "memory")  # 存储类型: memory、sqlite 或 redis
+SESSION_SQLITE_FILE = os.getenv("SESSION_SQLITE_FILE", os.path.join(tempfile.gettempdir(), "degpt_sessions.db"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SESSION_KEY_PREFIX = os.getenv("SESSION_KEY_PREFIX", "degpt:session:")
+SESSION_CLEANUP_INTERVAL = int(os.getenv("SESSION_CLEANUP_INTERVAL", "60"))  # 后台清理过期会话的间隔（秒）
+SESSION_EXPIRE_PER_TOUCH = 4  # 每次访问会话时顺带清理的过期会话上限
+SESSION_MEMORY_LIMIT_MB = float(os.getenv("SESSION_MEMORY_LIMIT_MB", "256"))  # 内存会话总字节预算，超出后按LRU淘汰
+# 会话中的图片按内容哈希单独存放，会话消息只保存引用
+IMAGE_STORE_MEMORY_MB = float(os.getenv("IMAGE_STORE_MEMORY_MB", "64"))  # 图片存储的内存预算，超出后写入磁盘
+IMAGE_STORE_DISK_MB = float(os.getenv("IMAGE_STORE_DISK_MB", "1024"))  # 磁盘预算，超出后删除最久未用的图片
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "degpt_images"))
+# 转发前按 detail 缩小并重新压缩图片（在进程池中处理，不占用服务进程的GIL）
+IMAGE_DOWNSCALE = os.getenv("IMAGE_DOWNSCALE", "false").lower() in ("true", "1", "t")
+IMAGE_DOWNSCALE_WORKERS = int(os.getenv("IMAGE_DOWNSCALE_WORKERS", "2"))
+IMAGE_DOWNSCALE_QUALITY = int(os.getenv("IMAGE_DOWNSCALE_QUALITY", "85"))  # JPEG质量
+IMAGE_DOWNSCALE_CACHE_SIZE = int(os.getenv("IMAGE_DOWNSCALE_CACHE_SIZE", "64"))  # 按原图哈希缓存的处理结果条数
+# 预先下载请求中的图片URL：off 不下载；validate 下载并校验，无法访问的图片不再转发；
+# inline 校验后以base64内联转发（可再经过缩放和会话图片存储）
+IMAGE_URL_PREFETCH = os.getenv("IMAGE_URL_PREFETCH", "off").lower()
+IMAGE_URL_FETCH_TIMEOUT = float(os.getenv("IMAGE_URL_FETCH_TIMEOUT", "5"))  # 单张图片下载超时（秒）
+IMAGE_URL_FETCH_CONCURRENCY = int(os.getenv("IMAGE_URL_FETCH_CONCURRENCY", "8"))  # 同时下载的图片数
+IMAGE_URL_CACHE_TTL = int(os.getenv("IMAGE_URL_CACHE_TTL", "300"))  # 下载结果缓存时间，过期后带ETag重新验证
+IMAGE_URL_CACHE_MB = float(os.getenv("IMAGE_URL_CACHE_MB", "64"))  # 下载结果缓存的内存预算
+IMAGE_URL_CACHE_SIZE = int(os.getenv("IMAGE_URL_CACHE_SIZE", "4096"))  # 下载结果缓存的最大条数（含失败结果）
+# 是否允许下载内网、本机和链路本地地址的图片（默认拒绝，防止借服务端访问内网）
+IMAGE_URL_ALLOW_PRIVATE = os.getenv("IMAGE_URL_ALLOW_PRIVATE", "false").lower() in ("true", "1", "t")
+# 历史消息中只有最近N轮保留完整图片，更早的换成文字（-1 不限制）
+IMAGE_HISTORY_TURNS = int(os.getenv("IMAGE_HISTORY_TURNS", "-1"))
+# 旧图片的替换方式：placeholder 固定提示；describe 后台请求图片模型生成一句描述并缓存，生成前使用固定提示
+IMAGE_HISTORY_POLICY = os.getenv("IMAGE_HISTORY_POLICY", "placeholder").lower()
+
+
+# 按最后活跃时间排序：最久未活跃的会话在头部
+SESSION_STORAGE = OrderedDict()
+
+# 多worker共享状态：模型缓存、模型统计和会话保存在本机SQLite(WAL)文件中
+SHARED_STATE = os.getenv("DEGPT_SHARED_STATE", "false").lower() in ("true", "1", "t")
+SHARED_STATE_FILE = os.getenv("DEGPT_STATE_FILE", os.path.join(tempfile.gettempdir(), "degpt_state.db"))
+SHARED_STATE_SYNC_INTERVAL = float(os.getenv("DEGPT_STATE_SYNC_INTERVAL", "1"))  # 模型统计同步间隔（秒）
 
 if SESSION_STORAGE_TYPE == "memory":
     if debug:
@@ -172,11 +230,1304 @@ base_model = os.getenv("DEGPT_BASE_MODEL", "gpt-4o-mini")
 auth_id = os.getenv("DEGPT_AUTH_ID", "b39fdee47a6bdbab5bc6827ac954c422")
 auth_cookie = os.getenv("DEGPT_AUTH_COOKIE", "_ga=GA1.1.486456891.1750229584; _ga_ELT9ER83T2=GS2.1.s1750229583$o1$g1$t1750229594$j49$l0$h0")
 
+# 令牌缓存配置
+TOKEN_REFRESH_MARGIN = int(os.getenv("DEGPT_TOKEN_REFRESH_MARGIN", "300"))  # 过期前多少秒开始后台刷新
+TOKEN_DEFAULT_TTL = int(os.getenv("DEGPT_TOKEN_TTL", "3600"))  # JWT中没有exp时的默认有效期
+TOKEN_BACKOFF_BASE = float(os.getenv("DEGPT_TOKEN_BACKOFF_BASE", "1"))  # 登录失败退避基数（秒）
+TOKEN_BACKOFF_MAX = float(os.getenv("DEGPT_TOKEN_BACKOFF_MAX", "60"))  # 登录失败最大退避时间（秒）
+# 多个worker进程共享令牌的本地缓存文件
+TOKEN_CACHE_FILE = os.getenv("DEGPT_TOKEN_CACHE_FILE", os.path.join(tempfile.gettempdir(), "degpt_token.json"))
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 上游连接池配置
+UPSTREAM_POOL_SIZE = int(os.getenv("DEGPT_POOL_SIZE", "100"))  # 到DeGPT的最大连接数
+UPSTREAM_KEEPALIVE_TIMEOUT = int(os.getenv("DEGPT_KEEPALIVE_TIMEOUT", "60"))  # 空闲连接保持时间（秒）
+UPSTREAM_TIMEOUT = int(os.getenv("DEGPT_TIMEOUT", "100"))  # 上游读取超时（秒）
+# 流式接口是否使用aiohttp异步连接池
+ASYNC_TRANSPORT = os.getenv("DEGPT_ASYNC_TRANSPORT", "true").lower() in ("true", "1", "t")
+
+# 分词器配置：离线环境可指定随服务打包的BPE文件，默认使用 degpt.py 同目录下的 cl100k_base.tiktoken（存在时）
+TIKTOKEN_BPE_FILE = os.getenv("TIKTOKEN_BPE_FILE",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "cl100k_base.tiktoken"))
+PROMPT_TOKEN_CACHE_SIZE = int(os.getenv("PROMPT_TOKEN_CACHE_SIZE", "20000"))  # 按内容哈希缓存的token计数条数
+STREAM_COUNT_BATCH_CHARS = int(os.getenv("STREAM_COUNT_BATCH_CHARS", "2048"))  # 流式回答攒够多少字符分词一次
+# token计数方式：exact（BPE分词）或 estimate（估算），可按使用场景分别设置，
+# 例如 "exact" 或 "prompt=estimate,stream=estimate"；场景: prompt、completion、stream
+TOKEN_COUNT_MODE = os.getenv("TOKEN_COUNT_MODE", "exact")
+# 估算系数（相对 cl100k_base 校准，见 docs/token_estimate.md；可用 python benchmarks.py tokens --fit 重新拟合）
+# 非ASCII字符按UTF-8字节长度分三类：2字节（拉丁扩展、西里尔、希腊等）、3字节（中日韩等）、4字节（emoji等）
+TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN = float(os.getenv("TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN", "3.73"))
+TOKEN_ESTIMATE_2BYTE_TOKENS_PER_CHAR = float(os.getenv("TOKEN_ESTIMATE_2BYTE_TOKENS_PER_CHAR", "0.53"))
+TOKEN_ESTIMATE_CJK_TOKENS_PER_CHAR = float(os.getenv("TOKEN_ESTIMATE_CJK_TOKENS_PER_CHAR", "1.11"))
+TOKEN_ESTIMATE_4BYTE_TOKENS_PER_CHAR = float(os.getenv("TOKEN_ESTIMATE_4BYTE_TOKENS_PER_CHAR", "2.72"))
+IMAGE_VALIDATION_CACHE_SIZE = int(os.getenv("IMAGE_VALIDATION_CACHE_SIZE", "512"))  # 按内容哈希缓存的图片校验结果条数
+
+# 代理请求头模板：只在启动时读取一次环境变量，每个请求只需补充Authorization
+HEADERS_PROXY_TEMPLATE = {
+    "Host": os.getenv("DEGPT_PROXY_HOST", "www.degpt.ai"),
+    "Connection": "keep-alive",
+    "Pragma": "no-cache",
+    "Cache-Control": "no-cache",
+    "sec-ch-ua-platform": os.getenv("DEGPT_PROXY_SEC_CH_UA_PLATFORM", "\"Windows\""),
+    "User-Agent": os.getenv("DEGPT_PROXY_USER_AGENT", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36"),
+    "sec-ch-ua": os.getenv("DEGPT_PROXY_SEC_CH_UA", "\"Google Chrome\";v=\"137\", \"Chromium\";v=\"137\", \"Not/A)Brand\";v=\"24\""),
+    "Content-Type": "application/json",
+    "sec-ch-ua-mobile": os.getenv("DEGPT_PROXY_SEC_CH_UA_MOBILE", "?0"),
+    "Accept": "*/*",
+    "Origin": os.getenv("DEGPT_PROXY_ORIGIN", "https://www.degpt.ai"),
+    "Sec-Fetch-Site": "same-origin",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Dest": "empty",
+    "Referer": os.getenv("DEGPT_PROXY_REFERER", "https://www.degpt.ai/c/e850c81f-19ab-4ac1-92ec-ee02c21095c7"),
+    "Accept-Encoding": "gzip, deflate, br, zstd",
+    "Accept-Language": os.getenv("DEGPT_PROXY_ACCEPT_LANGUAGE", "zh-CN,zh;q=0.9"),
+    "Cookie": auth_cookie
+}
+
+
+def build_proxy_headers(token: str) -> Dict[str, str]:
+    """基于模板生成代理请求头"""
+    headers = dict(HEADERS_PROXY_TEMPLATE)
+    headers["Authorization"] = f"Bearer {token}"
+    return headers
+
+
+def _create_http_session() -> requests.Session:
+    """同步调用使用的共享连接池"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.verify = False
+    return session
+
+
+http_session = _create_http_session()
+
+
+class UpstreamTransport:
+    """
+    到DeGPT的异步传输层
+
+    每个事件循环持有一个长连接 aiohttp.ClientSession，
+    连接池大小受 UPSTREAM_POOL_SIZE 限制，空闲连接保持 UPSTREAM_KEEPALIVE_TIMEOUT 秒。
+    """
+
+    def __init__(self, limit: int = UPSTREAM_POOL_SIZE, keepalive_timeout: int = UPSTREAM_KEEPALIVE_TIMEOUT,
+                 read_timeout: int = UPSTREAM_TIMEOUT):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.read_timeout = read_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+                ssl=False
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=self.read_timeout),
+                read_bufsize=2 ** 20
+            )
+            self._loop = loop
+        return self._session
+
+    async def post(self, url: str, headers: Dict[str, str], payload: Dict) -> aiohttp.ClientResponse:
+        """发送POST请求并返回未读取的响应，调用方负责release"""
+        session = await self.get_session()
+        return await session.post(url, headers=headers, json=payload)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+upstream_transport = UpstreamTransport()
+
 # 全局变量：存储所有模型的统计信息
 # 格式：{model_name: {"calls": 调用次数, "fails": 失败次数, "last_fail": 最后失败时间}}
 MODEL_STATS: Dict[str, Dict] = {}
 
 
+# UTF-8首字节 -> 字符的字节数；ASCII和续字节在查表前删除
+_UTF8_LEAD_BYTES = bytes(0 if b < 0xC0 else 2 if b < 0xE0 else 3 if b < 0xF0 else 4 for b in range(256))
+_UTF8_NON_LEAD_BYTES = bytes(range(0xC0))
+
+
+def utf8_char_counts(text: str) -> tuple:
+    """
+    按UTF-8编码长度统计字符数
+
+    编码、按首字节查表、计数都在C层面完成，不逐字符循环。
+
+    Returns:
+        (ASCII字符数, 2字节字符数, 3字节字符数, 4字节字符数)
+    """
+    if text.isascii():
+        return len(text), 0, 0, 0
+    # 只剩多字节字符的首字节，每个字节对应一个非ASCII字符
+    lengths = text.encode("utf-8", "surrogatepass").translate(_UTF8_LEAD_BYTES, _UTF8_NON_LEAD_BYTES)
+    two, three = lengths.count(2), lengths.count(3)
+    return len(text) - len(lengths), two, three, len(lengths) - two - three
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    快速估算 cl100k_base 的token数，不分词
+
+    ASCII部分按平均每token字符数计算；非ASCII字符按UTF-8字节长度分类，
+    拉丁扩展/西里尔（2字节）、中日韩（3字节）、emoji（4字节）分别按每字符token数计算。
+    """
+    if not text:
+        return 0
+    ascii_chars, two, three, four = utf8_char_counts(text)
+    tokens = (ascii_chars / TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN + two * TOKEN_ESTIMATE_2BYTE_TOKENS_PER_CHAR
+              + three * TOKEN_ESTIMATE_CJK_TOKENS_PER_CHAR + four * TOKEN_ESTIMATE_4BYTE_TOKENS_PER_CHAR)
+    return max(1, int(tokens + 0.5))
+
+
+def _parse_token_count_modes(value: str) -> Dict[str, str]:
+    """解析 TOKEN_COUNT_MODE，返回 {场景: 方式}，"*" 为默认方式"""
+    modes = {"*": "exact"}
+    for item in (value or "").split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        site, _, mode = item.rpartition("=")
+        if mode in ("exact", "estimate"):
+            modes[site or "*"] = mode
+    return modes
+
+
+class Tokenizer:
+    """
+    进程内共享的分词器（cl100k_base）
+
+    首次使用时才加载（或启动后由 preload 在后台加载），所有计数的地方共用同一个实例。
+    优先从本地BPE文件加载，不依赖网络；文件不存在时交给 tiktoken 下载/读取缓存；
+    都失败时退化为 estimate_tokens 估算，不影响请求。
+    每个使用场景（site）可以通过 TOKEN_COUNT_MODE 单独选择精确计数或估算。
+    """
+
+    # 与 tiktoken_ext.openai_public.cl100k_base 一致，从本地文件构造编码时使用
+    CL100K_PAT_STR = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+    CL100K_SPECIAL_TOKENS = {
+        "<|endoftext|>": 100257,
+        "<|fim_prefix|>": 100258,
+        "<|fim_middle|>": 100259,
+        "<|fim_suffix|>": 100260,
+        "<|endofprompt|>": 100276,
+    }
+    CL100K_HASH = "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"
+
+    def __init__(self, name: str = "cl100k_base", bpe_file: Optional[str] = TIKTOKEN_BPE_FILE,
+                 modes: str = TOKEN_COUNT_MODE):
+        self.name = name
+        self.bpe_file = bpe_file
+        self.modes = _parse_token_count_modes(modes)
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.source = None
+        self.error = None
+
+    def _load(self):
+        try:
+            import tiktoken
+        except ImportError as e:
+            self.error = f"tiktoken 未安装: {e}"
+            return None
+
+        if self.bpe_file and os.path.exists(self.bpe_file):
+            try:
+                from tiktoken.load import load_tiktoken_bpe
+                ranks = load_tiktoken_bpe(self.bpe_file, expected_hash=self.CL100K_HASH)
+                self.source = self.bpe_file
+                return tiktoken.Encoding(name=self.name, pat_str=self.CL100K_PAT_STR,
+                                         mergeable_ranks=ranks, special_tokens=self.CL100K_SPECIAL_TOKENS)
+            except Exception as e:
+                if debug:
+                    print(f"从 {self.bpe_file} 加载分词器失败: {e}")
+        try:
+            encoding = tiktoken.get_encoding(self.name)
+            self.source = "tiktoken"
+            return encoding
+        except Exception as e:
+            self.error = str(e)
+            if debug:
+                print(f"加载分词器失败，改用估算: {e}")
+            return None
+
+    @property
+    def encoding(self):
+        """加载后的 tiktoken.Encoding，不可用时为None"""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._encoding = self._load()
+                    self._loaded = True
+        return self._encoding
+
+    def preload(self) -> None:
+        """在后台线程加载，避免第一个请求等待"""
+        if not self._loaded:
+            threading.Thread(target=lambda: self.encoding, name="tokenizer-preload", daemon=True).start()
+
+    def is_exact(self, site: Optional[str] = None) -> bool:
+        """该场景是否使用真实的BPE分词（否则为估算）"""
+        if self.modes.get(site, self.modes["*"]) == "estimate":
+            return False
+        return self.encoding is not None
+
+    def count(self, text: str, site: Optional[str] = None) -> int:
+        """计算文本的token数（特殊token按普通文本处理）
+
+        Args:
+            text: 文本
+            site: 使用场景（prompt、completion、stream），决定精确计数还是估算
+        """
+        if not text:
+            return 0
+        if not self.is_exact(site):
+            return estimate_tokens(text)
+        return len(self.encoding.encode_ordinary(text))
+
+    def count_batch(self, texts: List[str], site: Optional[str] = None) -> List[int]:
+        """批量计数，tiktoken 在多线程中并行编码"""
+        if not self.is_exact(site):
+            return [estimate_tokens(text) for text in texts]
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+    def stats(self) -> Dict:
+        return {"name": self.name, "loaded": self._loaded, "source": self.source, "error": self.error,
+                "modes": self.modes}
+
+
+tokenizer = Tokenizer()
+
+
+class PromptTokenCounter:
+    """
+    按消息计算prompt token数
+
+    每段文本的计数按内容哈希缓存在有界LRU中：会话历史每轮都会重发，只在第一次出现时分词。
+    计数规则参照OpenAI：每条消息有固定的格式开销，name额外计数，最后加上回复前缀；
+    图片不对base64分词，每张按 IMAGE_PROMPT_TOKENS 计。
+    """
+
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_NAME = 1
+    REPLY_PRIMING_TOKENS = 3
+    IMAGE_PROMPT_TOKENS = 85
+
+    def __init__(self, tokenizer: Tokenizer, max_entries: int = PROMPT_TOKEN_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        if not self.tokenizer.is_exact("prompt"):
+            # 估算比查缓存还便宜
+            return estimate_tokens(text)
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            count = self.cache.get(key)
+            if count is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return count
+            self.misses += 1
+
+        count = self.tokenizer.count(text, "prompt")
+        # 分词器还没加载成功时的估算值不缓存
+        if self.tokenizer.is_exact("prompt"):
+            with self.lock:
+                self.cache[key] = count
+                if len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+        return count
+
+    def count_message(self, message: Dict) -> int:
+        tokens = self.TOKENS_PER_MESSAGE + self.count_text(str(message.get("role") or ""))
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(content)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "text":
+                    tokens += self.count_text(part.get("text") or "")
+                elif part.get("type") in ("image_url", "image"):
+                    tokens += self.IMAGE_PROMPT_TOKENS
+        if message.get("name"):
+            tokens += self.TOKENS_PER_NAME + self.count_text(str(message["name"]))
+        return tokens
+
+    def count_history(self, messages: List[Dict]) -> int:
+        """计算消息列表的token数，不含回复前缀"""
+        return sum(self.count_message(m) for m in messages if isinstance(m, dict))
+
+    def count_messages(self, messages: List[Dict]) -> int:
+        """计算整个消息列表的prompt token数"""
+        if not messages:
+            return 0
+        return self.count_history(messages) + self.REPLY_PRIMING_TOKENS
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+prompt_token_counter = PromptTokenCounter(tokenizer)
+
+
+class IncrementalTokenCounter:
+    """
+    流式回答的增量token计数
+
+    片段先攒在列表里，达到 STREAM_COUNT_BATCH_CHARS 再分词一次，
+    不会每个delta都调用分词器，流结束时只剩最后一小批需要计算。
+    """
+
+    def __init__(self, tokenizer: Tokenizer = tokenizer, batch_chars: int = STREAM_COUNT_BATCH_CHARS):
+        self.tokenizer = tokenizer
+        self.batch_chars = batch_chars
+        self.pending: List[str] = []
+        self.pending_chars = 0
+        self.count = 0
+
+    def add(self, text: Optional[str]) -> None:
+        if not text:
+            return
+        self.pending.append(text)
+        self.pending_chars += len(text)
+        if self.pending_chars >= self.batch_chars:
+            self.flush()
+
+    def flush(self) -> int:
+        """计算剩余片段，返回累计token数"""
+        if self.pending:
+            self.count += self.tokenizer.count("".join(self.pending), "stream")
+            self.pending.clear()
+            self.pending_chars = 0
+        return self.count
+
+
+def decode_jwt_exp(token: str) -> Optional[float]:
+    """
+    解析JWT中的exp字段（不校验签名）
+
+    Args:
+        token: JWT字符串
+
+    Returns:
+        Optional[float]: 过期时间戳（秒），无法解析时返回None
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        exp = claims.get("exp") if isinstance(claims, dict) else None
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+class TokenManager:
+    """
+    printSignIn 令牌管理器
+
+    - 根据JWT的exp缓存令牌，所有请求复用同一个令牌
+    - 通过本地缓存文件在多个worker进程之间共享令牌
+    - 过期前 refresh_margin 秒在后台线程中主动刷新
+    - 单飞刷新：并发请求只触发一次登录（进程内用锁，进程间用文件锁）
+    - 登录失败按指数退避并加入随机抖动
+    """
+
+    def __init__(self, refresh_margin: int = TOKEN_REFRESH_MARGIN, cache_file: Optional[str] = TOKEN_CACHE_FILE,
+                 default_ttl: int = TOKEN_DEFAULT_TTL):
+        self.refresh_margin = refresh_margin
+        self.cache_file = cache_file
+        self.default_ttl = default_ttl
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        # 已安排或正在执行后台刷新，避免每个请求都新开一个定时线程
+        self._refreshing = False
+        self._timer_lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0.0
+        self._last_error: Optional[Exception] = None
+        self._cache_mtime = 0.0
+
+    def get_token(self) -> str:
+        """获取可用令牌，必要时登录（同步阻塞）"""
+        token = self._usable_token()
+        if token:
+            return token
+
+        with self._lock:
+            # 等锁期间可能已经被其他请求刷新
+            token = self._usable_token()
+            if token:
+                return token
+            return self._refresh_locked()
+
+    def peek_token(self) -> Optional[str]:
+        """只返回缓存中的可用令牌，不会触发登录"""
+        return self._usable_token()
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """令牌被上游拒绝时调用，下次请求重新登录"""
+        with self._lock:
+            rejected = token or self._token
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+            self._remove_shared(rejected)
+
+    def _usable_token(self) -> Optional[str]:
+        now = time.time()
+        if not (self._token and now < self._expires_at):
+            self._load_shared()
+        if self._token and now < self._expires_at:
+            # 进入刷新窗口但还未过期：继续使用旧令牌，后台刷新
+            if now >= self._expires_at - self.refresh_margin:
+                self._schedule_refresh(0)
+            return self._token
+        return None
+
+    def _refresh_locked(self) -> str:
+        """执行一次登录，调用方必须持有 self._lock"""
+        now = time.time()
+        if now < self._retry_at:
+            raise requests.exceptions.RequestException(
+                f"登录失败，{self._retry_at - now:.1f}秒后重试: {self._last_error}")
+
+        lock_file = self._acquire_file_lock()
+        try:
+            # 其他进程可能已经完成了刷新
+            self._load_shared()
+            if self._token and time.time() < self._expires_at - self.refresh_margin:
+                return self._token
+
+            try:
+                token = self._sign_in()
+            except Exception as e:
+                self._failures += 1
+                self._last_error = e
+                delay = min(TOKEN_BACKOFF_MAX, TOKEN_BACKOFF_BASE * (2 ** (self._failures - 1)))
+                delay = random.uniform(delay / 2, delay)
+                self._retry_at = time.time() + delay
+                if debug:
+                    print(f"登录失败（第{self._failures}次），{delay:.1f}秒后重试: {e}")
+                # 旧令牌还没过期时继续使用
+                if self._token and time.time() < self._expires_at:
+                    self._schedule_refresh(delay)
+                    return self._token
+                raise
+
+            self._failures = 0
+            self._retry_at = 0.0
+            self._last_error = None
+            exp = decode_jwt_exp(token)
+            self._token = token
+            self._expires_at = exp if exp else time.time() + self.default_ttl
+            self._save_shared()
+            self._schedule_refresh(max(0.0, self._expires_at - self.refresh_margin - time.time()))
+            return token
+        finally:
+            self._release_file_lock(lock_file)
+
+    def _sign_in(self) -> str:
+        url = f'{base_url}/v1/auths/printSignIn'
+        headers = {
+            "user-agent": os.getenv("DEGPT_USER_AGENT", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36")
+        }
+        data = {
+            "id": auth_id,
+            "channel": ""
+        }
+        res_page = http_session.post(url=url, headers=headers, json=data, timeout=5)
+        res_page.encoding = "utf-8"
+        res_page.raise_for_status()
+        token = json.loads(res_page.text)["token"]
+        if debug:
+            print(f"res_page: {res_page}\r\nres_page.text: {res_page.text}\r\ntoken:{token}")
+        return token
+
+    def _schedule_refresh(self, delay: float) -> None:
+        """
+        安排一次后台刷新
+
+        已有待执行或正在执行的刷新时不重复安排（刷新线程自己安排下一次除外），
+        登录退避期间推迟到 _retry_at 之后。
+        """
+        with self._timer_lock:
+            if self._refreshing and threading.current_thread() is not self._timer:
+                return
+            delay = max(delay, self._retry_at - time.time(), 0.0)
+            self._refreshing = True
+            self._timer = threading.Timer(delay, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_refresh(self) -> None:
+        try:
+            if not self._lock.acquire(blocking=False):
+                # 前台请求正在刷新
+                return
+            try:
+                if self._token and time.time() < self._expires_at - self.refresh_margin:
+                    return
+                self._refresh_locked()
+            except Exception as e:
+                if debug:
+                    print(f"后台刷新令牌失败: {e}")
+            finally:
+                self._lock.release()
+        finally:
+            with self._timer_lock:
+                # 刷新过程中已安排了下一次时保持标记
+                if self._timer is threading.current_thread():
+                    self._refreshing = False
+
+    def _load_shared(self) -> None:
+        """从共享缓存文件读取其他worker刷新的令牌"""
+        if not self.cache_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.cache_file)
+            if mtime == self._cache_mtime:
+                return
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            self._cache_mtime = mtime
+            if cached.get("auth_id") == auth_id and float(cached.get("expires_at", 0)) > self._expires_at:
+                self._token = cached["token"]
+                self._expires_at = float(cached["expires_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _save_shared(self) -> None:
+        if not self.cache_file:
+            return
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"auth_id": auth_id, "token": self._token, "expires_at": self._expires_at}, f)
+            os.chmod(tmp_file, 0o600)
+            os.replace(tmp_file, self.cache_file)
+            self._cache_mtime = os.path.getmtime(self.cache_file)
+        except OSError as e:
+            if debug:
+                print(f"写入令牌缓存失败: {e}")
+
+    def _remove_shared(self, token: Optional[str]) -> None:
+        """删除共享缓存中被拒绝的令牌，避免其他worker继续读取"""
+        if not self.cache_file or not token:
+            return
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("token") == token:
+                os.remove(self.cache_file)
+            self._cache_mtime = 0.0
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def _acquire_file_lock(self):
+        if not self.cache_file or fcntl is None:
+            return None
+        try:
+            lock_file = open(f"{self.cache_file}.lock", "a")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            return lock_file
+        except OSError:
+            return None
+
+    def _release_file_lock(self, lock_file) -> None:
+        if lock_file is None:
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+
+token_manager = TokenManager()
+
+
+class SharedState:
+    """
+    多worker进程共享的状态存储（本机SQLite，WAL模式）
+
+    - kv: 模型缓存等JSON数据，以及跨进程的任务认领时间戳
+    - model_stats: 模型调用统计，写入为原子自增
+    会话由 SessionStore 负责（多worker时使用同一个文件）。
+    每个线程使用独立连接。
+
+    调用统计先在内存中合并，由后台线程每 FLUSH_INTERVAL 秒在一个事务中写入，
+    记录调用的线程（包括事件循环）不会等待SQLite的写锁。
+    """
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self._pending: Dict[str, list] = {}  # 模型 -> [调用数, 失败数, 最后失败时间]，尚未写入
+        self._pending_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript("""
+                        CREATE TABLE IF NOT EXISTS kv (
+                            key TEXT PRIMARY KEY, value TEXT, updated REAL);
+                        CREATE TABLE IF NOT EXISTS model_stats (
+                            model TEXT PRIMARY KEY, calls INTEGER NOT NULL DEFAULT 0,
+                            fails INTEGER NOT NULL DEFAULT 0, last_fail REAL);
+                    """)
+                    self._initialized = True
+        return conn
+
+    # ---- kv ----
+    def get_json(self, key: str) -> Optional[tuple]:
+        """返回 (value, updated)，不存在时返回None"""
+        row = self._conn().execute("SELECT value, updated FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set_json(self, key: str, value) -> None:
+        self._conn().execute(
+            "INSERT INTO kv(key, value, updated) VALUES(?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+            (key, json.dumps(value, ensure_ascii=False), time.time()))
+
+    def try_claim(self, key: str, interval: float) -> bool:
+        """跨进程认领一个周期任务：距离上次认领超过interval秒时返回True"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT updated FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[0] < interval:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT INTO kv(key, value, updated) VALUES(?, '1', ?) "
+                "ON CONFLICT(key) DO UPDATE SET updated = excluded.updated", (key, now))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    # ---- model_stats ----
+    def record_call(self, model_name: str, success: bool) -> None:
+        """记录一次调用（只放入待写批次，不访问数据库）"""
+        with self._pending_lock:
+            entry = self._pending.setdefault(model_name, [0, 0, None])
+            entry[0] += 1
+            if not success:
+                entry[1] += 1
+                entry[2] = time.time()
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="shared-stats-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                if debug:
+                    print(f"写入共享模型统计失败: {e}")
+
+    def flush(self) -> None:
+        """把待写的调用统计在一个事务中写入（失败时放回批次，下次重试）"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO model_stats(model, calls, fails, last_fail) VALUES(?, ?, ?, ?) "
+                "ON CONFLICT(model) DO UPDATE SET calls = calls + excluded.calls, "
+                "fails = fails + excluded.fails, last_fail = COALESCE(excluded.last_fail, last_fail)",
+                [(model, calls, fails, last_fail) for model, (calls, fails, last_fail) in pending.items()])
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self._pending_lock:
+                for model, (calls, fails, last_fail) in pending.items():
+                    entry = self._pending.setdefault(model, [0, 0, None])
+                    entry[0] += calls
+                    entry[1] += fails
+                    entry[2] = max(filter(None, (entry[2], last_fail)), default=None)
+            raise
+
+    def load_model_stats(self) -> Dict[str, Dict]:
+        """读取所有worker的统计，加上本进程还没写入的部分"""
+        rows = self._conn().execute("SELECT model, calls, fails, last_fail FROM model_stats").fetchall()
+        stats = {model: [calls, fails, last_fail] for model, calls, fails, last_fail in rows}
+        with self._pending_lock:
+            for model, (calls, fails, last_fail) in self._pending.items():
+                entry = stats.setdefault(model, [0, 0, None])
+                entry[0] += calls
+                entry[1] += fails
+                entry[2] = max(filter(None, (entry[2], last_fail)), default=None)
+        return {
+            model: {"calls": calls, "fails": fails,
+                    "last_fail": datetime.fromtimestamp(last_fail) if last_fail else None}
+            for model, (calls, fails, last_fail) in stats.items()
+        }
+
+
+shared_state = SharedState(SHARED_STATE_FILE) if SHARED_STATE else None
+
+
+class SessionStore(ABC):
+    """
+    会话存储接口
+
+    一轮对话只访问存储两次：load 读取历史（同时刷新活跃时间），
+    append 在回答结束后一次性写入本轮的用户消息和助手回复。
+    """
+
+    @abstractmethod
+    def load(self, session_id: str) -> Union[List[Dict], "MessageHistory"]:
+        """
+        获取会话历史，不存在时创建空会话
+
+        返回按时间顺序可迭代、支持len()的历史。内存存储直接返回会话中不可变的 MessageHistory，
+        不复制；调用方需要修改时自行 list()。
+        """
+
+    @abstractmethod
+    def append(self, session_id: str, messages: List[Dict]) -> None:
+        """追加消息，会话不存在时创建"""
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        """删除会话"""
+
+    @abstractmethod
+    def fork(self, session_id: str, new_session_id: str, at: int) -> int:
+        """
+        以会话的前at条消息创建新会话（覆盖已存在的新会话），返回新会话的消息数
+
+        Raises:
+            KeyError: 源会话不存在（或已过期）
+        """
+
+    def cleanup(self) -> int:
+        """清理过期会话，返回清理数量"""
+        return 0
+
+    def stats(self) -> Dict:
+        """存储指标，用于 /health"""
+        return {"type": self.__class__.__name__}
+
+
+def message_nbytes(obj) -> int:
+    """
+    计算消息在内存中占用的字节数
+
+    递归累加 dict/list 容器和字符串等对象本身的大小，
+    多模态消息中的base64图片会按实际字符串大小计入。
+    """
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(message_nbytes(k) + message_nbytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(message_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class MessageHistory:
+    """
+    不可变的会话历史（持久化链表）
+
+    每个节点只保存一条消息和指向上一条的指针：追加一轮对话只新建节点，
+    从第N条分叉直接引用已有节点，不同分支共享相同的前缀，不复制消息。
+    """
+
+    __slots__ = ("message", "parent", "length", "nbytes")
+
+    def __init__(self, message: Optional[Dict] = None, parent: Optional["MessageHistory"] = None):
+        self.message = message
+        self.parent = parent
+        if parent is None:
+            # 空历史
+            self.length = 0
+            self.nbytes = 0
+        else:
+            self.length = parent.length + 1
+            self.nbytes = parent.nbytes + message_nbytes(message)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter(self.to_list())
+
+    def append(self, messages: List[Dict]) -> "MessageHistory":
+        """返回追加消息后的新历史，原历史不变"""
+        history = self
+        for message in messages:
+            history = MessageHistory(message, history)
+        return history
+
+    def prefix(self, n: int) -> "MessageHistory":
+        """返回前n条消息组成的历史（与原历史共享节点，需要从末尾向前走 len-n 步）"""
+        history = self
+        while history.length > max(n, 0):
+            history = history.parent
+        return history
+
+    def tail(self, n: int) -> List[Dict]:
+        """按时间顺序返回最后n条消息，只访问这n个节点"""
+        messages = []
+        history = self
+        while history.length and len(messages) < n:
+            messages.append(history.message)
+            history = history.parent
+        messages.reverse()
+        return messages
+
+    def to_list(self) -> List[Dict]:
+        """按时间顺序返回消息列表（新列表，调用方可以修改）"""
+        messages = [None] * self.length
+        history = self
+        while history.length:
+            messages[history.length - 1] = history.message
+            history = history.parent
+        return messages
+
+
+EMPTY_HISTORY = MessageHistory()
+
+
+class MemorySessionStore(SessionStore):
+    """
+    进程内存储（单worker）
+
+    会话按最后活跃时间排列在 OrderedDict 中：访问时移到末尾，过期会话总在头部，
+    因此访问和过期都是O(1)。每次访问顺带清理少量过期会话，其余由后台定时任务清理。
+    同一顺序也是LRU顺序：消息总字节数超过预算时从头部淘汰最久未使用的会话。
+    会话历史是 MessageHistory，追加和分叉都不复制已有消息；
+    字节数按会话的完整历史计算，分叉共享的前缀会在每个分支中各计一次（偏保守）。
+    """
+
+    def __init__(self, storage: OrderedDict, timeout: int = SESSION_TIMEOUT,
+                 expire_per_touch: int = SESSION_EXPIRE_PER_TOUCH,
+                 budget_bytes: int = int(SESSION_MEMORY_LIMIT_MB * 1024 * 1024)):
+        self.storage = storage
+        self.timeout = timeout
+        self.expire_per_touch = expire_per_touch
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.trimmed_messages = 0
+
+    def _touch(self, session_id: str) -> Dict:
+        now = time.time()
+        self._expire(now, self.expire_per_touch)
+        session = self.storage.get(session_id)
+        if session is None:
+            session = self.storage[session_id] = {"history": EMPTY_HISTORY, "last_activity": now}
+        else:
+            session["last_activity"] = now
+            self.storage.move_to_end(session_id)
+        return session
+
+    def _remove(self, session_id: str) -> int:
+        session = self.storage.pop(session_id)
+        self.total_bytes -= session["history"].nbytes
+        return session["history"].nbytes
+
+    def _expire(self, now: float, limit: Optional[int] = None) -> int:
+        """从头部弹出过期会话，遇到第一个未过期的会话即停止"""
+        deadline = now - self.timeout
+        count = 0
+        while self.storage and (limit is None or count < limit):
+            session_id, session = next(iter(self.storage.items()))
+            if session["last_activity"] > deadline:
+                break
+            self._remove(session_id)
+            count += 1
+            if debug:
+                print(f"清理过期会话: {session_id}")
+        self.expired += count
+        return count
+
+    def _enforce_budget(self, current_id: str, keep: int) -> None:
+        """
+        超出预算时按LRU淘汰其他会话；只剩当前会话仍超出时，丢弃它最早的消息
+
+        Args:
+            current_id: 刚写入的会话，最后才处理
+            keep: 当前会话至少保留的末尾消息数（本轮刚写入的消息）
+        """
+        while self.total_bytes > self.budget_bytes and len(self.storage) > 1:
+            session_id = next(iter(self.storage))
+            if session_id == current_id:
+                # 当前会话刚被访问，正常不会在头部；防御性地移到末尾
+                self.storage.move_to_end(session_id)
+                continue
+            self.evicted_bytes += self._remove(session_id)
+            self.evictions += 1
+            if debug:
+                print(f"会话内存超出预算，淘汰会话: {session_id}")
+
+        session = self.storage.get(current_id)
+        if self.total_bytes > self.budget_bytes and session and len(session["history"]) > keep:
+            # 丢弃最早的消息需要重建链表（少见的情况）
+            history = session["history"]
+            messages = history.to_list()
+            drop = 0
+            excess = self.total_bytes - self.budget_bytes
+            while excess > 0 and len(messages) - drop > keep:
+                excess -= message_nbytes(messages[drop])
+                drop += 1
+            session["history"] = EMPTY_HISTORY.append(messages[drop:])
+            self.total_bytes += session["history"].nbytes - history.nbytes
+            self.trimmed_messages += drop
+
+    def load(self, session_id: str) -> MessageHistory:
+        with self.lock:
+            if session_id in self.storage:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return self._touch(session_id)["history"]
+
+    def append(self, session_id: str, messages: List[Dict]) -> None:
+        with self.lock:
+            session = self._touch(session_id)
+            history = session["history"]
+            session["history"] = history.append(messages)
+            self.total_bytes += session["history"].nbytes - history.nbytes
+            self._enforce_budget(session_id, keep=len(messages))
+
+    def fork(self, session_id: str, new_session_id: str, at: int) -> int:
+        with self.lock:
+            self._expire(time.time(), self.expire_per_touch)
+            if session_id not in self.storage:
+                raise KeyError(session_id)
+            history = self._touch(session_id)["history"].prefix(at)
+            if new_session_id in self.storage:
+                self._remove(new_session_id)
+            self._touch(new_session_id)["history"] = history
+            self.total_bytes += history.nbytes
+            self._enforce_budget(new_session_id, keep=len(history))
+            return len(history)
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            if session_id in self.storage:
+                self._remove(session_id)
+
+    def cleanup(self) -> int:
+        with self.lock:
+            return self._expire(time.time())
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "type": "memory",
+                "sessions": len(self.storage),
+                "bytes": self.total_bytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "trimmed_messages": self.trimmed_messages
+            }
+
+
+class SQLiteSessionStore(SessionStore):
+    """本机持久化存储（SQLite WAL），重启后会话不丢失，多worker可共用同一文件"""
+
+    def __init__(self, path: str, timeout: int = SESSION_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY, last_activity REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS idx_sessions_activity ON sessions(last_activity);
+                CREATE TABLE IF NOT EXISTS session_messages (
+                    session_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL,
+                    PRIMARY KEY (session_id, seq));
+            """)
+            self._local.conn = conn
+        return conn
+
+    def load(self, session_id: str) -> List[Dict]:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.execute(
+                "INSERT INTO sessions(session_id, last_activity) VALUES(?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_activity = excluded.last_activity",
+                (session_id, time.time()))
+            rows = conn.execute("SELECT message FROM session_messages WHERE session_id = ? ORDER BY seq",
+                                (session_id,)).fetchall()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [json.loads(row[0]) for row in rows]
+
+    def append(self, session_id: str, messages: List[Dict]) -> None:
+        if not messages:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO sessions(session_id, last_activity) VALUES(?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_activity = excluded.last_activity",
+                (session_id, time.time()))
+            row = conn.execute("SELECT COALESCE(MAX(seq), -1) FROM session_messages WHERE session_id = ?",
+                               (session_id,)).fetchone()
+            conn.executemany(
+                "INSERT INTO session_messages(session_id, seq, message) VALUES(?, ?, ?)",
+                [(session_id, row[0] + 1 + i, json.dumps(message, ensure_ascii=False))
+                 for i, message in enumerate(messages)])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, session_id: str) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def fork(self, session_id: str, new_session_id: str, at: int) -> int:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT 1 FROM sessions WHERE session_id = ? AND last_activity >= ?",
+                               (session_id, now - self.timeout)).fetchone()
+            if row is None:
+                raise KeyError(session_id)
+            conn.execute("DELETE FROM session_messages WHERE session_id = ?", (new_session_id,))
+            conn.executemany(
+                "INSERT INTO sessions(session_id, last_activity) VALUES(?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_activity = excluded.last_activity",
+                [(session_id, now), (new_session_id, now)])
+            # 在库内复制前at条消息，不经过Python
+            count = conn.execute(
+                "INSERT INTO session_messages(session_id, seq, message) "
+                "SELECT ?, seq, message FROM session_messages WHERE session_id = ? ORDER BY seq LIMIT ?",
+                (new_session_id, session_id, max(at, 0))).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def cleanup(self) -> int:
+        conn = self._conn()
+        deadline = time.time() - self.timeout
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM session_messages WHERE session_id IN "
+                "(SELECT session_id FROM sessions WHERE last_activity < ?)", (deadline,))
+            count = conn.execute("DELETE FROM sessions WHERE last_activity < ?", (deadline,)).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis协议存储：每个会话一个LIST，过期交给Redis的TTL
+
+    读写都通过pipeline一次往返完成。
+    """
+
+    def __init__(self, url: str = REDIS_URL, timeout: int = SESSION_TIMEOUT, prefix: str = SESSION_KEY_PREFIX,
+                 client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("SESSION_STORAGE_TYPE=redis 需要安装 redis 包")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def load(self, session_id: str) -> List[Dict]:
+        key = self._key(session_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.lrange(key, 0, -1)
+        pipe.expire(key, self.timeout)
+        raw_messages, _ = pipe.execute()
+        return [json.loads(raw) for raw in raw_messages]
+
+    def append(self, session_id: str, messages: List[Dict]) -> None:
+        if not messages:
+            return
+        key = self._key(session_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(key, *[json.dumps(message, ensure_ascii=False) for message in messages])
+        pipe.expire(key, self.timeout)
+        pipe.execute()
+
+    def delete(self, session_id: str) -> None:
+        self.client.delete(self._key(session_id))
+
+    def fork(self, session_id: str, new_session_id: str, at: int) -> int:
+        source, target = self._key(session_id), self._key(new_session_id)
+        if not self.client.exists(source):
+            raise KeyError(session_id)
+        # 服务端复制后截断，一次往返（COPY 需要 Redis 6.2+）
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(target)
+        if at > 0:
+            pipe.copy(source, target)
+            pipe.ltrim(target, 0, at - 1)
+        pipe.expire(source, self.timeout)
+        pipe.expire(target, self.timeout)
+        pipe.llen(target)
+        return pipe.execute()[-1]
+
+
+def create_session_store() -> SessionStore:
+    """根据 SESSION_STORAGE_TYPE 创建会话存储"""
+    if SESSION_STORAGE_TYPE == "redis":
+        return RedisSessionStore()
+    if SESSION_STORAGE_TYPE == "sqlite":
+        return SQLiteSessionStore(SESSION_SQLITE_FILE)
+    if SHARED_STATE:
+        # 多worker时进程内存无法共享，改用共享状态文件
+        return SQLiteSessionStore(SHARED_STATE_FILE)
+    return MemorySessionStore(SESSION_STORAGE)
+
+
+session_store = create_session_store()
+_model_stats_synced_at = 0.0
+
+
+def sync_shared_state(force: bool = False) -> None:
+    """从共享存储刷新本进程的 MODEL_STATS 和 cached_models"""
+    global _model_stats_synced_at, last_request_time, MODEL_STATS, cached_models
+    if shared_state is None:
+        return
+    now = time.time()
+    if not force and now - _model_stats_synced_at < SHARED_STATE_SYNC_INTERVAL:
+        return
+    _model_stats_synced_at = now
+    try:
+        # 整体替换引用，避免其他线程遍历时字典被修改
+        MODEL_STATS = shared_state.load_model_stats()
+
+        shared_models = shared_state.get_json("cached_models")
+        if shared_models:
+            models, updated = shared_models
+            if updated > last_request_time:
+                cached_models = models
+                last_request_time = updated
+    except sqlite3.Error as e:
+        if debug:
+            print(f"同步共享状态失败: {e}")
+
+
+def _wait_for_shared_models(timeout: float = 15) -> bool:
+    """等待其他worker发布模型数据"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        sync_shared_state(force=True)
+        if cached_models["data"]:
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def publish_models() -> None:
+    """把本进程获取到的模型数据发布给其他worker"""
+    if shared_state is None:
+        return
+    try:
+        shared_state.set_json("cached_models", cached_models)
+    except sqlite3.Error as e:
+        if debug:
+            print(f"发布模型数据失败: {e}")
+
+
 def record_call(model_name: str, success: bool = True) -> None:
     """
     记录模型调用情况
@@ -194,175 +1545,1519 @@ def record_call(model_name: str, success: bool = True) -> None:
         stats["fails"] += 1
         stats["last_fail"] = datetime.now()
 
+    if shared_state is not None:
+        # 只放入待写批次，由后台线程写入SQLite，不阻塞调用方（包括事件循环）
+        shared_state.record_call(model_name, success)
 
-def get_session(session_id: str) -> List[Dict]:
-    """获取或创建会话上下文"""
-    global SESSION_STORAGE
 
-    # 清理过期会话
-    cleanup_sessions()
-
-    if SESSION_STORAGE_TYPE == "memory":
-        if session_id not in SESSION_STORAGE:
-            SESSION_STORAGE[session_id] = {
-                "messages": [],
-                "last_activity": datetime.now()
-            }
-        else:
-            SESSION_STORAGE[session_id]["last_activity"] = datetime.now()
+def get_session(session_id: str) -> Union[List[Dict], MessageHistory]:
+    """获取或创建会话上下文（过期清理不在请求路径上，见 cleanup_sessions），返回值不能修改"""
+    try:
+        return session_store.load(session_id)
+    except Exception as e:
+        # 会话存储不可用时退化为无上下文对话
+        if debug:
+            print(f"读取会话失败 {session_id}: {e}")
+        return []
 
-        return SESSION_STORAGE[session_id]["messages"]
 
+def session_stats() -> Dict:
+    """会话存储指标"""
+    try:
+        return session_store.stats()
+    except Exception as e:
+        return {"type": session_store.__class__.__name__, "error": str(e)}
 
 
 def cleanup_sessions() -> None:
-    """清理过期会话"""
-    global SESSION_STORAGE
-    now = datetime.now()
-
-    if SESSION_STORAGE_TYPE == "memory":
-        expired_sessions = []
-        for session_id, session_data in SESSION_STORAGE.items():
-            if (now - session_data["last_activity"]).total_seconds() > SESSION_TIMEOUT:
-                expired_sessions.append(session_id)
-
-        for session_id in expired_sessions:
-            del SESSION_STORAGE[session_id]
-            if debug:
-                print(f"清理过期会话: {session_id}")
-
-    elif SESSION_STORAGE_TYPE == "redis":
-        # Redis 会自动过期，这里不需要手动清理
-        pass
+    """清理过期会话，由后台定时任务每 SESSION_CLEANUP_INTERVAL 秒调用一次"""
+    try:
+        session_store.cleanup()
+    except Exception as e:
+        if debug:
+            print(f"清理过期会话失败: {e}")
 
 
 def clear_session(session_id: str) -> None:
     """清除特定会话"""
-    global SESSION_STORAGE
-    if SESSION_STORAGE_TYPE == "memory":
-        if session_id in SESSION_STORAGE:
-            del SESSION_STORAGE[session_id]
-            if debug:
-                print(f"清除会话: {session_id}")
+    session_store.delete(session_id)
+    if debug:
+        print(f"清除会话: {session_id}")
 
 
-def validate_image_content(image_data: str) -> Dict[str, any]:
+def fork_session(session_id: str, new_session_id: str, at: Optional[int] = None) -> int:
     """
-    验证图片内容格式和大小
-    
+    从会话的第at条消息处分叉出新会话
+
     Args:
-        image_data: Base64编码的图片数据或URL
-        
+        session_id: 源会话
+        new_session_id: 新会话ID，已存在时被覆盖
+        at: 保留源会话的前at条消息，None表示全部
+
     Returns:
-        Dict: {
-            "valid": bool,
-            "error": str,
-            "format": str,
-            "size": int
+        int: 新会话的消息数
+
+    Raises:
+        KeyError: 源会话不存在
+    """
+    if not session_id or not new_session_id or session_id == new_session_id:
+        raise ValueError("session_id 和 new_session_id 必须非空且不同")
+    if at is None:
+        at = sys.maxsize
+    count = session_store.fork(session_id, new_session_id, at)
+    if debug:
+        print(f"会话 {session_id} 分叉为 {new_session_id}，保留 {count} 条消息")
+    return count
+
+
+def _message_key(message: Dict) -> tuple:
+    """比较消息是否相同时使用的键：角色、文本内容和图片数量（图片在会话中保存为引用，不比较URL）"""
+    content = message.get("content")
+    if isinstance(content, list):
+        texts = tuple((part.get("text") or "").strip() for part in content
+                      if isinstance(part, dict) and part.get("type") == "text")
+        images = sum(1 for part in content if isinstance(part, dict) and part.get("type") in ("image_url", "image"))
+        return message.get("role"), texts, images
+    return message.get("role"), ((content or "").strip(),) if isinstance(content, str) else (), 0
+
+
+def resent_history_count(history: Union[List[Dict], MessageHistory], messages: List[Dict]) -> int:
+    """
+    客户端重发的会话历史条数
+
+    OpenAI风格的客户端每轮都会发送完整历史：会话末尾的k条与本轮非system消息的开头k条相同时，
+    这k条不再转发和保存。本轮最后一条消息总是视为新消息。
+
+    Args:
+        history: 会话中已保存的消息
+        messages: 本轮请求中的消息
+
+    Returns:
+        int: 本轮非system消息中与会话重复的开头条数
+    """
+    turn = [_message_key(m) for m in messages if m.get("role") != "system"]
+    limit = min(len(history), len(turn) - 1)
+    if limit <= 0:
+        return 0
+    recent = history.tail(limit) if isinstance(history, MessageHistory) else history[len(history) - limit:]
+    tail = [_message_key(m) for m in recent]
+    for k in range(limit, 0, -1):
+        if tail[limit - k] == turn[0] and tail[limit - k:] == turn[:k]:
+            return k
+    return 0
+
+
+def drop_resent_messages(messages: List[Dict], count: int) -> List[Dict]:
+    """去掉开头count条非system消息，system消息保留在原位置"""
+    kept = []
+    for message in messages:
+        if count and message.get("role") != "system":
+            count -= 1
+            continue
+        kept.append(message)
+    return kept
+
+
+def save_turn(session_id: str, turn_messages: Optional[List[Dict]], assistant_message: Optional[Dict]) -> bool:
+    """保存一轮对话（本轮用户消息 + 助手回复），返回是否保存成功"""
+    messages = list(turn_messages or [])
+    if assistant_message:
+        messages.append(assistant_message)
+    if not session_id or not messages:
+        return False
+    try:
+        session_store.append(session_id, messages)
+        return True
+    except Exception as e:
+        if debug:
+            print(f"保存会话失败 {session_id}: {e}")
+        return False
+
+
+IMAGE_URL_PATTERN = re.compile(
+    r'^https?://'  # http:// 或 https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'  # 域名
+    r'[A-Z]{2,6}\.?|'  # 顶级域名
+    r'localhost|'  # localhost
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # IP地址
+    r'(?::\d+)?'  # 可选端口
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+
+SUPPORTED_IMAGE_FORMATS = ("image/jpeg", "image/png", "image/gif", "image/webp")
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_IMAGE_RESOLUTION = 4096
+# 读取尺寸时只解码开头这么多字节；JPEG的SOF段在更后面时才解码整张图片
+IMAGE_SNIFF_BYTES = 64 * 1024
+# JPEG中带尺寸的帧头标记（SOF0-SOF15，除去DHT/JPG/DAC）
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def sniff_image_size(data: bytes) -> Optional[tuple]:
+    """
+    从文件头读取图片格式和尺寸，不解码像素
+
+    支持 PNG / JPEG / GIF / WebP（VP8、VP8L、VP8X）。
+
+    Args:
+        data: 图片开头的字节（可以不完整）
+
+    Returns:
+        (mime类型, 宽, 高)；不是支持的格式或数据不够时返回 None
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR" and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return "image/png", width, height
+
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        width, height = struct.unpack("<HH", data[6:10])
+        return "image/gif", width, height
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", data[26:30])
+            return "image/webp", width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L" and data[20] == 0x2F:
+            bits = int.from_bytes(data[21:25], "little")
+            return "image/webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return "image/webp", int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+
+    if data[:2] == b"\xff\xd8":
+        # 逐段跳过，直到遇到帧头
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker == 0xFF:
+                # 填充字节
+                i += 1
+                continue
+            if marker in _JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return "image/jpeg", width, height
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # 没有长度字段的标记
+                i += 2
+                continue
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+class ImageValidator:
+    """
+    图片校验（按内容哈希缓存结果）
+
+    base64图片的大小由编码长度直接算出，尺寸只解码文件头读取，不用PIL打开整张图片；
+    超出大小限制的图片不解码。会话历史中的图片每轮都会重发，相同内容只校验一次。
+    """
+
+    def __init__(self, max_entries: int = IMAGE_VALIDATION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _result(valid: bool, error: str, format: str, size: int, width: int = 0, height: int = 0,
+                digest: str = "") -> Dict[str, any]:
+        return {
+            "valid": valid,
+            "error": error,
+            "format": format,
+            "size": size,
+            "width": width,
+            "height": height,
+            "hash": digest
         }
+
+    @staticmethod
+    def content_hash(image_data: str) -> str:
+        """data URL的内容哈希，分段编码，避免复制整张图片"""
+        h = hashlib.blake2b(digest_size=16)
+        for i in range(0, len(image_data), 1 << 20):
+            h.update(image_data[i:i + (1 << 20)].encode("utf-8"))
+        return h.hexdigest()
+
+    def validate(self, image_data: str) -> Dict[str, any]:
+        """
+        验证图片内容格式和大小
+
+        Args:
+            image_data: Base64编码的图片数据或URL
+
+        Returns:
+            Dict: {"valid", "error", "format", "size", "width", "height", "hash"}，
+            hash 为base64图片解码前内容的哈希（URL图片为空）
+        """
+        try:
+            if image_data.startswith("data:image/"):
+                digest = self.content_hash(image_data)
+                with self.lock:
+                    result = self.cache.get(digest)
+                    if result is not None:
+                        self.cache.move_to_end(digest)
+                        self.hits += 1
+                        return dict(result)
+                    self.misses += 1
+
+                result = self._validate_base64(image_data, digest)
+                with self.lock:
+                    self.cache[digest] = result
+                    if len(self.cache) > self.max_entries:
+                        self.cache.popitem(last=False)
+                return dict(result)
+
+            if image_data.startswith(("http://", "https://")):
+                if not IMAGE_URL_PATTERN.match(image_data):
+                    return self._result(False, "无效的图片URL格式", "image/url", 0)
+                return self._result(True, "", "image/url", 0)
+
+            return self._result(False, "不支持的图片格式，仅支持Base64编码或HTTP/HTTPS URL", "unknown", 0)
+        except Exception as e:
+            return self._result(False, f"图片验证失败: {str(e)}", "unknown", 0)
+
+    def _validate_base64(self, image_data: str, digest: str) -> Dict[str, any]:
+        # 解析data URL（按下标切片，不复制整段base64）
+        comma = image_data.index(",")
+        mime_type = image_data[:comma].split(";")[0].split(":")[1]
+
+        if mime_type not in SUPPORTED_IMAGE_FORMATS:
+            return self._result(False, f"不支持的图片格式: {mime_type}", mime_type, 0, digest=digest)
+
+        # 解码后的大小由base64长度算出
+        start, end = comma + 1, len(image_data)
+        while end > start and image_data[end - 1] in "= \r\n":
+            end -= 1
+        image_size = (end - start) * 3 // 4
+        if image_size > MAX_IMAGE_BYTES:
+            return self._result(False, f"图片大小超出限制: {image_size / (1024 * 1024):.2f}MB > 20MB",
+                                mime_type, image_size, digest=digest)
+
+        try:
+            # 先只解码文件头，读不到尺寸（JPEG元数据很长或base64中有换行）再完整解码一次
+            prefix_chars = IMAGE_SNIFF_BYTES // 3 * 4
+            sniffed = None
+            if end - start > prefix_chars:
+                try:
+                    sniffed = sniff_image_size(base64.b64decode(image_data[start:start + prefix_chars]))
+                except Exception:
+                    sniffed = None
+            if sniffed is None:
+                image_bytes = base64.b64decode(image_data[start:])
+                image_size = len(image_bytes)
+                sniffed = sniff_image_size(image_bytes)
+        except Exception as e:
+            return self._result(False, f"Base64解码失败: {str(e)}", mime_type, 0, digest=digest)
+
+        if sniffed is None:
+            return self._result(False, "图片格式错误: 无法识别的图片数据", mime_type, image_size, digest=digest)
+
+        _, width, height = sniffed
+        if width > MAX_IMAGE_RESOLUTION or height > MAX_IMAGE_RESOLUTION:
+            return self._result(False, f"图片分辨率过高: {width}x{height} > {MAX_IMAGE_RESOLUTION}x{MAX_IMAGE_RESOLUTION}",
+                                mime_type, image_size, width, height, digest)
+
+        return self._result(True, "", mime_type, image_size, width, height, digest)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+image_validator = ImageValidator()
+
+
+IMAGE_REF_PREFIX = "degpt-image://"
+IMAGE_EXPIRED_TEXT = "[图片已过期]"
+
+
+class ImageStore:
+    """
+    按内容寻址的图片存储（哈希 -> 解码后的图片字节）
+
+    会话历史中的图片只保存 degpt-image://<哈希> 引用，同一张图片无论出现在多少轮、
+    多少个会话（包括分叉出的会话）中都只存一份，构建上游请求时才还原为data URL。
+    保存的是base64解码后的字节（比data URL小约1/4），哈希仍按原data URL计算。
+    内存超出预算时把最久未用的图片写到磁盘，磁盘超出预算时删除；找不到的引用
+    还原为文字提示。
+
+    磁盘目录：
+    - 会话在本进程内存中时，每个进程使用独立的子目录 worker-<pid>，启动时删除已退出进程的子目录
+    - 会话存在sqlite/redis时图片同时写盘（write_through），同一台机器的worker共用目录，
+      按文件名即可读取其他worker写入的图片。目录中的文件本身就是索引：读取时刷新mtime，
+      超出预算时在文件锁内扫描目录、按mtime删除最旧的文件，所有worker共用一份预算
     """
+
+    FILE_SUFFIX = ".img"
+    # 本进程写入的字节数超过预算的这个比例时重新扫描目录（其他worker的写入只能通过扫描得知）
+    SCAN_FRACTION = 16
+
+    def __init__(self, directory: str = IMAGE_STORE_DIR,
+                 memory_budget: int = int(IMAGE_STORE_MEMORY_MB * 1024 * 1024),
+                 disk_budget: int = int(IMAGE_STORE_DISK_MB * 1024 * 1024),
+                 write_through: bool = False, max_age: int = SESSION_TIMEOUT):
+        self.write_through = write_through
+        self.root = directory
+        self.directory = directory if write_through else os.path.join(directory, f"worker-{os.getpid()}")
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.max_age = max_age
+        self.memory = OrderedDict()  # 哈希 -> (data URL头, 字节)，按最近使用排序
+        self.memory_bytes = 0
+        # 最近一次扫描得到的磁盘占用，加上本进程之后写入的部分
+        self.disk_images = 0
+        self.disk_bytes = 0
+        self.written_since_scan = 0
+        self.lock = threading.Lock()
+        self.spilled = 0
+        self.missing = 0
+        self.pruned = 0
+        self._prepared = False
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + self.FILE_SUFFIX)
+
+    def prepare(self) -> None:
+        """创建目录并清理上次运行留下的文件（服务启动时调用，第一次写盘前也会调用）"""
+        if self._prepared:
+            return
+        self._prepared = True
+        try:
+            self._prepare_directory()
+        except OSError as e:
+            if debug:
+                print(f"清理图片目录失败: {e}")
+
+    def _prepare_directory(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if self.write_through:
+            self._prune(startup=True)
+            return
+        # 本进程的目录可能是之前同pid进程留下的
+        for entry in os.scandir(self.directory):
+            self._unlink(entry.path)
+        for entry in os.scandir(self.root):
+            if not (entry.is_dir() and entry.name.startswith("worker-")) or entry.path == self.directory:
+                continue
+            try:
+                os.kill(int(entry.name[len("worker-"):]), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except (ValueError, OSError):
+                # 无法判断（例如没有权限）时保留
+                continue
+            for child in os.scandir(entry.path):
+                self._unlink(child.path)
+            try:
+                os.rmdir(entry.path)
+            except OSError:
+                pass
+
+    def _unlink(self, path: str) -> None:
+        try:
+            os.remove(path)
+            self.pruned += 1
+        except OSError:
+            pass
+
+    def _prune(self, startup: bool = False) -> None:
+        """
+        扫描目录，删除过期和超出预算的图片（最久未读取的先删）
+
+        共享目录时在文件锁内执行，避免多个worker同时删除。
+        """
+        lock_file = None
+        if self.write_through and fcntl is not None:
+            try:
+                lock_file = open(os.path.join(self.directory, ".lock"), "a")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            except OSError:
+                lock_file = None
+        try:
+            now = time.time()
+            files = []
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(".tmp"):
+                    # 写入过程中崩溃留下的临时文件
+                    if startup and now - stat.st_mtime > 60:
+                        self._unlink(entry.path)
+                    continue
+                if not entry.name.endswith(self.FILE_SUFFIX):
+                    continue
+                if self.write_through and now - stat.st_mtime > self.max_age:
+                    # 超过会话超时没有被读取过，引用它的会话都已过期
+                    self._unlink(entry.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            files.sort()
+            while total > self.disk_budget and len(files) > 1:
+                _, size, path = files.pop(0)
+                self._unlink(path)
+                total -= size
+            self.disk_images = len(files)
+            self.disk_bytes = total
+            self.written_since_scan = 0
+        finally:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def _write(self, digest: str, header: str, blob: bytes) -> None:
+        """写入磁盘（先写临时文件再改名，其他进程不会读到半个文件）"""
+        self.prepare()
+        path = self._path(digest)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header.encode("ascii"))
+            f.write(b"\n")
+            f.write(blob)
+        os.replace(tmp_path, path)
+        size = len(header) + 1 + len(blob)
+        self.disk_images += 1
+        self.disk_bytes += size
+        self.written_since_scan += size
+        if self.disk_bytes > self.disk_budget or self.written_since_scan > self.disk_budget // self.SCAN_FRACTION:
+            self._prune()
+
+    @staticmethod
+    def _decode(data_url: str) -> Optional[tuple]:
+        """把data URL拆成 (头部, 解码后的字节)，无法解码时返回None"""
+        header, sep, payload = data_url.partition(",")
+        if not sep or not header.startswith("data:") or not header.endswith(";base64") or not header.isascii():
+            return None
+        try:
+            return header, base64.b64decode(payload, validate=True)
+        except ValueError:
+            return None
+
+    def put(self, data_url: str, digest: Optional[str] = None) -> str:
+        """
+        保存图片
+
+        Args:
+            data_url: base64图片的data URL
+            digest: 已算好的内容哈希（图片校验结果中的hash）
+
+        Returns:
+            str: 图片引用；无法解码的data URL原样返回（继续内联保存在会话中）
+        """
+        digest = digest or ImageValidator.content_hash(data_url)
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                return IMAGE_REF_PREFIX + digest
+        decoded = self._decode(data_url)
+        if decoded is None:
+            return data_url
+        header, blob = decoded
+        with self.lock:
+            if digest in self.memory:
+                return IMAGE_REF_PREFIX + digest
+            self.memory[digest] = (header, blob)
+            self.memory_bytes += len(blob)
+            try:
+                if self.write_through:
+                    self._write(digest, header, blob)
+                # 磁盘写入在锁内完成：只有图片请求会用到这把锁
+                while self.memory_bytes > self.memory_budget and len(self.memory) > 1:
+                    old_digest, (old_header, old_blob) = self.memory.popitem(last=False)
+                    self.memory_bytes -= len(old_blob)
+                    self._write(old_digest, old_header, old_blob)
+                    self.spilled += 1
+            except OSError as e:
+                if debug:
+                    print(f"图片写入磁盘失败: {e}")
+        return IMAGE_REF_PREFIX + digest
+
+    def get(self, digest: str) -> Optional[str]:
+        """按哈希读取图片的data URL，不存在时返回None（可能读磁盘，不要在事件循环中调用）"""
+        with self.lock:
+            entry = self.memory.get(digest)
+            if entry is not None:
+                self.memory.move_to_end(digest)
+        if entry is None:
+            # 磁盘上的图片可能是其他worker写入的
+            path = self._path(digest)
+            try:
+                with open(path, "rb") as f:
+                    header, sep, blob = f.read().partition(b"\n")
+                if not sep:
+                    raise ValueError("invalid image file")
+                # mtime作为LRU顺序
+                os.utime(path)
+                entry = header.decode("ascii"), blob
+            except (OSError, ValueError):
+                with self.lock:
+                    self.missing += 1
+                return None
+        header, blob = entry
+        return header + "," + base64.b64encode(blob).decode("ascii")
+
+    def to_refs(self, messages: List[Dict], images: List["ImageRef"]) -> List[Dict]:
+        """
+        把消息中的base64图片替换为引用（用于写入会话）
+
+        只复制包含图片的消息，原消息不变；URL图片保持原样。
+        """
+        hashes = {img.url: img.hash for img in images if img.hash}
+        if not hashes:
+            return messages
+        result = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list) and any(self._image_url(part) in hashes for part in content):
+                parts = []
+                for part in content:
+                    url = self._image_url(part)
+                    if url in hashes:
+                        part = {**part, "image_url": {**part["image_url"], "url": self.put(url, hashes[url])}}
+                    parts.append(part)
+                message = {**message, "content": parts}
+            result.append(message)
+        return result
+
+    def materialize(self, messages: List[Dict]) -> List[Dict]:
+        """
+        把会话消息中的图片引用还原为data URL（用于构建上游请求）
+
+        在传入的列表上原地替换，只复制包含引用的消息，会话中保存的消息不变。
+        """
+        for i, message in enumerate(messages):
+            content = message.get("content") if isinstance(message, dict) else None
+            if not isinstance(content, list):
+                continue
+            if not any(self._image_url(part).startswith(IMAGE_REF_PREFIX) for part in content):
+                continue
+            parts = []
+            for part in content:
+                url = self._image_url(part)
+                if url.startswith(IMAGE_REF_PREFIX):
+                    data_url = self.get(url[len(IMAGE_REF_PREFIX):])
+                    if data_url is None:
+                        part = {"type": "text", "text": IMAGE_EXPIRED_TEXT}
+                    else:
+                        part = {**part, "image_url": {**part["image_url"], "url": data_url}}
+                parts.append(part)
+            messages[i] = {**message, "content": parts}
+        return messages
+
+    @staticmethod
+    def _image_url(part) -> str:
+        if isinstance(part, dict) and part.get("type") == "image_url" and isinstance(part.get("image_url"), dict):
+            url = part["image_url"].get("url")
+            if isinstance(url, str):
+                return url
+        return ""
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "directory": self.directory,
+                "memory_images": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_images": self.disk_images,
+                "disk_bytes": self.disk_bytes,
+                "spilled": self.spilled,
+                "missing": self.missing,
+                "pruned": self.pruned
+            }
+
+
+# 会话不在本进程内存中时，图片同时写盘供其他worker读取
+image_store = ImageStore(write_through=not isinstance(session_store, MemorySessionStore))
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def _downscale_image(data_url: str, width: int, height: int, quality: int) -> Optional[tuple]:
+    """
+    缩小并重新压缩一张base64图片（在进程池中执行）
+
+    不透明图片输出JPEG，带透明通道的输出PNG；动图、结果没有变小时返回None。
+    输出图片按EXIF方向转正（输出不带EXIF），目标尺寸是文件头中旋转前的尺寸，
+    方向为5–8（旋转90°/270°）时宽高互换。
+
+    Returns:
+        (data URL, 宽, 高)；不需要替换时返回None
+    """
+    payload = data_url[data_url.index(",") + 1:]
+    img = Image.open(io.BytesIO(base64.b64decode(payload)))
+    if getattr(img, "is_animated", False):
+        return None
+    orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    # JPEG可以在解码时直接按比例缩小；draft只在解码前有效，按旋转前的尺寸调用
+    img.draft("RGB", (width, height))
+    img = ImageOps.exif_transpose(img)
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+
+    out = io.BytesIO()
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img.save(out, "PNG")
+        mime_type = "image/png"
+    else:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        mime_type = "image/jpeg"
+    if out.tell() * 4 // 3 >= len(payload):
+        return None
+    return f"data:{mime_type};base64," + base64.b64encode(out.getbuffer()).decode("ascii"), width, height
+
+
+class ImageDownscaler:
+    """
+    转发前按OpenAI的 detail 规则缩小图片
+
+    - low: 缩放到 512x512 以内
+    - high / auto: 先缩放到 2048x2048 以内，再把短边缩到 768 以内
+
+    是否需要处理由校验时读到的尺寸决定，不解码图片；尺寸已经达标的小图片直接转发。
+    Pillow解码和编码在进程池中执行，结果按 (原图哈希, 目标尺寸) 缓存，
+    会话中重复出现的图片只处理一次。处理失败时转发原图。
+    """
+
+    LOW_DETAIL_SIZE = 512
+    HIGH_DETAIL_MAX_SIZE = 2048
+    HIGH_DETAIL_SHORT_SIDE = 768
+    # 尺寸已达标但超过这个大小的图片仍然重新压缩
+    RECOMPRESS_MIN_BYTES = 256 * 1024
+
+    def __init__(self, workers: int = IMAGE_DOWNSCALE_WORKERS, quality: int = IMAGE_DOWNSCALE_QUALITY,
+                 max_entries: int = IMAGE_DOWNSCALE_CACHE_SIZE, enabled: bool = IMAGE_DOWNSCALE):
+        self.workers = workers
+        self.quality = quality
+        self.max_entries = max_entries
+        self.enabled = enabled and Image is not None
+        self.cache = OrderedDict()  # (哈希, 宽, 高) -> 处理后的ImageRef，None表示无需替换
+        self.lock = threading.Lock()
+        self._pool = None
+        self.processed = 0
+        self.saved_bytes = 0
+        self.failures = 0
+
+    def _executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self.lock:
+            if self._pool is None:
+                # spawn: 服务进程里有很多线程，fork出的子进程可能继承被占用的锁
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def preload(self) -> None:
+        """启动时预热进程池（子进程导入模块需要几秒），不等待完成"""
+        if self.enabled:
+            pool = self._executor()
+            for _ in range(self.workers):
+                pool.submit(sniff_image_size, b"")
+
+    def target_size(self, image: "ImageRef") -> Optional[tuple]:
+        """计算目标尺寸，不需要处理时返回None"""
+        width, height = image.width, image.height
+        if not image.hash or not width or not height or image.format == "image/gif":
+            return None
+        if image.detail == "low":
+            scale = min(1.0, self.LOW_DETAIL_SIZE / max(width, height))
+        else:
+            scale = min(1.0, self.HIGH_DETAIL_MAX_SIZE / max(width, height))
+            short_side = min(width, height) * scale
+            if short_side > self.HIGH_DETAIL_SHORT_SIDE:
+                scale *= self.HIGH_DETAIL_SHORT_SIDE / short_side
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if target == (width, height) and image.size <= self.RECOMPRESS_MIN_BYTES:
+            return None
+        return target
+
+    def _plan(self, request: "ChatRequest"):
+        """返回 (已缓存的结果, 需要处理的任务)"""
+        done, pending = {}, {}
+        for image in request.images:
+            target = self.target_size(image)
+            if target is None:
+                continue
+            key = (image.hash, target)
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    done[image.url] = self.cache[key]
+                    continue
+            pending.setdefault(key, image)
+        return done, pending
+
+    def _finish(self, key, image: "ImageRef", output: Optional[tuple]) -> Optional["ImageRef"]:
+        """记录处理结果并放入缓存"""
+        result = None
+        if output:
+            # 输出尺寸是转正后的尺寸，按EXIF旋转过的图片与目标尺寸宽高互换
+            data_url, width, height = output
+            comma = data_url.index(",")
+            result = ImageRef(data_url, image.detail, data_url[5:data_url.index(";")],
+                              (len(data_url) - comma - 1) * 3 // 4, width, height,
+                              ImageValidator.content_hash(data_url))
+        with self.lock:
+            self.processed += 1
+            if result:
+                self.saved_bytes += image.size - result.size
+            self.cache[key] = result
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return result
+
+    def _failed(self, image: "ImageRef", e: Exception) -> None:
+        with self.lock:
+            self.failures += 1
+        if debug:
+            print(f"图片缩放失败，转发原图: {e}")
+
+    def transform(self, request: "ChatRequest") -> "ChatRequest":
+        """同步处理请求中的图片（在工作线程中调用）"""
+        if not self.enabled or not request.images or request.downscaled:
+            return request
+        request.downscaled = True
+        done, pending = self._plan(request)
+        if pending:
+            pool = self._executor()
+            futures = {key: pool.submit(_downscale_image, image.url, key[1][0], key[1][1], self.quality)
+                       for key, image in pending.items()}
+            for key, future in futures.items():
+                image = pending[key]
+                try:
+                    done[image.url] = self._finish(key, image, future.result())
+                except Exception as e:
+                    self._failed(image, e)
+        # 无需替换的图片结果为None，不能当作移除
+        request.replace_images({url: ref for url, ref in done.items() if ref is not None})
+        return request
+
+    async def atransform(self, request: "ChatRequest") -> "ChatRequest":
+        """异步处理请求中的图片，等待进程池时不阻塞事件循环"""
+        if not self.enabled or not request.images or request.downscaled:
+            return request
+        request.downscaled = True
+        done, pending = self._plan(request)
+        if pending:
+            pool = self._executor()
+            keys = list(pending)
+            results = await asyncio.gather(*(
+                asyncio.wrap_future(pool.submit(_downscale_image, pending[key].url, key[1][0], key[1][1],
+                                                self.quality))
+                for key in keys), return_exceptions=True)
+            for key, output in zip(keys, results):
+                image = pending[key]
+                if isinstance(output, BaseException):
+                    self._failed(image, output)
+                else:
+                    done[image.url] = self._finish(key, image, output)
+        # 无需替换的图片结果为None，不能当作移除
+        request.replace_images({url: ref for url, ref in done.items() if ref is not None})
+        return request
+
+    def shutdown(self) -> None:
+        with self.lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "cached": len(self.cache),
+                "processed": self.processed,
+                "saved_bytes": self.saved_bytes,
+                "failures": self.failures
+            }
+
+
+image_downscaler = ImageDownscaler()
+
+
+IMAGE_UNAVAILABLE_TEXT = "[图片无法访问]"
+
+
+def is_public_address(host: str) -> bool:
+    """IP地址是否是公网地址（内网、本机、链路本地、保留和组播地址都不是）"""
     try:
-        # 检查是否为Base64编码的图片
-        if image_data.startswith('data:image/'):
-            # 解析data URL
-            header, base64_data = image_data.split(',', 1)
-            mime_type = header.split(';')[0].split(':')[1]
-            
-            # 检查支持的图片格式
-            supported_formats = ['image/jpeg', 'image/png', 'image/gif', 'image/webp']
-            if mime_type not in supported_formats:
-                return {
-                    "valid": False,
-                    "error": f"不支持的图片格式: {mime_type}",
-                    "format": mime_type,
-                    "size": 0
-                }
-            
+        ip = ipaddress.ip_address(host.split("%", 1)[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver(aiohttp.abc.AbstractResolver):
+    """只返回公网地址的DNS解析器，域名解析到内网地址时连接失败"""
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        hosts = [h for h in await self._resolver.resolve(host, port, family) if is_public_address(h["host"])]
+        if not hosts:
+            raise OSError(f"不允许访问内网地址: {host}")
+        return hosts
+
+    async def close(self) -> None:
+        await self._resolver.close()
+
+
+class ImagePrefetcher:
+    """
+    预先下载请求中的图片URL
+
+    图片在独立的后台事件循环中并发下载（aiohttp，限制并发数、单张大小和超时），
+    服务端在选择模型、读取会话、获取token的同时等待下载完成；同步和异步入口共用同一套下载。
+    下载结果按URL缓存 IMAGE_URL_CACHE_TTL 秒，过期后带 If-None-Match 重新验证，
+    服务器返回304时直接复用，重复出现的图片不再下载。
+    无法访问、过大或不是图片的URL在转发前换成文字提示，不会让上游请求失败。
+
+    默认只访问公网地址：URL中的IP和域名解析结果都要求是公网地址，重定向手动跟随，
+    每一跳都重新检查。缓存同时限制内存预算和条数（只校验模式和失败结果不占预算）。
+    """
+
+    # 失败结果只缓存很短时间
+    FAILURE_TTL = 30
+    MAX_REDIRECTS = 3
+
+    def __init__(self, mode: str = IMAGE_URL_PREFETCH, timeout: float = IMAGE_URL_FETCH_TIMEOUT,
+                 concurrency: int = IMAGE_URL_FETCH_CONCURRENCY, ttl: int = IMAGE_URL_CACHE_TTL,
+                 budget_bytes: int = int(IMAGE_URL_CACHE_MB * 1024 * 1024),
+                 max_entries: int = IMAGE_URL_CACHE_SIZE, allow_private: bool = IMAGE_URL_ALLOW_PRIVATE):
+        self.mode = mode if mode in ("validate", "inline") else "off"
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.budget_bytes = budget_bytes
+        self.max_entries = max_entries
+        self.allow_private = allow_private
+        self.cache = OrderedDict()  # URL -> (过期时间, ETag, 结果)
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.fetched = 0
+        self.revalidated = 0
+        self.hits = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="image-prefetch", daemon=True).start()
+            return self._loop
+
+    def start(self, request: "ChatRequest") -> None:
+        """开始下载请求中的图片URL，不等待"""
+        if not self.enabled or request.prefetch:
+            return
+        urls = {image.url for image in request.images if image.format == "image/url"}
+        if not urls:
+            return
+        loop = self._event_loop()
+        for url in urls:
+            request.prefetch[url] = asyncio.run_coroutine_threadsafe(self.fetch(url), loop)
+
+    def wait(self, request: "ChatRequest") -> "ChatRequest":
+        """等待下载完成并更新请求中的图片（在工作线程中调用）"""
+        if not self.enabled:
+            return request
+        self.start(request)
+        self._collect(request, self.timeout + 1)
+        return request
+
+    async def await_request(self, request: "ChatRequest") -> "ChatRequest":
+        """异步等待下载完成，不阻塞调用方的事件循环"""
+        if not self.enabled:
+            return request
+        self.start(request)
+        if request.prefetch:
+            await asyncio.wait([asyncio.wrap_future(f) for f in request.prefetch.values()],
+                               timeout=self.timeout + 1)
+        # 此时还没完成的下载按超时处理
+        self._collect(request, 0)
+        return request
+
+    def _collect(self, request: "ChatRequest", timeout: float) -> None:
+        results = {}
+        for url, future in request.prefetch.items():
             try:
-                # 解码Base64数据
-                image_bytes = base64.b64decode(base64_data)
-                image_size = len(image_bytes)
-                
-                # 检查文件大小限制 (20MB)
-                max_size = 20 * 1024 * 1024
-                if image_size > max_size:
-                    return {
-                        "valid": False,
-                        "error": f"图片大小超出限制: {image_size / (1024*1024):.2f}MB > 20MB",
-                        "format": mime_type,
-                        "size": image_size
-                    }
-                
-                # 如果有PIL，验证图片内容
-                if Image and io:
-                    try:
-                        img = Image.open(io.BytesIO(image_bytes))
-                        width, height = img.size
-                        
-                        # 检查分辨率限制
-                        max_resolution = 4096
-                        if width > max_resolution or height > max_resolution:
-                            return {
-                                "valid": False,
-                                "error": f"图片分辨率过高: {width}x{height} > {max_resolution}x{max_resolution}",
-                                "format": mime_type,
-                                "size": image_size
-                            }
-                    except Exception as e:
-                        return {
-                            "valid": False,
-                            "error": f"图片格式错误: {str(e)}",
-                            "format": mime_type,
-                            "size": image_size
-                        }
-                
-                return {
-                    "valid": True,
-                    "error": "",
-                    "format": mime_type,
-                    "size": image_size
-                }
-                
+                results[url] = future.result(timeout=timeout)
             except Exception as e:
-                return {
-                    "valid": False,
-                    "error": f"Base64解码失败: {str(e)}",
-                    "format": mime_type,
-                    "size": 0
-                }
-        
-        elif image_data.startswith(('http://', 'https://')):
-            # URL图片支持（简单验证）
+                results[url] = self._failure(f"图片下载失败: {str(e) or '超时'}")
+        self._apply(request, results)
+
+    def _apply(self, request: "ChatRequest", results: Dict[str, Dict]) -> None:
+        request.prefetch = {}
+        replaced = {}
+        for image in request.images:
+            result = results.get(image.url)
+            if result is None:
+                continue
+            if not result["valid"]:
+                request.errors.append(f"图片验证失败: {result['error']}")
+                replaced[image.url] = None
+                continue
+            url = result["data_url"] if self.mode == "inline" else image.url
+            replaced[image.url] = ImageRef(url, image.detail, result["format"], result["size"], result["width"],
+                                           result["height"], result["hash"] if self.mode == "inline" else "")
+        request.replace_images(replaced, IMAGE_UNAVAILABLE_TEXT)
+
+    @staticmethod
+    def _failure(error: str) -> Dict:
+        return {"valid": False, "error": error, "format": "image/url", "size": 0, "width": 0, "height": 0,
+                "hash": "", "data_url": ""}
+
+    def _cached(self, url: str):
+        with self.lock:
+            entry = self.cache.get(url)
+            if entry is not None:
+                self.cache.move_to_end(url)
+            return entry
+
+    def _store(self, url: str, expires_at: float, etag: Optional[str], result: Dict) -> None:
+        with self.lock:
+            old = self.cache.pop(url, None)
+            if old is not None:
+                self.cache_bytes -= len(old[2]["data_url"])
+            self.cache[url] = (expires_at, etag, result)
+            self.cache_bytes += len(result["data_url"])
+            while len(self.cache) > 1 and (self.cache_bytes > self.budget_bytes
+                                           or len(self.cache) > self.max_entries):
+                _, (_, _, evicted) = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted["data_url"])
+
+    async def fetch(self, url: str) -> Dict:
+        """
+        下载并校验一张图片（同一URL同时只下载一次）
+
+        Returns:
+            Dict: validate_image_content 的结果，另含 data_url
+        """
+        entry = self._cached(url)
+        if entry is not None and entry[0] > time.time():
+            with self.lock:
+                self.hits += 1
+            return entry[2]
+        inflight = self._inflight.get(url)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._download(url, entry))
+            self._inflight[url] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(inflight)
+
+    def _check_url(self, url: str) -> None:
+        """拒绝非http(s)和直接写IP的内网地址（域名由PublicResolver在连接时检查）"""
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError(f"不支持的URL: {url[:100]}")
+        host = parsed.hostname
+        if self.allow_private:
+            return
+        try:
+            ipaddress.ip_address(host.split("%", 1)[0])
+        except ValueError:
+            return
+        if not is_public_address(host):
+            raise ValueError(f"不允许访问内网地址: {host}")
+
+    async def _get(self, url: str, headers: Dict) -> aiohttp.ClientResponse:
+        """发起GET请求，手动跟随重定向，每一跳都检查目标地址"""
+        for _ in range(self.MAX_REDIRECTS + 1):
+            self._check_url(url)
+            response = await self._session.get(url, headers=headers, allow_redirects=False)
+            if response.status not in (301, 302, 303, 307, 308) or "Location" not in response.headers:
+                return response
+            response.release()
+            url = urljoin(url, response.headers["Location"])
+        raise ValueError("重定向次数过多")
+
+    async def _download(self, url: str, entry) -> Dict:
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300,
+                                               resolver=None if self.allow_private else PublicResolver()))
+        headers = {"If-None-Match": entry[1]} if entry is not None and entry[1] else {}
+        try:
+            async with self._semaphore:
+                async with await self._get(url, headers) as response:
+                    if response.status == 304 and entry is not None:
+                        with self.lock:
+                            self.revalidated += 1
+                        self._store(url, time.time() + self.ttl, entry[1], entry[2])
+                        return entry[2]
+                    if response.status != 200:
+                        raise ValueError(f"HTTP {response.status}")
+                    if (response.content_length or 0) > MAX_IMAGE_BYTES:
+                        raise ValueError(f"图片大小超出限制: {response.content_length / (1024 * 1024):.2f}MB > 20MB")
+                    body = bytearray()
+                    async for chunk in response.content.iter_chunked(1 << 16):
+                        body += chunk
+                        if len(body) > MAX_IMAGE_BYTES:
+                            raise ValueError("图片大小超出限制: 20MB")
+                    etag = response.headers.get("ETag")
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+            result = self._failure(f"图片下载失败: {str(e) or '超时'}")
+            self._store(url, time.time() + min(self.ttl, self.FAILURE_TTL), None, result)
+            return result
+
+        sniffed = sniff_image_size(bytes(body[:IMAGE_SNIFF_BYTES]))
+        if sniffed is None:
+            result = self._failure("图片格式错误: 无法识别的图片数据")
+        else:
+            data_url = f"data:{sniffed[0]};base64," + base64.b64encode(body).decode("ascii")
+            result = {**image_validator.validate(data_url), "data_url": data_url}
+            if not result["valid"] or self.mode != "inline":
+                # 只校验时不需要保留图片内容
+                result["data_url"] = ""
+        with self.lock:
+            self.fetched += 1
+        self._store(url, time.time() + (self.ttl if result["valid"] else min(self.ttl, self.FAILURE_TTL)),
+                    etag, result)
+        return result
+
+    def shutdown(self) -> None:
+        with self.lock:
+            loop, session = self._loop, self._session
+            self._loop, self._session = None, None
+        if loop is None:
+            return
+        if session is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+
+    def stats(self) -> Dict:
+        with self.lock:
             return {
-                "valid": True,
-                "error": "",
-                "format": "image/url",
-                "size": 0
+                "mode": self.mode,
+                "cached": len(self.cache),
+                "cache_bytes": self.cache_bytes,
+                "fetched": self.fetched,
+                "revalidated": self.revalidated,
+                "hits": self.hits,
+                "failures": self.failures
             }
+
+
+image_prefetcher = ImagePrefetcher()
+
+
+IMAGE_OMITTED_TEXT = "[之前的图片已省略]"
+
+
+class ImageHistoryPolicy:
+    """
+    多轮对话中旧图片的处理策略
+
+    每轮请求都会带上历史中的全部图片。这里只保留最近 keep_turns 轮（按用户消息计，
+    本轮始终保留）的完整图片，更早的换成文字：固定提示，或按图片内容哈希缓存的一句描述
+    （会话中的引用、客户端重发的base64图片共用同一份描述，只有普通URL按URL缓存）。
+    替换在引用还原为data URL之前进行，被省略的图片不会从图片存储中读取；
+    会话中保存的消息不变，修改配置后对已有会话同样生效。
+    """
+
+    DESCRIBE_PROMPT = "用一句话简要描述这张图片的主要内容，不超过50字。"
+    MAX_DESCRIPTIONS = 1024
+    FAILURE_RETRY = 600  # 生成失败后多久（秒）才重新尝试
+
+    def __init__(self, keep_turns: int = IMAGE_HISTORY_TURNS, policy: str = IMAGE_HISTORY_POLICY):
+        self.keep_turns = keep_turns
+        self.policy = policy if policy in ("placeholder", "describe") else "placeholder"
+        self.descriptions = OrderedDict()  # 图片内容哈希（普通URL为URL本身） -> 描述
+        self.pending: Set[str] = set()
+        self.failed = OrderedDict()  # 生成失败的key -> 可以重试的时间
+        self.lock = threading.Lock()
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.omitted = 0
+        self.described = 0
+        self.failures = 0
+
+    def apply(self, messages: List[Dict], hashes: Optional[Dict[str, str]] = None) -> int:
+        """
+        在传入的列表上原地替换过旧的图片（只复制被修改的消息）
+
+        Args:
+            messages: 发往上游的消息列表
+            hashes: 已算好的 data URL -> 内容哈希（本轮请求中的图片）
+
+        Returns:
+            int: 省略的图片数
+        """
+        if self.keep_turns < 0:
+            return 0
+        omitted = 0
+        user_turns = 0
+        for i in range(len(messages) - 1, -1, -1):
+            message = messages[i]
+            if not isinstance(message, dict):
+                continue
+            content = message.get("content")
+            if user_turns > self.keep_turns and isinstance(content, list):
+                parts = []
+                changed = False
+                for part in content:
+                    url = ImageStore._image_url(part)
+                    if url:
+                        part = {"type": "text", "text": self._describe(url, hashes)}
+                        changed = True
+                        omitted += 1
+                    parts.append(part)
+                if changed:
+                    messages[i] = {**message, "content": parts}
+            if message.get("role") == "user":
+                user_turns += 1
+        if omitted:
+            with self.lock:
+                self.omitted += omitted
+        return omitted
+
+    def _describe(self, url: str, hashes: Optional[Dict[str, str]] = None) -> str:
+        """返回图片的替换文字，describe策略下没有缓存描述时在后台生成"""
+        if self.policy != "describe":
+            return IMAGE_OMITTED_TEXT
+        if url.startswith(IMAGE_REF_PREFIX):
+            key = url[len(IMAGE_REF_PREFIX):]
+        elif url.startswith("data:"):
+            # 与图片存储的引用使用同一种哈希，重发的图片和会话中的引用共用描述
+            key = (hashes or {}).get(url) or ImageValidator.content_hash(url)
         else:
+            key = url
+        with self.lock:
+            description = self.descriptions.get(key)
+            if description is not None:
+                self.descriptions.move_to_end(key)
+                return f"[之前的图片: {description}]"
+            if key in self.pending or self.failed.get(key, 0) > time.time():
+                return IMAGE_OMITTED_TEXT
+            self.pending.add(key)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                       thread_name_prefix="image-describe")
+        self._executor.submit(self._generate, key, url)
+        return IMAGE_OMITTED_TEXT
+
+    def _generate(self, key: str, url: str) -> None:
+        description = ""
+        try:
+            data_url = image_store.get(key) if url.startswith(IMAGE_REF_PREFIX) else url
+            if data_url is not None:
+                description = self._request_description(data_url)
+        except Exception as e:
+            if debug:
+                print(f"生成图片描述失败: {e}")
+        with self.lock:
+            self.pending.discard(key)
+            if description:
+                self.failed.pop(key, None)
+                self.descriptions[key] = description[:200]
+                self.described += 1
+                if len(self.descriptions) > self.MAX_DESCRIPTIONS:
+                    self.descriptions.popitem(last=False)
+            else:
+                # 失败的结果也缓存，到期前不再为同一张图片请求上游
+                self.failed[key] = time.time() + self.FAILURE_RETRY
+                self.failed.move_to_end(key)
+                self.failures += 1
+                if len(self.failed) > self.MAX_DESCRIPTIONS:
+                    self.failed.popitem(last=False)
+
+    def _request_description(self, data_url: str) -> str:
+        """
+        直接调用上游生成描述
+
+        不经过 chat_completion：这是代理自己发起的请求，不计入模型调用统计，
+        也不刷新模型列表、不重新选择模型。
+        """
+        image_models = filter_image_supported_models(cached_models)
+        if not image_models:
+            return ""
+        model = image_models[0].get("id")
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": [
+                {"type": "text", "text": self.DESCRIBE_PROMPT},
+                {"type": "image_url", "image_url": {"url": data_url, "detail": "low"}}
+            ]}],
+            "stream": True,
+            "project": "DecentralGPT",
+            "enable_thinking": False
+        }
+        aggregator = CompletionAggregator(model)
+        token = token_manager.get_token()
+        with http_session.post(url=f'{base_url}/v1/chat/completion/proxy', headers=build_proxy_headers(token),
+                               json=payload, timeout=UPSTREAM_TIMEOUT, stream=True) as response:
+            if response.status_code in (401, 403):
+                token_manager.invalidate(token)
+            response.raise_for_status()
+            for line in response.iter_lines(chunk_size=8192):
+                if line:
+                    aggregator.feed(line)
+        return "".join(aggregator.content_chunks).strip()
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        with self.lock:
             return {
-                "valid": False,
-                "error": "不支持的图片格式，仅支持Base64编码或HTTP/HTTPS URL",
-                "format": "unknown",
-                "size": 0
+                "keep_turns": self.keep_turns,
+                "policy": self.policy,
+                "omitted": self.omitted,
+                "descriptions": len(self.descriptions),
+                "described": self.described,
+                "failures": self.failures
             }
-            
-    except Exception as e:
-        return {
-            "valid": False,
-            "error": f"图片验证失败: {str(e)}",
-            "format": "unknown",
-            "size": 0
+
+
+image_history_policy = ImageHistoryPolicy()
+
+
+def validate_image_content(image_data: str) -> Dict[str, any]:
+    """
+    验证图片内容格式和大小（结果按内容哈希缓存，两个模块共用）
+
+    Args:
+        image_data: Base64编码的图片数据或URL
+
+    Returns:
+        Dict: {
+            "valid": bool,
+            "error": str,
+            "format": str,
+            "size": int,
+            "width": int,
+            "height": int,
+            "hash": str
         }
+    """
+    return image_validator.validate(image_data)
+
 
+class ImageRef:
+    """请求中一张通过校验的图片"""
 
-def parse_multimodal_content(messages: List[Dict]) -> Dict[str, any]:
+    __slots__ = ("url", "detail", "format", "size", "width", "height", "hash")
+
+    def __init__(self, url: str, detail: str, format: str, size: int, width: int = 0, height: int = 0,
+                 hash: str = ""):
+        self.url = url
+        self.detail = detail
+        self.format = format
+        self.size = size
+        self.width = width
+        self.height = height
+        self.hash = hash
+
+
+class ChatRequest:
     """
-    解析多模态消息内容
-    
+    规范化后的对话请求
+
+    normalize_messages 一次遍历完成消息过滤、内容项校验、图片校验和token计数，
+    模型选择、会话合并和usage统计都直接复用这里的结果，不再重复解析消息。
+    """
+
+    __slots__ = ("messages", "text_messages", "images", "errors", "prompt_tokens", "downscaled", "prefetch",
+                 "requested_model", "model", "model_for_images")
+
+    def __init__(self):
+        # 过滤后的原始消息（保留多模态content）
+        self.messages: List[Dict] = []
+        # 同样的消息转换成纯文本content
+        self.text_messages: List[Dict] = []
+        self.images: List[ImageRef] = []
+        self.errors: List[str] = []
+        # 本轮发往上游的消息的token数（不含回复前缀）
+        self.prompt_tokens = 0
+        # 图片是否已经过缩放处理
+        self.downscaled = False
+        # 图片URL -> 下载任务（concurrent.futures.Future）
+        self.prefetch: Dict[str, concurrent.futures.Future] = {}
+        # select_model 的结果：客户端指定的模型、选定的模型、选择时是否有图片
+        self.requested_model: Optional[str] = None
+        self.model: Optional[str] = None
+        self.model_for_images = False
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    @property
+    def has_images(self) -> bool:
+        return bool(self.images)
+
+    @property
+    def content_type(self) -> str:
+        return "multimodal" if self.images else "text"
+
+    @property
+    def capabilities(self) -> Set[str]:
+        """请求需要模型具备的能力"""
+        return {"text", "image"} if self.images else {"text"}
+
+    def replace_images(self, replaced: Dict[str, Optional["ImageRef"]], placeholder: str = "") -> None:
+        """
+        替换请求中的图片
+
+        Args:
+            replaced: 原图片URL -> 新图片（None表示移除，原位置换成placeholder文字）
+            placeholder: 移除图片时留下的文字
+        """
+        if not replaced:
+            return
+        self.images = [replaced[image.url] if image.url in replaced else image
+                       for image in self.images if replaced.get(image.url, image) is not None]
+        for i, message in enumerate(self.messages):
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            parts = []
+            changed = False
+            for part in content:
+                url = ImageStore._image_url(part)
+                if url in replaced:
+                    changed = True
+                    image = replaced[url]
+                    part = ({**part, "image_url": {**part["image_url"], "url": image.url}} if image is not None
+                            else {"type": "text", "text": placeholder})
+                parts.append(part)
+            if changed:
+                self.messages[i] = {**message, "content": parts}
+
+    @property
+    def upstream_messages(self) -> List[Dict]:
+        """本轮发往上游的消息：有图片时保持原格式，否则使用纯文本"""
+        return self.messages if self.images else self.text_messages
+
+
+def normalize_messages(messages: List[Dict]) -> ChatRequest:
+    """
+    一次遍历规范化消息列表
+
+    丢弃角色不支持、内容为空或格式错误的消息；content数组中的图片只校验一次，
+    校验失败的图片不计入 has_images，错误记录在 errors 中。
+
     Args:
         messages: 消息列表，支持字符串和content数组格式
-        
+
+    Returns:
+        ChatRequest: 规范化结果
+    """
+    request = ChatRequest()
+    errors = request.errors
+
+    for message in messages:
+        if not isinstance(message, dict):
+            errors.append("消息必须是字典类型")
+            continue
+
+        role = message.get("role")
+        content = message.get("content")
+        if role not in ("system", "user", "assistant"):
+            errors.append(f"不支持的消息角色: {role}")
+            continue
+
+        if isinstance(content, str):
+            if not content.strip():
+                continue
+            request.messages.append(message)
+            request.text_messages.append({"role": role, "content": content})
+            continue
+
+        if not isinstance(content, list) or not content:
+            errors.append(f"不支持的content类型: {type(content)}")
+            continue
+
+        # 多模态内容数组
+        text_parts = []
+        has_content = False
+        for item in content:
+            if not isinstance(item, dict):
+                errors.append("内容项必须是字典类型")
+                continue
+
+            item_type = item.get("type")
+            if item_type == "text":
+                text = item.get("text")
+                if not isinstance(text, str):
+                    errors.append("文本内容项必须包含text字段")
+                    continue
+                text_parts.append(text)
+                has_content = has_content or bool(text.strip())
+            elif item_type == "image_url":
+                image_url = item.get("image_url")
+                url = image_url.get("url") if isinstance(image_url, dict) else None
+                if not url or not isinstance(url, str):
+                    errors.append("图片内容项必须包含image_url.url字段")
+                    continue
+                has_content = True
+                validation_result = validate_image_content(url)
+                if validation_result["valid"]:
+                    request.images.append(ImageRef(url, image_url.get("detail", "auto"),
+                                                   validation_result["format"], validation_result["size"],
+                                                   validation_result["width"], validation_result["height"],
+                                                   validation_result["hash"]))
+                else:
+                    errors.append(f"图片验证失败: {validation_result['error']}")
+            else:
+                errors.append(f"不支持的内容类型: {item_type}")
+
+        if not has_content:
+            continue
+        # 将多模态内容转换为文本格式传给后端
+        combined_text = " ".join(text_parts)
+        request.messages.append(message)
+        request.text_messages.append({
+            "role": role,
+            "content": combined_text if combined_text.strip() else "查看图片内容"
+        })
+
+    request.prompt_tokens = prompt_token_counter.count_history(request.upstream_messages)
+    return request
+
+
+def parse_multimodal_content(messages: List[Dict]) -> Dict[str, any]:
+    """
+    解析多模态消息内容（兼容旧接口，基于 normalize_messages）
+
     Returns:
         Dict: {
             "has_images": bool,
@@ -372,89 +3067,15 @@ def parse_multimodal_content(messages: List[Dict]) -> Dict[str, any]:
             "errors": List[str]
         }
     """
-    result = {
-        "has_images": False,
-        "text_content": "",
-        "image_data": [],
-        "processed_messages": [],
-        "errors": []
+    request = normalize_messages(messages)
+    return {
+        "has_images": request.has_images,
+        "text_content": "".join(m["content"] + "\n" for m in request.text_messages),
+        "image_data": [{"url": img.url, "detail": img.detail, "format": img.format, "size": img.size}
+                       for img in request.images],
+        "processed_messages": request.text_messages,
+        "errors": request.errors
     }
-    
-    try:
-        for message in messages:
-            if not isinstance(message, dict):
-                result["errors"].append("消息必须是字典类型")
-                continue
-                
-            role = message.get("role")
-            content = message.get("content")
-            
-            if not role or not content:
-                result["errors"].append("消息必须包含role和content字段")
-                continue
-            
-            # 处理不同的content格式
-            if isinstance(content, str):
-                # 纯文本格式
-                result["text_content"] += content + "\n"
-                result["processed_messages"].append({
-                    "role": role,
-                    "content": content
-                })
-            
-            elif isinstance(content, list):
-                # 多模态内容数组
-                text_parts = []
-                message_content = ""
-                
-                for content_item in content:
-                    if not isinstance(content_item, dict):
-                        result["errors"].append("内容项必须是字典类型")
-                        continue
-                    
-                    content_type = content_item.get("type")
-                    
-                    if content_type == "text":
-                        text = content_item.get("text", "")
-                        text_parts.append(text)
-                        message_content += text
-                        
-                    elif content_type == "image_url":
-                        image_url_data = content_item.get("image_url", {})
-                        image_url = image_url_data.get("url", "")
-                        
-                        if image_url:
-                            # 验证图片
-                            validation_result = validate_image_content(image_url)
-                            if validation_result["valid"]:
-                                result["has_images"] = True
-                                result["image_data"].append({
-                                    "url": image_url,
-                                    "detail": image_url_data.get("detail", "auto"),
-                                    "format": validation_result["format"],
-                                    "size": validation_result["size"]
-                                })
-                            else:
-                                result["errors"].append(f"图片验证失败: {validation_result['error']}")
-                    else:
-                        result["errors"].append(f"不支持的内容类型: {content_type}")
-                
-                # 将多模态内容转换为文本格式传给后端
-                combined_text = " ".join(text_parts)
-                result["text_content"] += combined_text + "\n"
-                result["processed_messages"].append({
-                    "role": role,
-                    "content": combined_text if combined_text.strip() else "查看图片内容"
-                })
-            
-            else:
-                result["errors"].append(f"不支持的content类型: {type(content)}")
-        
-        return result
-        
-    except Exception as e:
-        result["errors"].append(f"解析多模态内容失败: {str(e)}")
-        return result
 
 
 def filter_image_supported_models(models_data: Dict) -> List[Dict]:
@@ -491,6 +3112,7 @@ def filter_image_supported_models(models_data: Dict) -> List[Dict]:
 def get_auto_model(cooldown_seconds: int = 300) -> str:
     """异步获取最优模型"""
     try:
+        sync_shared_state()
         if not MODEL_STATS:
             get_models()
 
@@ -562,21 +3184,58 @@ def _fetch_and_update_models():
         raise Exception("无法获取模型数据")
 
 
+_models_refresh_lock = threading.Lock()
+_models_refreshing = False
+
+
+def _refresh_models():
+    """抓取模型数据；多worker时只由认领到任务的进程抓取，其他进程复用共享结果"""
+    if shared_state is None or shared_state.try_claim("models_fetch", cache_duration) \
+            or not _wait_for_shared_models():
+        _fetch_and_update_models()
+        publish_models()
+
+
+def _background_refresh_models():
+    global _models_refreshing
+    try:
+        _refresh_models()
+    except Exception as e:
+        if debug:
+            print(f"后台刷新模型数据失败，继续使用缓存数据: {e}")
+    finally:
+        with _models_refresh_lock:
+            _models_refreshing = False
+
+
 def get_models():
-    """model data retrieval with thread safety"""
-    global cached_models, last_request_time, base_model, MODEL_STATS
+    """
+    model data retrieval with thread safety
+
+    缓存过期时：已有模型数据则在后台线程中刷新（爬取官网JS最长需要 MODEL_CRAWL_TIMEOUT 秒），
+    本次直接返回旧数据；只有还没有任何模型数据时才等待抓取完成。
+    """
+    global cached_models, last_request_time, base_model, MODEL_STATS, _models_refreshing
+    sync_shared_state()
     current_time = time.time()
     if (current_time - last_request_time) > cache_duration:
-        try:
-            # Update timestamp before awaiting to prevent concurrent updates
-            last_request_time = current_time
-            _fetch_and_update_models()
-        except Exception as e:
-            if debug:
-                print(f"获取模型数据时出错: {e}")
-            # 如果获取模型数据失败，但缓存中有数据，继续使用缓存数据
-            if not cached_models["data"]:
-                raise e
+        # Update timestamp before fetching to prevent concurrent updates
+        last_request_time = current_time
+        if cached_models["data"]:
+            with _models_refresh_lock:
+                start = not _models_refreshing
+                _models_refreshing = True
+            if start:
+                threading.Thread(target=_background_refresh_models, name="models-refresh", daemon=True).start()
+        else:
+            try:
+                _refresh_models()
+            except Exception as e:
+                if debug:
+                    print(f"获取模型数据时出错: {e}")
+                # 如果获取模型数据失败，但缓存中有数据，继续使用缓存数据
+                if not cached_models["data"]:
+                    raise e
 
      # 根据MODEL_STATS判断高成功率的模型并更新base_model
     if MODEL_STATS:
@@ -704,42 +3363,29 @@ def fetch_content(url: str) -> Optional[str]:
         return None
 
 
-def parse_models_from_js(content: str, url: str) -> List[Dict]:
-    """解析JS内容中的模型信息"""
-    try:
-        # 匹配模型数据
-        pattern = r'models\s*:\s*\[([^\]]+)\]'
-        match = re.search(pattern, content)
-
-        if not match:
-            return []
-
-        # 处理JSON数据
-        models_data = match.group(1)
-        models_data = re.sub(r'(\w+):', r'"\1":', models_data)
-        models_data = models_data.replace("'", '"')
-        models_data = f"[{models_data}]"
+def _parse_models_literal(models_data: str, url: str) -> List[Dict]:
+    """把JS中 models:[...] 方括号内的对象字面量转换为模型列表"""
+    # 处理JSON数据
+    models_data = re.sub(r'(\w+):', r'"\1":', models_data)
+    models_data = models_data.replace("'", '"')
+    models_data = f"[{models_data}]"
 
+    try:
+        models = json.loads(models_data)
+        if isinstance(models, list) and models and not (len(models) == 1 and not models[0]):
+            # if debug:
+            #     print(f"解析到模型数据:\n{json.dumps(models, indent=2)}")
+            return models
+    except json.JSONDecodeError:
+        # 尝试修复JSON
+        fixed_data = _fix_json_errors(models_data)
         try:
-            models = json.loads(models_data)
-            if isinstance(models, list) and models and not (len(models) == 1 and not models[0]):
-                # if debug:
-                #     print(f"解析到模型数据:\n{json.dumps(models, indent=2)}")
-                return models
-        except json.JSONDecodeError:
-            # 尝试修复JSON
-            fixed_data = _fix_json_errors(models_data)
-            try:
-                return json.loads(fixed_data)
-            except json.JSONDecodeError as e:
-                if debug:
-                    print(f"JSON解析失败 {url}: {e}")
+            return json.loads(fixed_data)
+        except json.JSONDecodeError as e:
+            if debug:
+                print(f"JSON解析失败 {url}: {e}")
 
-        return []
-    except Exception as e:
-        if debug:
-            print(f"解析模型失败 {url}: {e}")
-        return []
+    return []
 
 
 def _fix_json_errors(json_str: str) -> str:
@@ -758,180 +3404,263 @@ def _fix_json_errors(json_str: str) -> str:
     return json_str
 
 
-#"""version2 """
-def extract_links(content: str, url: str) -> Set[str]:
+# 模型数组开头，字面量前缀可以快速定位
+_BUNDLE_MODELS = re.compile(r'models\s*:\s*\[')
+# 以扩展名+右引号/右括号定位资源路径，再向前找左边界，避免在每个位置尝试匹配整个路径
+_BUNDLE_PATH_END = re.compile(r'\.(?:js|css|html?|json)(?=["\')])')
+_BUNDLE_PATH_CHARS = re.compile(r'[^"\'\s\\<>()]+')
+# 模板变量、函数调用、只有扩展名（如 ".js"）等不是真实路径
+_INVALID_BUNDLE_PATH = re.compile(r'\$\{.*?\}|\{.*?\}|^[.,]+$|^[a-z]+=|^\w+\(|(?:^|/)\.[a-z]+$')
+_NO_LINK_SUFFIXES = ('.json', '.css', '.png', '.jpg', '.jpeg', '.gif', '.svg')
+
+
+def scan_js_bundle(content: str, url: str) -> tuple:
     """
-    提取页面中的所有有效链接，处理特殊情况和无效URL
+    扫描页面或JS bundle，提取模型列表和同域名的资源链接
+
+    替代原来的 parse_models_from_js + extract_links（保留在 benchmarks.py 中对照）：正则全部预先编译，不用HTML解析器，
+    也不再用多个正则对整个bundle反复匹配。先按字面量前缀查找模型数组，找到即返回；
+    否则只扫描一遍，引号中的路径、HTML的 src/href 和css的 url(...) 一并处理。
 
     Args:
         content: 页面内容
-        url: 当前页面URL
+        url: 页面URL
 
     Returns:
-        Set[str]: 提取的有效链接集合
+        (模型列表, 链接集合)：找到模型时链接集合为空
     """
+    for match in _BUNDLE_MODELS.finditer(content):
+        end = content.find("]", match.end())
+        if end <= match.end():
+            continue
+        try:
+            models = _parse_models_literal(content[match.end():end], url)
+        except Exception as e:
+            models = []
+            if debug:
+                print(f"解析模型失败 {url}: {e}")
+        if models:
+            return models, set()
+
+    if url.endswith(_NO_LINK_SUFFIXES):
+        return [], set()
+
+    paths = set()
+    for match in _BUNDLE_PATH_END.finditer(content):
+        end = match.end()
+        closing = content[end]
+        lower = max(0, end - 512)
+        if closing == ")":
+            # 只认css的 url(a.css)；url("a.css") 按引号处理
+            start = content.rfind("(", lower, end)
+            if start < 3 or content[start - 3:start].lower() != "url":
+                continue
+        else:
+            start = content.rfind(closing, lower, end)
+        if start < 0:
+            continue
+        path = content[start + 1:end].strip()
+        if _BUNDLE_PATH_CHARS.fullmatch(path):
+            paths.add(path)
+
     links = set()
     base_domain = urlparse(url).netloc
+    for path in paths:
+        if _INVALID_BUNDLE_PATH.search(path) or path.startswith(("data:", "blob:")):
+            continue
+        if path.startswith("./"):
+            path = path[2:]
+        full_url = urljoin(url, path)
+        if urlparse(full_url).netloc == base_domain:
+            links.add(full_url)
+    return [], links
 
-    def is_valid_path(path: str) -> bool:
-        """
-        验证路径是否有效
-
-        Args:
-            path: 要验证的路径
 
-        Returns:
-            bool: 路径是否有效
-        """
-        # 排除无效路径模式
-        invalid_patterns = [
-            r'\$\{.*?\}',  # 模板字面量
-            r'\{.*?\}',  # 其他变量
-            r'^\(.*?\)',  # 括号开头
-            r'^\).*?',  # 右括号开头
-            r'^[\s\.,]+$',  # 仅包含空白或标点
-            r'^[a-z]+\=',  # 属性赋值
-            r'^\w+\(',  # 函数调用
-        ]
-
-        if not path or path.isspace():
-            return False
+# 可能包含模型列表的入口/页面bundle
+_LIKELY_BUNDLE = re.compile(r'(?:^|[/._-])(?:index|app|main|entry|start|layout|page|chat|model)s?[._-]', re.IGNORECASE)
 
-        return not any(re.search(pattern, path) for pattern in invalid_patterns)
 
-    def clean_path(path: str) -> Optional[str]:
-        """
-        清理和规范化路径
+class ModelCrawler:
+    """
+    并发的模型发现爬虫
 
-        Args:
-            path: 原始路径
+    从首页开始按广度优先下载同域名的页面和JS（最多 concurrency 个同时进行），
+    入口bundle优先；上次找到模型的bundle排在最前面。任一页面解析出模型后立即取消其他下载，
+    只采用第一个结果。JS的解析在线程中进行，不占用爬虫的事件循环。
+    带ETag/Last-Modified的页面会记住解析结果，下次带条件请求，返回304时直接复用，
+    未变化的bundle不重新下载、不重新解析。
+    """
 
-        Returns:
-            Optional[str]: 清理后的路径，无效则返回None
+    MAX_VALIDATORS = 512
+
+    def __init__(self, concurrency: int = MODEL_CRAWL_CONCURRENCY, max_pages: int = MODEL_CRAWL_MAX_PAGES,
+                 timeout: float = MODEL_CRAWL_TIMEOUT, page_timeout: float = 10):
+        self.concurrency = concurrency
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.page_timeout = page_timeout
+        self.validators = OrderedDict()  # URL -> (ETag, Last-Modified, 模型, 链接)
+        self.model_url: Optional[str] = None
+        self.lock = threading.Lock()
+        self.crawls = 0
+        self.fetched = 0
+        self.not_modified = 0
+        self.last_pages = 0
+        self.last_seconds = 0.0
+
+    def _priority(self, url: str, depth: int) -> int:
+        """数字越小越先下载：按深度广度优先，同层内JS bundle优先，样式和数据文件最后"""
+        path = urlparse(url).path
+        priority = depth * 10
+        if url == self.model_url:
+            return -100
+        if path.endswith(".js"):
+            priority -= 5
+            if _LIKELY_BUNDLE.search(path.rsplit("/", 1)[-1]):
+                priority -= 3
+        elif path.endswith((".css", ".json")):
+            priority += 20
+        return priority
+
+    def crawl(self, start_url: str) -> List[Dict]:
         """
-        if not path:
-            return None
+        同步入口，等待整个爬取完成（最长 timeout 秒）
 
-        # 基础清理
-        path = path.strip()
-        path = re.sub(r'\s+', '', path)
-        path = re.sub(r'[\(\)]', '', path)
-        path = re.sub(r',.*$', '', path)
-
-        # 处理相对路径
-        if path.startswith('./'):
-            path = path[2:]
-        elif path.startswith('/'):
-            path = path[1:]
-
-        # 验证文件扩展名
-        valid_extensions = ('.js', '.css', '.html', '.htm', '.json')
-        if not any(path.endswith(ext) for ext in valid_extensions):
+        get_models 已有模型数据时在后台线程中刷新，只有首次加载时请求需要等待；
+        在事件循环中请换用 acrawl。
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.acrawl(start_url))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.acrawl(start_url)).result()
+
+    async def acrawl(self, start_url: str) -> List[Dict]:
+        """爬取并返回找到的模型列表（没有找到时为空列表）"""
+        started = time.monotonic()
+        queue = asyncio.PriorityQueue()
+        counter = iter(range(1 << 62))
+        seen = {start_url}
+        found: List[Dict] = []
+        done = asyncio.Event()
+        pages = 0
+
+        queue.put_nowait((self._priority(start_url, 0), next(counter), start_url, 0))
+        model_url = self.model_url
+        if model_url and model_url != start_url and urlparse(model_url).netloc == urlparse(start_url).netloc:
+            seen.add(model_url)
+            queue.put_nowait((self._priority(model_url, 0), next(counter), model_url, 0))
+
+        async def worker(session: aiohttp.ClientSession):
+            nonlocal pages
+            while True:
+                _, _, url, depth = await queue.get()
+                try:
+                    if done.is_set() or pages >= self.max_pages:
+                        continue
+                    pages += 1
+                    if debug:
+                        print(f"正在分析: {url}")
+                    result = await self._fetch(session, url)
+                    if result is None:
+                        continue
+                    models, links = result
+                    if done.is_set():
+                        # 解析期间其他页面已经找到了模型
+                        continue
+                    if models:
+                        found.extend(models)
+                        self.model_url = url
+                        done.set()
+                        continue
+                    for link in links:
+                        if link not in seen:
+                            seen.add(link)
+                            queue.put_nowait((self._priority(link, depth + 1), next(counter), link, depth + 1))
+                finally:
+                    queue.task_done()
+
+        async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.page_timeout),
+                headers={"User-Agent": "Mozilla/5.0"},
+                connector=aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)) as session:
+            workers = [asyncio.ensure_future(worker(session)) for _ in range(self.concurrency)]
+            waiters = [asyncio.ensure_future(queue.join()), asyncio.ensure_future(done.wait())]
+            try:
+                await asyncio.wait(waiters, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                # 找到模型、爬完或超时后取消仍在进行的下载
+                for task in workers + waiters:
+                    task.cancel()
+                await asyncio.gather(*workers, *waiters, return_exceptions=True)
+
+        with self.lock:
+            self.crawls += 1
+            self.last_pages = pages
+            self.last_seconds = round(time.monotonic() - started, 3)
+        if debug:
+            print(f"模型爬取完成: {pages} 个页面, {self.last_seconds}s, 模型 {len(found)} 个")
+        return found
+
+    async def _fetch(self, session: aiohttp.ClientSession, url: str) -> Optional[tuple]:
+        """下载并解析一个页面，返回 (模型, 链接)；失败时返回None"""
+        with self.lock:
+            cached = self.validators.get(url)
+        headers = {}
+        if cached is not None:
+            if cached[0]:
+                headers["If-None-Match"] = cached[0]
+            if cached[1]:
+                headers["If-Modified-Since"] = cached[1]
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    with self.lock:
+                        self.not_modified += 1
+                        self.validators.move_to_end(url)
+                    return cached[2], cached[3]
+                if response.status != 200:
+                    raise ValueError(f"HTTP {response.status}")
+                content = await response.text(errors="replace")
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if debug:
+                print(f"获取页面失败 {url}: {e}")
             return None
 
-        return path
-
-    try:
-        if not content or url.endswith(('.json', '.css', '.png', '.jpg', '.jpeg', '.gif', '.svg')):
-            return links
-
-        # 处理HTML内容
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # 提取href链接
-        for tag in soup.find_all(href=True):
-            href = tag['href']
-            if is_valid_path(href):
-                cleaned_href = clean_path(href)
-                if cleaned_href:
-                    full_url = urljoin(url, cleaned_href)
-                    if urlparse(full_url).netloc == base_domain:
-                        links.add(full_url)
-                        if debug:
-                            print(f"添加有效链接: {full_url}")
-
-        # 处理script标签
-        for tag in soup.find_all('script', src=True):
-            src = tag['src']
-            if is_valid_path(src):
-                cleaned_src = clean_path(src)
-                if cleaned_src:
-                    full_url = urljoin(url, cleaned_src)
-                    if urlparse(full_url).netloc == base_domain:
-                        links.add(full_url)
-
-        # 处理JS文件内容
-        if url.endswith('.js'):
-            # 处理各种导入模式
-            import_patterns = [
-                (r'import\s*[^"\']*["\']([^"\']+)["\']', 1),
-                (r'from\s+["\']([^"\']+)["\']', 1),
-                (r'import\s*\(["\']([^"\']+)["\']\)', 1),
-                (r'require\s*\(["\']([^"\']+)["\']\)', 1),
-                (r'(?:url|src|href)\s*:\s*["\']([^"\']+)["\']', 1),
-                (r'@import\s+["\']([^"\']+)["\']', 1),
-                (r'url\(["\']?([^"\'()]+)["\']?\)', 1),
-            ]
-
-            for pattern, group in import_patterns:
-                for match in re.finditer(pattern, content):
-                    path = match.group(group)
-                    if is_valid_path(path):
-                        cleaned_path = clean_path(path)
-                        if cleaned_path:
-                            full_url = urljoin(url, cleaned_path)
-                            if urlparse(full_url).netloc == base_domain:
-                                links.add(full_url)
-
-            # 处理数组形式的导入
-            for array_match in re.finditer(r'\[([\s\S]*?)\]', content):
-                array_content = array_match.group(1)
-                paths = re.findall(r'["\']([^"\']+?\.[a-zA-Z0-9]+)["\']', array_content)
-                for path in paths:
-                    if is_valid_path(path):
-                        cleaned_path = clean_path(path)
-                        if cleaned_path and not cleaned_path.startswith(('http:', 'https:', 'data:', 'blob:')):
-                            full_url = urljoin(url, cleaned_path)
-                            if urlparse(full_url).netloc == base_domain:
-                                links.add(full_url)
+        # bundle可能有几MB，解析放到线程中，其他页面的下载继续进行
+        models, links = await asyncio.to_thread(scan_js_bundle, content, url)
+        with self.lock:
+            self.fetched += 1
+            if etag or last_modified:
+                self.validators[url] = (etag, last_modified, models, links)
+                self.validators.move_to_end(url)
+                if len(self.validators) > self.MAX_VALIDATORS:
+                    self.validators.popitem(last=False)
+        return models, links
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "crawls": self.crawls,
+                "fetched": self.fetched,
+                "not_modified": self.not_modified,
+                "last_pages": self.last_pages,
+                "last_seconds": self.last_seconds,
+                "model_url": self.model_url
+            }
 
-    except Exception as e:
-        if debug:
-            print(f"提取链接失败 {url}: {e}")
 
-    return links
+model_crawler = ModelCrawler()
 
 
 def analyze(_bb_url="https://www.degpt.ai/") -> List[Dict]:
-    """分析网站内容"""
-    visited_urls = set()
-    found_models = []
-
-    def _analyze(url: str) -> bool:
-        if url in visited_urls:
-            return False
-
-        visited_urls.add(url)
-        if debug:
-            print(f"正在分析: {url}")
-
-        content = fetch_content(url)
-        if not content:
-            return False
-
-        models = parse_models_from_js(content, url)
-        if models:
-            found_models.extend(models)
-            return True
-
-        for link in extract_links(content, url):
-            if _analyze(link):
-                return True
-
-        return False
-
-    _analyze(_bb_url)
-    return found_models
+    """分析网站内容，返回JS中的模型列表"""
+    return model_crawler.crawl(_bb_url)
 
 
 ################
@@ -953,6 +3682,7 @@ def is_model_available(model_id: str, cooldown_seconds: int = 300) -> bool:
     """
     global MODEL_STATS
 
+    sync_shared_state()
     # 如果MODEL_STATS为空，加载模型数据
     if not MODEL_STATS:
         get_models()
@@ -1050,127 +3780,171 @@ def chat_completion_messages(
         project="DecentralGPT",
         temperature=0.3, max_tokens=1024, top_p=0.5,
         frequency_penalty=0, presence_penalty=0):
-    # 输入验证
-    if not messages or not isinstance(messages, list):
-        raise ValueError("messages 参数必须是一个非空列表")
+    model, headers_proxy, data_proxy, turn_messages, prompt_tokens = prepare_chat_request(
+        messages, model=model, session_id=session_id, project=project)
+    return chat_completion(model=model, headers=headers_proxy, payload=data_proxy, stream=stream,
+                           session_id=session_id, turn_messages=turn_messages, prompt_tokens=prompt_tokens)
 
-    # 解析多模态内容
-    multimodal_result = parse_multimodal_content(messages)
-    
-    # # 检查错误
-    # if multimodal_result["errors"]:
-    #     error_msg = "; ".join(multimodal_result["errors"])
-    #     raise ValueError(f"消息格式错误: {error_msg}")
-    
-    # 检查是否包含图片
-    has_images = multimodal_result["has_images"]
-    processed_messages = multimodal_result["processed_messages"]
-    
-    if debug:
-        print(f"多模态解析结果: has_images={has_images}, 图片数量={len(multimodal_result['image_data'])}")
-        if has_images:
-            for img in multimodal_result["image_data"]:
-                print(f"图片信息: 格式={img['format']}, 大小={img['size']} bytes")
 
-    # 针对图片请求，筛选支持图片的模型
+async def achat_completion_messages(
+        messages,
+        model: str = None,
+        session_id: str = None,
+        project="DecentralGPT") -> "AsyncStreamingResponseWithSession":
+    """
+    chat_completion_messages 的异步流式版本
+
+    Returns:
+        AsyncStreamingResponseWithSession: 上游SSE的完整行，按网络读取成批返回（已建立连接并校验状态码），
+        关闭时把本轮对话写入会话
+    """
+    if not isinstance(messages, ChatRequest) and messages and isinstance(messages, list):
+        messages = normalize_messages(messages)
+    if isinstance(messages, ChatRequest):
+        # 图片下载和缩放都在其他线程/进程中进行，等待时不阻塞事件循环
+        await image_prefetcher.await_request(messages)
+        await image_downscaler.atransform(messages)
+    # 登录、会话存储和图片存储的读写都是阻塞调用，在线程中执行
+    model, headers_proxy, data_proxy, turn_messages, prompt_tokens = await asyncio.to_thread(
+        prepare_chat_request, messages, model=model, session_id=session_id, project=project)
+    lines = await achat_completion(model=model, headers=headers_proxy, payload=data_proxy, session_id=session_id)
+    return AsyncStreamingResponseWithSession(lines, session_id, model, turn_messages, prompt_tokens)
+
+
+def select_model(request: "ChatRequest", model: Optional[str] = None) -> str:
+    """
+    按请求内容选择模型，结果记录在请求上，之后的各个阶段直接复用
+
+    - 纯文本：指定的模型可用时使用，否则（或auto）选成功率最高的模型
+    - 有图片：只在支持图片的模型中选择；指定的模型（按id或名称匹配）支持图片时使用，否则用第一个图片模型
+
+    Args:
+        request: 规范化后的请求
+        model: 客户端指定的模型；再次选择时使用第一次记录的值
+
+    Returns:
+        str: 模型id
+
+    Raises:
+        ValueError: 有图片但没有支持图片的模型
+    """
+    if request.model is None:
+        request.requested_model = model
+    model = request.requested_model
+    has_images = request.has_images
     if has_images:
-        # 获取当前模型列表
         try:
-            models_json = json.loads(get_models())
-            image_models = filter_image_supported_models(models_json)
-            
-            if not image_models:
-                raise ValueError("当前无可用的图片支持模型，请使用纯文本请求")
-            
-            # 如果指定了model且该模型不支持图片，则选择支持图片的模型
-            if model and model != "auto":
-                model_supports_image = any(m.get("id") == model and 
-                                         (m.get("support") == "image" or "image" in str(m.get("support", "")).lower())
-                                         for m in image_models)
-                if not model_supports_image:
-                    # 选择第一个可用的图片模型
-                    selected_model = image_models[0].get("id")
-                    if debug:
-                        print(f"原模型 {model} 不支持图片，切换为 {selected_model}")
-                    model = selected_model
-            
+            image_models = filter_image_supported_models(json.loads(get_models()))
         except Exception as e:
             if debug:
                 print(f"获取图片模型列表失败: {e}")
-            # 降级处理：如果无法获取图片模型，但有图片内容，则报错
             raise ValueError(f"无法获取图片支持模型列表: {e}")
+        if not image_models:
+            raise ValueError("当前无可用的图片支持模型，请使用纯文本请求")
+        matched = None
+        if model and model != "auto":
+            matched = next((m for m in image_models if model in (m.get("id"), m.get("name"))), None)
+            if matched is None and debug:
+                print(f"原模型 {model} 不支持图片，切换为 {image_models[0].get('id')}")
+        model = (matched or image_models[0]).get("id")
 
-    # 确保model有效
     if not model or model == "auto":
         model = get_auto_model()
     else:
         model = get_model_by_autoupdate(model)
+    request.model = model
+    request.model_for_images = has_images
+    return model
+
+
+def prepare_chat_request(
+        messages,
+        model: str = None,
+        session_id: str = None,
+        project="DecentralGPT"):
+    """
+    构建发往DeGPT的请求
+
+    Returns:
+        Tuple: (校准后的model, 请求头, 请求体, 本轮需要写入会话的消息, prompt token数)
+    """
+    # 已规范化的请求直接复用，否则在这里解析一次
+    if isinstance(messages, ChatRequest):
+        request = messages
+    else:
+        if not messages or not isinstance(messages, list):
+            raise ValueError("messages 参数必须是一个非空列表")
+        request = normalize_messages(messages)
+    if not request.messages:
+        raise ValueError("没有有效的消息可以处理")
+
+    # 等待图片URL下载完成（异步入口已经处理过时直接返回），无法访问的图片不再转发
+    image_prefetcher.wait(request)
+    has_images = request.has_images
+    if has_images:
+        # 按detail缩小图片（异步入口已经处理过时直接返回）
+        image_downscaler.transform(request)
+
     if debug:
-        print(f"校准后的model: {model}")
+        print(f"多模态解析结果: has_images={has_images}, 图片数量={len(request.images)}")
+        for img in request.images:
+            print(f"图片信息: 格式={img.format}, 大小={img.size} bytes, 尺寸={img.width}x{img.height}")
 
-    # 处理会话上下文
-    if session_id:
-        session_messages = get_session(session_id)
-        # 合并历史消息和当前消息（使用处理后的消息）
-        combined_messages = session_messages + processed_messages
-        if debug:
-            print(f"会话 {session_id} 的历史消息: {len(session_messages)} 条")
-            print(f"合并后的消息: {len(combined_messages)} 条")
+    # 入口已经选好模型时直接使用；图片下载失败被移除后按纯文本请求重新选择
+    if request.model is None or request.model_for_images != has_images:
+        model = select_model(request, model)
     else:
-        combined_messages = processed_messages
+        model = request.model
+    if debug:
+        print(f"校准后的model: {model}")
 
-    # 获取token
-    url = f'{base_url}/v1/auths/printSignIn'
+    # 处理会话上下文（每轮只读取一次存储；内存存储返回的历史不复制，也不能修改）
+    session_messages = get_session(session_id) if session_id else []
+    if debug and session_id:
+        print(f"会话 {session_id} 的历史消息: {len(session_messages)} 条")
 
-    headers = {
-        "user-agent": os.getenv("DEGPT_USER_AGENT", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36")
-    }
+    # 获取token（缓存复用，过期前后台刷新）
+    token = token_manager.get_token()
 
-    data = {
-        "id": auth_id,
-        "channel": ""
-    }
-    res_page = requests.post(url=url, headers=headers, json=data, verify=False, timeout=5)
-    res_page.encoding="utf-8"
-    token = json.loads(res_page.text)["token"]
-    if debug:
-        print(f"res_page: {res_page}\r\nres_page.text: {res_page.text}\r\ntoken:{token}")
-
-    headers_proxy = {
-        "Host": os.getenv("DEGPT_PROXY_HOST", "www.degpt.ai"),
-        "Connection": "keep-alive",
-        "Content-Length": os.getenv("DEGPT_PROXY_CONTENT_LENGTH", "1673"),
-        "Pragma": "no-cache",
-        "Cache-Control": "no-cache",
-        "sec-ch-ua-platform": os.getenv("DEGPT_PROXY_SEC_CH_UA_PLATFORM", "\"Windows\""),
-        "Authorization": f"Bearer {token}",
-        "User-Agent": os.getenv("DEGPT_PROXY_USER_AGENT", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36"),
-        "sec-ch-ua": os.getenv("DEGPT_PROXY_SEC_CH_UA", "\"Google Chrome\";v=\"137\", \"Chromium\";v=\"137\", \"Not/A)Brand\";v=\"24\""),
-        "Content-Type": "application/json",
-        "sec-ch-ua-mobile": os.getenv("DEGPT_PROXY_SEC_CH_UA_MOBILE", "?0"),
-        "Accept": "*/*",
-        "Origin": os.getenv("DEGPT_PROXY_ORIGIN", "https://www.degpt.ai"),
-        "Sec-Fetch-Site": "same-origin",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Dest": "empty",
-        "Referer": os.getenv("DEGPT_PROXY_REFERER", "https://www.degpt.ai/c/e850c81f-19ab-4ac1-92ec-ee02c21095c7"),
-        "Accept-Encoding": "gzip, deflate, br, zstd",
-        "Accept-Language": os.getenv("DEGPT_PROXY_ACCEPT_LANGUAGE", "zh-CN,zh;q=0.9"),
-        "Cookie": auth_cookie
-    }
+    headers_proxy = build_proxy_headers(token)
     
-    # 构建请求数据：如果有图片，使用原始消息格式；否则使用处理后的消息
-    if has_images:
-        # 使用原始消息格式保持多模态内容
-        if session_id:
-            session_messages = get_session(session_id)
-            # 对于图片请求，也需要合并历史消息，但保持原格式
-            api_messages = session_messages + messages
-        else:
-            api_messages = messages
+    # 如果有图片，使用原始消息格式；否则使用处理后的纯文本消息
+    turn_source = request.upstream_messages
+    history_count = len(session_messages)
+    turn_tokens = request.prompt_tokens
+    # 客户端重发了会话中已有的历史时只保留新消息，避免历史重复转发、重复保存
+    resent = resent_history_count(session_messages, turn_source) if session_messages else 0
+    if resent:
+        turn_source = drop_resent_messages(turn_source, resent)
+        turn_tokens = prompt_token_counter.count_history(turn_source)
+        if debug:
+            print(f"会话 {session_id}: 客户端重发了 {resent} 条历史消息，已跳过")
+
+    # 上游请求体需要完整的消息列表，这是每轮唯一一次按顺序展开历史；
+    # SQLite/Redis 返回的是本次新解码的列表，直接追加
+    if isinstance(session_messages, MessageHistory):
+        api_messages = session_messages.to_list()
     else:
-        # 纯文本请求使用处理后的消息
-        api_messages = combined_messages
+        api_messages = session_messages
+    api_messages.extend(turn_source)
+    # 先省略过旧的图片（包括客户端自己重发的历史），再把剩下的图片引用还原为data URL
+    if image_history_policy.apply(api_messages, {image.url: image.hash for image in request.images}):
+        # 本轮消息中被省略的图片（客户端重发的旧图片）不再按图片计数
+        for old, new in zip(turn_source, api_messages[history_count:]):
+            if new is not old:
+                turn_tokens += prompt_token_counter.count_message(new) - prompt_token_counter.count_message(old)
+    image_store.materialize(api_messages)
+
+    # 历史消息命中缓存，不重复分词；本轮消息的token数在规范化时已算好
+    prompt_tokens = (prompt_token_counter.count_history(api_messages[:history_count]) + turn_tokens
+                     + prompt_token_counter.REPLY_PRIMING_TOKENS)
+    if debug and session_id:
+        print(f"合并后的消息: {len(api_messages)} 条")
+
+    # 系统提示由客户端每轮重发，不写入会话；base64图片只在会话中保存引用
+    turn_messages = [m for m in turn_source if m.get("role") != "system"] if session_id else []
+    if turn_messages and has_images:
+        turn_messages = image_store.to_refs(turn_messages, request.images)
     
     # 后端服务只支持流式调用
     data_proxy = {
@@ -1181,9 +3955,112 @@ def chat_completion_messages(
         "enable_thinking": True
     }
     if debug:
-        print(json.dumps(headers, indent=4))
+        print(json.dumps(headers_proxy, indent=4))
         print(json.dumps(data_proxy, indent=4))
-    return chat_completion(model=model, headers=headers_proxy, payload=data_proxy, stream=stream, session_id=session_id)
+    return model, headers_proxy, data_proxy, turn_messages, prompt_tokens
+
+
+class CompletionAggregator:
+    """
+    把上游SSE流聚合成非流式的 chat.completion 响应
+
+    每个数据帧到达时只解析一次，内容和思考过程分别放在片段列表里，
+    流结束后拼接一次即可得到完整响应（包含 reasoning_content 和 finish_reason）。
+    """
+
+    def __init__(self, model: Optional[str] = None, prompt_tokens: int = 0):
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.id = None
+        self.created = None
+        self.object_type = None
+        self.system_fingerprint = None
+        self.content_chunks: List[str] = []
+        self.reasoning_chunks: List[str] = []
+        self.finish_reason = None
+        self.usage = None
+
+    def feed(self, line: Union[str, bytes]) -> None:
+        """处理一行SSE数据"""
+        if not line.startswith(b"data:" if isinstance(line, bytes) else "data:"):
+            return
+        data_str = line[5:].strip()
+        if not data_str or data_str in ("[DONE]", b"[DONE]"):
+            return
+        try:
+            data = json.loads(data_str)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return
+        if not isinstance(data, dict):
+            return
+
+        # 提取第一个data行的元信息
+        if self.created is None:
+            self.id = data.get("id")
+            self.created = data.get("created")
+            self.object_type = data.get("object")
+            self.model = data.get("model") or self.model
+            self.system_fingerprint = data.get("system_fingerprint")
+        if isinstance(data.get("usage"), dict):
+            self.usage = data["usage"]
+
+        choices = data.get("choices")
+        if not isinstance(choices, list):
+            return
+        for choice in choices:
+            if not isinstance(choice, dict):
+                continue
+            delta = choice.get("delta")
+            if isinstance(delta, dict):
+                content = delta.get("content")
+                if isinstance(content, str) and content:
+                    self.content_chunks.append(content)
+                reasoning = delta.get("reasoning_content")
+                if isinstance(reasoning, str) and reasoning:
+                    self.reasoning_chunks.append(reasoning)
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+
+    def result(self) -> Dict:
+        """组装标准响应数据"""
+        content = "".join(self.content_chunks)
+        reasoning = "".join(self.reasoning_chunks)
+        message = {
+            "role": "assistant",
+            "content": content
+        }
+        if reasoning:
+            message["reasoning_content"] = reasoning
+
+        usage = self.usage
+        if usage is None:
+            # 计算token数量（思考过程也计入completion_tokens）
+            content_tokens = tokenizer.count(content, "completion")
+            reasoning_tokens = tokenizer.count(reasoning, "completion")
+            completion_tokens = content_tokens + reasoning_tokens
+            usage = {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": self.prompt_tokens + completion_tokens
+            }
+            if reasoning_tokens:
+                usage["completion_tokens_details"] = {"reasoning_tokens": reasoning_tokens}
+
+        return {
+            "id": self.id or f"chatcmpl-{datetime.now().timestamp()}",
+            # 聚合后是完整响应，不再沿用上游的 chat.completion.chunk
+            "object": "chat.completion",
+            "created": self.created or int(datetime.now().timestamp()),
+            "model": self.model or "gpt-4o",
+            "system_fingerprint": self.system_fingerprint,
+            "usage": usage,
+            "choices": [{
+                "message": message,
+                "logprobs": None,
+                "finish_reason": self.finish_reason or "stop",
+                "index": 0
+            }]
+        }
 
 
 def parse_response(response_text):
@@ -1192,69 +4069,13 @@ def parse_response(response_text):
     包含多层结构校验，确保安全访问嵌套字段
     返回标准API响应格式
     """
-    lines = response_text.split('\n')
-    result = ""
-    created = None
-    object_type = None
-
-    for line in lines:
-        if line.startswith("data:"):
-            data_str = line[len("data:"):].strip()
-            if not data_str or data_str == "[DONE]":
-                continue
-            try:
-                data = json.loads(data_str)
-                # 提取第一个data行的元信息
-                if isinstance(data, dict) and not created:
-                    created = data.get("created")
-                    object_type = data.get("object")
-
-                # 安全访问嵌套字段，确保是字典类型
-                if isinstance(data, dict):
-                    # 检查是否存在choices字段且为列表
-                    if "choices" in data and isinstance(data["choices"], list):
-                        for choice in data["choices"]:
-                            # 检查每个choice是否为字典且包含delta字段
-                            if isinstance(choice, dict) and "delta" in choice:
-                                delta = choice["delta"]
-                                # 确保delta是字典且包含content字段
-                                if isinstance(delta, dict) and "content" in delta:
-                                    content = delta["content"]
-                                    # 确保content是字符串类型
-                                    if isinstance(content, str):
-                                        result += content
-            except json.JSONDecodeError:
-                continue
-    import tiktoken
-
-    # 计算token数量
-    enc = tiktoken.get_encoding("cl100k_base")
-    completion_tokens = len(enc.encode(result))
-
-    # 组装标准响应数据
-    response_data = {
-        "id": f"chatcmpl-{datetime.now().timestamp()}",
-        "object": object_type or "chat.completion",
-        "created": created or int(datetime.now().timestamp()),
-        "model": "gpt-4o",  # 可根据需求调整来源
-        "usage": {
-            "prompt_tokens": 0,  # 需要根据实际prompt内容计算
-            "completion_tokens": completion_tokens,
-            "total_tokens": completion_tokens
-        },
-        "choices": [{
-            "message": {
-                "role": "assistant",
-                "content": result
-            },
-            "finish_reason": "stop",
-            "index": 0
-        }]
-    }
+    aggregator = CompletionAggregator()
+    for line in response_text.split('\n'):
+        aggregator.feed(line)
+    return aggregator.result()
 
-    return response_data
 
-def chat_completion(model, headers, payload, stream=True, session_id=None):
+def chat_completion(model, headers, payload, stream=True, session_id=None, turn_messages=None, prompt_tokens=0):
     """处理用户请求并保留上下文"""
     try:
         url = f'{base_url}/v1/chat/completion/proxy'
@@ -1262,11 +4083,14 @@ def chat_completion(model, headers, payload, stream=True, session_id=None):
             print(f"url: {url}")
 
         # 始终以流式方式调用后端
-        response = requests.post(url=url, headers=headers, json=payload, verify=False, timeout=100, stream=True)
+        response = http_session.post(url=url, headers=headers, json=payload, timeout=UPSTREAM_TIMEOUT, stream=True)
         response.encoding = 'utf-8'
 
         # 检查响应状态码
         if response.status_code != 200:
+            if response.status_code in (401, 403):
+                # 令牌被拒绝，下次请求重新登录
+                token_manager.invalidate(headers.get("Authorization", "").replace("Bearer ", "", 1) or None)
             record_call(model, False)
             error_msg = f"API 请求失败，状态码: {response.status_code}"
             if response.text:
@@ -1278,26 +4102,27 @@ def chat_completion(model, headers, payload, stream=True, session_id=None):
 
         # 根据stream参数决定返回方式
         if stream:
-            # 对于流式响应，直接返回response对象
-            # 会话上下文的保存将在more_core.py中处理
-            return response
+            # 对于流式响应，返回包装对象
+            # 转发时由more_core.py记录回答内容，关闭时保存会话
+            return StreamingResponseWithSession(response, session_id, model, turn_messages, prompt_tokens)
         else:
-            # 收集所有流数据并解析
-            full_response = ""
-            for chunk in response.iter_lines():
-                if chunk:
-                    decoded_chunk = chunk.decode('utf-8')
-                    if decoded_chunk.startswith("data:"):
-                        full_response += decoded_chunk + "\n"
+            # 边读边聚合，每帧只解析一次
+            aggregator = CompletionAggregator(model, prompt_tokens)
+            try:
+                for chunk in response.iter_lines(chunk_size=8192):
+                    if chunk:
+                        aggregator.feed(chunk)
+            finally:
+                response.close()
 
             if debug:
                 print("Full response collected")
 
-            result = parse_response(full_response)
+            result = aggregator.result()
 
             # 保存助手响应到会话
             if session_id and isinstance(result, dict):
-                save_assistant_response(session_id, result)
+                save_assistant_response(session_id, result, turn_messages)
 
             return result
     except requests.exceptions.Timeout:
@@ -1317,80 +4142,241 @@ def chat_completion(model, headers, payload, stream=True, session_id=None):
         raise Exception(f"未知错误: {e}")
 
 
-def save_assistant_response(session_id: str, response_data: Dict) -> None:
-    """保存助手响应到会话"""
-    global SESSION_STORAGE
+async def achat_completion(model, headers, payload, session_id=None) -> AsyncIterator[List[bytes]]:
+    """
+    通过 aiohttp 连接池调用后端
 
-    if SESSION_STORAGE_TYPE == "memory":
-        if session_id in SESSION_STORAGE:
-            # 提取助手消息
-            if "choices" in response_data and response_data["choices"]:
-                choice = response_data["choices"][0]
-                if "message" in choice:
-                    assistant_message = choice["message"]
-                    SESSION_STORAGE[session_id]["messages"].append(assistant_message)
-                    if debug:
-                        print(f"保存助手响应到会话 {session_id}")
+    建立连接并检查状态码后返回按批读取完整行的异步迭代器，
+    状态码错误等异常在返回前抛出，便于调用方返回正确的错误响应。
+    """
+    url = f'{base_url}/v1/chat/completion/proxy'
+    if debug:
+        print(f"url: {url}")
+
+    try:
+        response = await upstream_transport.post(url, headers=headers, payload=payload)
+    except asyncio.TimeoutError:
+        record_call(model, False)
+        raise requests.exceptions.RequestException("请求超时，请稍后重试")
+    except aiohttp.ClientError as e:
+        record_call(model, False)
+        raise requests.exceptions.RequestException(f"网络连接错误，请检查网络设置: {e}")
+
+    if response.status != 200:
+        try:
+            text = await response.text()
+        except Exception:
+            text = ""
+        finally:
+            response.release()
+        if response.status in (401, 403):
+            # 令牌被拒绝，下次请求重新登录
+            token_manager.invalidate(headers.get("Authorization", "").replace("Bearer ", "", 1) or None)
+        record_call(model, False)
+        error_msg = f"API 请求失败，状态码: {response.status}"
+        if text:
+            error_msg += f"，响应内容: {text}"
+        raise requests.exceptions.RequestException(error_msg)
 
+    record_call(model, True)
+    return _aiter_response_batches(response)
 
-class StreamingResponseWithSession:
-    """包装流式响应以支持会话上下文保存"""
 
-    def __init__(self, response, session_id, model):
-        self.response = response
+class SSELineBuffer:
+    """
+    按行切分上游字节流
+
+    每次网络读取的数据切出其中完整的非空行，行尾的换行保留，转发时不用再拼接；
+    不完整的半行留在 bytearray 中等下一块数据。数据块恰好以整行结束时不经过缓冲区。
+    """
+
+    __slots__ = ("buffer",)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """追加一块数据，返回其中完整的行"""
+        buffer = self.buffer
+        if not buffer and data.endswith(b"\n"):
+            block = data
+        else:
+            buffer += data
+            end = buffer.rfind(b"\n") + 1
+            if not end:
+                return []
+            with memoryview(buffer) as view:
+                block = view[:end].tobytes()
+            del buffer[:end]
+        return [line for line in block.splitlines(keepends=True) if not line.isspace()]
+
+    def flush(self) -> List[bytes]:
+        """流结束时返回最后一行（上游没有以换行结尾时）"""
+        rest = bytes(self.buffer).strip()
+        self.buffer.clear()
+        return [rest + b"\n"] if rest else []
+
+
+async def _aiter_response_batches(response: aiohttp.ClientResponse) -> AsyncIterator[List[bytes]]:
+    """按网络读取批量返回aiohttp响应中的完整行，结束或中断时把连接还给连接池"""
+    lines = SSELineBuffer()
+    try:
+        async for data in response.content.iter_any():
+            batch = lines.feed(data)
+            if batch:
+                yield batch
+        batch = lines.flush()
+        if batch:
+            yield batch
+    finally:
+        response.release()
+
+
+def save_assistant_response(session_id: str, response_data: Dict, turn_messages: Optional[List[Dict]] = None) -> None:
+    """保存助手响应（以及本轮用户消息）到会话"""
+    # 提取助手消息
+    if "choices" in response_data and response_data["choices"]:
+        choice = response_data["choices"][0]
+        if "message" in choice:
+            # 思考过程不写入会话，上游不接受历史消息中的 reasoning_content
+            message = {"role": choice["message"].get("role", "assistant"),
+                       "content": choice["message"].get("content", "")}
+            if save_turn(session_id, turn_messages, message) and debug:
+                print(f"保存助手响应到会话 {session_id}")
+
+
+class StreamSessionRecorder:
+    """
+    记录流式回答：写入会话并统计用量
+
+    转发方在已解析（或快速扫描）的数据块中取出 delta.content 调用 record，不需要再次解析JSON；
+    内容片段先放在列表里，保存时只拼接一次。正常结束和客户端断开都会调用 save，
+    重复调用只保存一次。回答和思考过程的token在转发过程中分批计数。
+    """
+
+    def __init__(self, session_id, model, turn_messages: Optional[List[Dict]] = None, prompt_tokens: int = 0):
         self.session_id = session_id
         self.model = model
-        self.accumulated_content = ""
+        self.turn_messages = turn_messages
+        self.prompt_tokens = prompt_tokens
+        self.content_chunks: List[str] = []
+        self.saved = False
+        # 用量统计
+        self.include_usage = False  # 客户端请求了 stream_options.include_usage
+        self.usage_sent = False
+        self.upstream_usage = None
+        self.stream_meta = None  # 第一个数据帧的 id/created/model，用于最后的usage数据块
+        self.completion_counter = IncrementalTokenCounter()
+        self.reasoning_counter = IncrementalTokenCounter()
+
+    def record(self, content: str) -> None:
+        """记录一段回答内容"""
+        if content:
+            self.content_chunks.append(content)
+            self.completion_counter.add(content)
+
+    def record_reasoning(self, reasoning: str) -> None:
+        """记录一段思考过程（只计数，不写入会话）"""
+        self.reasoning_counter.add(reasoning)
+
+    def usage(self) -> Dict:
+        """本次回答的用量；上游自带usage时以上游为准"""
+        if self.upstream_usage:
+            return self.upstream_usage
+        reasoning_tokens = self.reasoning_counter.flush()
+        completion_tokens = self.completion_counter.flush() + reasoning_tokens
+        usage = {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": self.prompt_tokens + completion_tokens
+        }
+        if reasoning_tokens:
+            usage["completion_tokens_details"] = {"reasoning_tokens": reasoning_tokens}
+        return usage
 
-    def __iter__(self):
-        return self
+    @property
+    def accumulated_content(self) -> str:
+        return "".join(self.content_chunks)
 
-    def __next__(self):
-        # 这个方法不会被直接调用，但我们实现它以保持兼容性
-        raise StopIteration
+    def save(self) -> bool:
+        """保存本轮对话（用户消息 + 已收到的回答），返回是否保存成功"""
+        if self.saved or not self.content_chunks:
+            return False
+        self.saved = True
+        assistant_message = {
+            "role": "assistant",
+            "content": self.accumulated_content
+        }
+        saved = save_turn(self.session_id, self.turn_messages, assistant_message)
+        if saved and debug:
+            print(f"流式响应保存到会话 {self.session_id}")
+        return saved
 
-    def __aiter__(self):
-        return self
 
-    async def __anext__(self):
-        # 这个方法也不会被直接调用，但我们实现它以保持兼容性
-        raise StopAsyncIteration
+class StreamingResponseWithSession(StreamSessionRecorder):
+    """包装流式响应（requests）以支持会话上下文保存"""
+
+    def __init__(self, response, session_id, model, turn_messages: Optional[List[Dict]] = None,
+                 prompt_tokens: int = 0):
+        super().__init__(session_id, model, turn_messages, prompt_tokens)
+        self.response = response
+
+    def __getattr__(self, name):
+        # 其余属性（status_code、text等）直接使用原始响应
+        if name == "response":
+            raise AttributeError(name)
+        return getattr(self.response, name)
+
+    def iter_batches(self) -> Iterator[List[bytes]]:
+        """按网络读取批量返回完整的行（保留行尾换行）"""
+        # chunked响应按上游的分块到达即返回；否则与 requests.iter_lines 相同按512字节读取
+        chunk_size = None if getattr(self.response.raw, "chunked", False) else 512
+        lines = SSELineBuffer()
+        for data in self.response.iter_content(chunk_size=chunk_size):
+            batch = lines.feed(data)
+            if batch:
+                yield batch
+        batch = lines.flush()
+        if batch:
+            yield batch
 
     def iter_lines(self):
-        for chunk in self.response.iter_lines():
-            if chunk:
-                decoded_chunk = chunk.decode('utf-8')
-                if decoded_chunk.startswith("data:"):
-                    # 累积内容用于会话保存
-                    data_str = decoded_chunk[len("data:"):].strip()
-                    if data_str and data_str != "[DONE]":
-                        try:
-                            data = json.loads(data_str)
-                            if isinstance(data, dict) and "choices" in data:
-                                for choice in data["choices"]:
-                                    if "delta" in choice and "content" in choice["delta"]:
-                                        self.accumulated_content += choice["delta"]["content"]
-                        except json.JSONDecodeError:
-                            pass
-                yield chunk
+        for batch in self.iter_batches():
+            for line in batch:
+                yield line.rstrip(b"\r\n")
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
         # 会话结束时保存助手响应
-        if self.accumulated_content:
-            assistant_message = {
-                "role": "assistant",
-                "content": self.accumulated_content
-            }
-            global SESSION_STORAGE
-            if SESSION_STORAGE_TYPE == "memory":
-                if self.session_id in SESSION_STORAGE:
-                    SESSION_STORAGE[self.session_id]["messages"].append(assistant_message)
-                    if debug:
-                        print(f"流式响应保存到会话 {self.session_id}")
-        self.response.close()
+        try:
+            self.save()
+        finally:
+            self.response.close()
+
+
+class AsyncStreamingResponseWithSession(StreamSessionRecorder):
+    """包装上游的异步迭代器（aiohttp）以支持会话上下文保存，每次返回一批完整的行（保留行尾换行）"""
+
+    def __init__(self, lines: AsyncIterator[List[bytes]], session_id, model,
+                 turn_messages: Optional[List[Dict]] = None, prompt_tokens: int = 0):
+        super().__init__(session_id, model, turn_messages, prompt_tokens)
+        self.lines = lines
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> List[bytes]:
+        return await self.lines.__anext__()
+
+    async def aclose(self) -> None:
+        """释放上游连接并保存会话；会话写入放到线程池，事件循环不等待存储IO"""
+        try:
+            await self.lines.aclose()
+        finally:
+            if self.content_chunks and not self.saved:
+                asyncio.get_running_loop().run_in_executor(None, self.save)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,3 @@
-import base64
 import json
 import multiprocessing
 import os
@@ -6,9 +5,8 @@ import random
 import re
 import string
 import time
-from typing import Dict, Any, List, Union, Optional, Tuple
+from typing import Dict, Any, List, Union, Optional
 
-import tiktoken
 import uvicorn
 from apscheduler.schedulers.background import BackgroundScheduler
 from fastapi import FastAPI, Request, HTTPException
@@ -18,13 +16,42 @@ from starlette.responses import HTMLResponse
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 import asyncio
+import concurrent.futures
 import sys
+import sqlite3
+import threading
 
 import degpt as dg
 
 # debug for Log
 debug = os.getenv("DEBUG", "False").lower() in ("true", "1", "t")
 
+# 同步上游流的读取线程与事件循环之间的队列长度（背压）
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+# 非流式请求线程池大小
+CHAT_EXECUTOR_WORKERS = int(os.getenv("CHAT_EXECUTOR_WORKERS", "32"))
+
+# SSE快速路径：只在原始字节里查找需要改写的键，其余数据块原样转发
+_FINISH_REASON_NULL = re.compile(rb'"finish_reason"\s*:\s*null')
+_CONTENT_KEY = re.compile(rb'"content"\s*:')
+_CONTENT_STRING = re.compile(rb'"content"\s*:\s*"')
+_REASONING_STRING = re.compile(rb'"reasoning_content"\s*:\s*"')
+
+
+def _scan_delta_content(data: bytes, pattern: re.Pattern = _CONTENT_STRING) -> Optional[str]:
+    """不解析整个JSON，只解码并取出 "content"（或pattern指定的键）字符串的值
+
+    JSON字符串内部的引号都被转义，因此原始数据中的 "content": 只可能是键。
+    """
+    match = pattern.search(data)
+    if match is None:
+        return None
+    try:
+        return json.decoder.scanstring(data[match.end():].decode('utf-8'), 0)[0]
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
 app = FastAPI(
     title="ones",
     description="High-performance API service",
@@ -32,151 +59,105 @@ app = FastAPI(
 )
 
 
+class ChatExecutor:
+    """非流式请求专用线程池，记录排队深度与等待时间"""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="chat-worker")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, func, *args):
+        """在线程池中执行func，等待期间不占用事件循环"""
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def task():
+            wait = time.monotonic() - submitted_at
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(task)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # 客户端断开：还在排队的任务直接取消
+            future.cancel()
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self.completed + self.active
+            return {
+                "max_workers": self.max_workers,
+                "queue_depth": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "avg_wait_ms": round(self.total_wait / started * 1000, 2) if started else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 2)
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
 class APIServer:
     """High-performance API server implementation"""
 
     def __init__(self, app: FastAPI):
         self.app = app
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.chat_executor = ChatExecutor(CHAT_EXECUTOR_WORKERS)
         self._setup_routes()
+        self._setup_lifecycle()
         self._setup_scheduler()
     
-    def validate_image_url(self, url: str) -> None:
-        """验证图片URL和格式"""
-        if not url:
-            raise ValueError("图片URL不能为空")
-        
-        # Base64格式验证
-        if url.startswith("data:image/"):
-            try:
-                # 提取MIME类型和数据
-                if ',' not in url:
-                    raise ValueError("Base64图片格式无效")
-                header, data = url.split(',', 1)
-                mime_type = header.split(';')[0].split(':')[1]
-                
-                # 验证支持的图片格式
-                if mime_type not in ["image/jpeg", "image/png", "image/gif", "image/webp"]:
-                    raise ValueError(f"不支持的图片格式: {mime_type}")
-                
-                # 验证文件大小（Base64解码后）
-                try:
-                    decoded_data = base64.b64decode(data)
-                    if len(decoded_data) > 20 * 1024 * 1024:  # 20MB
-                        raise ValueError("图片大小超出限制: 20MB")
-                except Exception as e:
-                    raise ValueError(f"Base64解码失败: {str(e)}")
-            except Exception as e:
-                raise ValueError(f"Base64图片验证失败: {str(e)}")
-        
-        # HTTP/HTTPS URL格式验证
-        elif url.startswith(("http://", "https://")):
-            # URL格式基本验证
-            url_pattern = re.compile(
-                r'^https?://'  # http:// 或 https://
-                r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'  # 域名
-                r'[A-Z]{2,6}\.?|'  # 顶级域名
-                r'localhost|'  # localhost
-                r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # IP地址
-                r'(?::\d+)?'  # 可选端口
-                r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-            
-            if not url_pattern.match(url):
-                raise ValueError("无效的图片URL格式")
-        else:
-            raise ValueError("不支持的图片URL格式，请使用Base64或HTTP/HTTPS URL")
-    
-    def validate_multimodal_content(self, content: Union[str, List[Dict[str, Any]]]) -> Tuple[bool, str, str]:
-        """验证多模态内容格式
-        
-        返回:
-            (验证通过, 内容类型, 合并的文本内容)
+    def _setup_lifecycle(self) -> None:
+        """Warm up per-process resources on startup and release them on shutdown
+
+        预热放在启动事件中：多worker时主进程只管理worker、不运行应用，不会加载分词器或拉起进程池。
         """
-        # 支持字符串格式（向后兼容）
-        if isinstance(content, str):
-            return True, "text", content
-        
-        # 支持数组格式（多模态）
-        if isinstance(content, list):
-            has_image = False
-            text_parts = []
-            
-            for item in content:
-                if not isinstance(item, dict) or "type" not in item:
-                    raise ValueError("内容项必须是包含type字段的字典")
-                
-                item_type = item.get("type")
-                if item_type == "text":
-                    if "text" not in item:
-                        raise ValueError("文本内容项必须包含text字段")
-                    text_parts.append(item.get("text", ""))
-                elif item_type == "image_url":
-                    has_image = True
-                    if "image_url" not in item or "url" not in item["image_url"]:
-                        raise ValueError("图片内容项必须包含image_url.url字段")
-                    # 验证图片URL格式和大小
-                    try:
-                        self.validate_image_url(item["image_url"]["url"])
-                    except ValueError as e:
-                        raise ValueError(f"图片验证失败: {str(e)}")
-                else:
-                    raise ValueError(f"不支持的内容类型: {item_type}")
-            
-            content_type = "multimodal" if has_image else "text"
-            combined_text = "\n".join(text_parts)
-            
-            return True, content_type, combined_text
-        
-        raise ValueError("content必须是字符串或内容数组")
-    
-    def select_model_for_content(self, model_name: str, content_type: str) -> str:
-        """基于内容类型智能选择模型"""
-        # 如果是纯文本，使用原有逻辑
-        if content_type == "text":
-            if model_name == "auto":
-                return dg.get_auto_model()
-            return dg.get_model_by_autoupdate(model_name)
-        
-        # 如果包含图片，需要检查模型是否支持图片
-        if content_type == "multimodal":
-            # 获取可用模型列表
-            try:
-                models_str = dg.get_models()
-                models_data = json.loads(models_str)
-                available_models = models_data.get("data", [])
-                
-                # 筛选支持图片的模型
-                image_models = [
-                    model for model in available_models 
-                    if model.get("support") == "image"
-                ]
-                
-                if not image_models:
-                    raise ValueError("当前无可用的图片支持模型，请使用纯文本请求")
-                
-                # 如果指定的模型支持图片，使用指定模型
-                if model_name != "auto":
-                    for model in image_models:
-                        if model.get("name") == model_name or model.get("id") == model_name:
-                            return dg.get_model_by_autoupdate(model_name)
-                
-                # 否则自动选择第一个可用的图片模型
-                best_model = image_models[0]
-                model_id = best_model.get("name") or best_model.get("id")
-                return dg.get_model_by_autoupdate(model_id)
-                
-            except Exception as e:
-                if debug:
-                    print(f"模型选择错误: {e}")
-                # 降级处理：如果无法获取模型列表，使用原有逻辑
-                if model_name == "auto":
-                    return dg.get_auto_model()
-                return dg.get_model_by_autoupdate(model_name)
-        
-        # 默认情况
-        if model_name == "auto":
-            return dg.get_auto_model()
-        return dg.get_model_by_autoupdate(model_name)
+        async def warm_up():
+            # 共享分词器在后台加载，启动不等待
+            dg.tokenizer.preload()
+            dg.image_downscaler.preload()
+            # 清理上次运行留下的图片文件
+            await asyncio.to_thread(dg.image_store.prepare)
+
+        async def close_upstream_transport():
+            await dg.upstream_transport.close()
+            self.chat_executor.shutdown()
+            dg.image_downscaler.shutdown()
+            dg.image_prefetcher.shutdown()
+            dg.image_history_policy.shutdown()
+            if dg.shared_state is not None:
+                # 写入还在批次中的模型调用统计
+                try:
+                    await asyncio.to_thread(dg.shared_state.flush)
+                except sqlite3.Error as e:
+                    if debug:
+                        print(f"写入共享模型统计失败: {e}")
+
+        self.app.router.on_startup.append(warm_up)
+        self.app.router.on_shutdown.append(close_upstream_transport)
 
     def _setup_scheduler(self):
         """ Schedule tasks to check and reload routes and models at regular intervals. """
@@ -186,6 +167,9 @@ class APIServer:
 
         # Scheduled Task 2: Reload models every 30 minutes (1800 seconds). This task will check and update the model data periodically
         self.scheduler.add_job(self._reload_check, 'interval', seconds=60 * 30)
+
+        # Scheduled Task 3: Expire idle sessions in the background instead of on the request path
+        self.scheduler.add_job(dg.cleanup_sessions, 'interval', seconds=dg.SESSION_CLEANUP_INTERVAL)
         self.scheduler.start()
 
     def _setup_routes(self) -> None:
@@ -198,8 +182,20 @@ class APIServer:
             return HTMLResponse(content="<h1>hello. It's home page.</h1>")
 
         @self.app.get("/health", name="health")
-        def health():
-            return JSONResponse(content={"status": "working"})
+        async def health():
+            return JSONResponse(content={
+                "status": "working",
+                "chat_executor": self.chat_executor.stats(),
+                "tokenizer": dg.tokenizer.stats(),
+                "prompt_token_cache": dg.prompt_token_counter.stats(),
+                "image_cache": dg.image_validator.stats(),
+                "image_store": dg.image_store.stats(),
+                "image_downscale": dg.image_downscaler.stats(),
+                "image_prefetch": dg.image_prefetcher.stats(),
+                "image_history": dg.image_history_policy.stats(),
+                "model_crawler": dg.model_crawler.stats(),
+                "sessions": dg.session_stats()
+            })
 
         @self.app.get("/api/v1/models", name="models")
         @self.app.get("/v1/models", name="models")
@@ -228,6 +224,27 @@ class APIServer:
             except Exception as e:
                 raise HTTPException(status_code=500, detail=str(e))
 
+        @self.app.post("/api/v1/session/fork", name="fork_session")
+        async def fork_session(request: Request):
+            """从会话的第at条消息处分叉出新会话，分支之间共享前缀"""
+            data = await request.json()
+            session_id = data.get("session_id")
+            if not session_id:
+                raise HTTPException(status_code=400, detail="session_id is required")
+            new_session_id = data.get("new_session_id") or self._generate_session_id()
+            at = data.get("at")
+            if at is not None and (not isinstance(at, int) or at < 0):
+                raise HTTPException(status_code=400, detail="at must be a non-negative integer")
+            try:
+                count = dg.fork_session(session_id, new_session_id, at)
+            except KeyError:
+                raise HTTPException(status_code=404, detail=f"会话不存在: {session_id}")
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e))
+            return JSONResponse(content={"status": "success", "session_id": new_session_id, "messages": count})
+
         async def claude_messages_handler(request: Request):
             """Claude协议消息处理器（简化的Claude协议消息端点，实现最大兼容性）"""
             try:
@@ -249,14 +266,19 @@ class APIServer:
 
                 # 转换Claude格式到OpenAI格式（包含容错处理）
                 openai_data = self._convert_claude_to_openai(data, headers)
+                if stream:
+                    # 由OpenAI流最后的usage数据块得到 message_delta.usage
+                    openai_data["stream_options"] = {"include_usage": True}
 
                 # 使用现有的OpenAI处理逻辑（包含消息过滤）
-                response = self._generate_response_optimized(headers, openai_data)
+                response = await self._generate_response_optimized(headers, openai_data)
 
                 if stream and isinstance(response, StreamingResponse):
                     # 流式响应 - 转换为Claude格式的SSE流
+                    # message_start 先给出本次消息的prompt估计（会话历史在结束时的usage中体现）
+                    input_tokens = dg.prompt_token_counter.count_messages(openai_data.get("messages") or [])
                     return StreamingResponse(
-                        self._stream_claude_response(response),
+                        self._stream_claude_response(response, input_tokens),
                         media_type="text/event-stream"
                     )
                 else:
@@ -351,7 +373,7 @@ class APIServer:
                 data = await request.json()
                 if debug:
                     print(f"Request received...\r\n\tHeaders: {headers},\r\n\tData: {data}")
-                return self._generate_response_optimized(headers, data)
+                return await self._generate_response_optimized(headers, data)
             except Exception as e:
                 if debug:
                     print(f"Request processing error: {e}")
@@ -361,7 +383,7 @@ class APIServer:
 
     def _calculate_tokens(self, text: str) -> int:
         """Calculate token count for text"""
-        return len(self.encoding.encode(text))
+        return dg.tokenizer.count(text, "completion")
 
     def _generate_id(self, letters: int = 4, numbers: int = 6) -> str:
         """Generate unique chat completion ID"""
@@ -711,302 +733,409 @@ class APIServer:
             result['model'] = model  # 根据需要设置model值
         return result
 
-    def _generate_response_optimized(self, headers: Dict[str, str], data: Dict[str, Any]) -> Union[Dict[str, Any], StreamingResponse]:
-        """Generate API response with enhanced error handling"""
+    async def _generate_response_optimized(self, headers: Dict[str, str], data: Dict[str, Any]) -> Union[Dict[str, Any], StreamingResponse]:
+        """Generate API response with enhanced error handling
+
+        非流式请求（登录、模型选择、读取完整上游响应）整体在专用线程池中执行，
+        事件循环只等待结果，长回答不会卡住 /health 和其他流式请求。
+        """
         global debug
         if debug:
             print("inside _generate_response")
-        try:
-            # check model
-            model_name = data.get("model")
-            
-            # 验证消息格式并检测内容类型
-            msgs = data.get("messages")
-            if not msgs:
-                raise HTTPException(status_code=400, detail="消息不能为空")
-            
-            if not isinstance(msgs, list):
-                raise HTTPException(status_code=400, detail="消息必须是一个列表")
-            
-            # 检测是否包含多模态内容
-            has_multimodal_content = False
-            
-            # 精简消息过滤：移除无效消息
-            valid_msgs = []
-            for message in msgs:
-                if not isinstance(message, dict):
-                    continue
-                
-                # 必需字段检查
-                if "role" not in message or "content" not in message:
-                    continue
-                
-                if message["role"] not in ["system", "user", "assistant"]:
-                    continue
-                
-                # 简化内容检查
-                content = message["content"]
-                if isinstance(content, str):
-                    if content.strip():
-                        valid_msgs.append(message)
-                elif isinstance(content, list) and content:
-                    # 检查列表内容是否有效
-                    if any(isinstance(item, dict) and 
-                          ((item.get("type") == "text" and item.get("text", "").strip()) or
-                           (item.get("type") == "image_url" and item.get("image_url", {}).get("url")))
-                          for item in content):
-                        valid_msgs.append(message)
-                
-                # 使用新的多模态验证函数
-                try:
-                    is_valid, content_type, combined_text = self.validate_multimodal_content(content)
-                    if content_type == "multimodal":
-                        has_multimodal_content = True
-                except ValueError as e:
-                    continue  # 跳过格式错误的消息
-            
-            # 检查是否还有有效的消息
-            if not valid_msgs:
-                raise HTTPException(status_code=400, detail="没有有效的消息可以处理")
-            
-            msgs = valid_msgs
-            
-            # 基于内容类型选择模型
-            content_type = "multimodal" if has_multimodal_content else "text"
-            
-            # 对于所有请求，如果模型不存在则使用auto校准
-            if model_name and model_name != "auto" and not dg.is_model_available(model_name):
-                model_name = "auto"
-            
-            # 使用智能模型选择
-            try:
-                model_name = self.select_model_for_content(model_name or "auto", content_type)
-            except ValueError as e:
-                raise HTTPException(status_code=400, detail=str(e))
-
-            model = model_name  # 设置最终的model变量
-            # must has token ? token check
-            authorization = headers.get('Authorization')
-            token = os.getenv("TOKEN", "")
-            if token and authorization and token not in authorization:
-                raise HTTPException(status_code=401, detail="无效的Token")
-
-            # call ai
-            if not msgs:
-                raise HTTPException(status_code=400, detail="消息不能为空")
-
-            # 获取会话ID - 支持session_id和user_id参数
-            session_id = data.get("session_id")
-            user_id = data.get("user_id")
-
-            # 如果没有提供session_id，但提供了user_id，则使用user_id作为session_id
-            if not session_id and user_id:
-                session_id = f"user_{user_id}"
+        if not data.get("stream", False):
+            return await self.chat_executor.run(self._generate_response_sync, headers, data)
 
-            # 如果都没有提供，生成一个临时的session_id用于单次对话
-            if not session_id:
-                session_id = self._generate_session_id()
+        request = {}
+        try:
+            # 模型列表刷新、会话读取等都是阻塞调用，放到线程中执行，不占用事件循环。
+            # 不使用 chat_executor：它的线程会被非流式请求长时间占用，这里只需要短暂执行
+            request = await asyncio.to_thread(self._prepare_chat_request, headers, data)
+
+            # 流式响应处理
+            if dg.ASYNC_TRANSPORT:
+                # aiohttp连接池，返回逐行的异步迭代器
+                response = await dg.achat_completion_messages(
+                    messages=request["messages"],
+                    model=request["model"] or "gpt-4o-mini",
+                    session_id=request["session_id"]
+                )
+            else:
+                # requests同步POST以及等待图片下载都会阻塞，在线程中建立连接；之后由读取线程转发
+                response = await asyncio.to_thread(
+                    dg.chat_completion_messages,
+                    messages=request["messages"],
+                    model=request["model"] or "gpt-4o-mini",
+                    session_id=request["session_id"],
+                    stream=True
+                )
 
-            # 检查是否需要流式响应
-            stream = data.get("stream", False)
+            # 直接返回流式响应，逐行转发给客户端
+            return StreamingResponse(
+                self._stream_response(response, request["include_usage"]),
+                media_type="text/event-stream"
+            )
+        except HTTPException:
+            # 重新抛出HTTPException
+            raise
+        except Exception as e:
+            self._record_failure(request)
+            if debug:
+                print(f"Response generation error: {e}")
+            # 提供更详细的错误信息
+            error_detail = f"内部服务器错误: {str(e)}"
 
+            # 如果是流式响应，我们需要返回一个流式的错误响应
+            async def error_stream():
+                error_message = f'{{"error": "{error_detail}"}}'
+                yield f"data: {error_message}\n\n"
+            return StreamingResponse(error_stream(), media_type="text/event-stream")
+
+    def _generate_response_sync(self, headers: Dict[str, str], data: Dict[str, Any]) -> Dict[str, Any]:
+        """非流式请求处理（在 chat_executor 线程中运行）"""
+        request = {}
+        try:
+            request = self._prepare_chat_request(headers, data)
+            model_name = request["model"]
+
+            # 非流式响应处理
+            result = dg.chat_completion_messages(
+                messages=request["messages"],
+                model=model_name or "gpt-4o-mini",
+                session_id=request["session_id"],
+                stream=False
+            )
             if debug:
-                print(f"request model: {model_name}")
-                if token:
-                    print(f"request token: {token}")
-                print(f"request messages: {msgs}")
-                print(f"session_id: {session_id}")
-                print(f"user_id: {user_id}")
-                print(f"stream: {stream}")
-
-            if stream:
-                # 流式响应处理
-                response = dg.chat_completion_messages(
-                    messages=msgs,
-                    model=model_name or "gpt-4o-mini",
-                    session_id=session_id,
-                    stream=True
-                )
+                print(f"result: {result}---- {self.is_chatgpt_format(result)}")
 
-                # 直接返回流式响应，逐行转发给客户端
-                return StreamingResponse(
-                    self._stream_response(response),
-                    media_type="text/event-stream"
-                )
+            # Ensure result is properly formatted as a dictionary
+            if isinstance(result, dict) and self.is_chatgpt_format(result):
+                # If data already follows ChatGPT format, use it directly
+                response_data = self.process_result(result, model_name)
             else:
-                # 非流式响应处理
-                result = dg.chat_completion_messages(
-                    messages=msgs,
-                    model=model_name or "gpt-4o-mini",
-                    session_id=session_id,
-                    stream=False
-                )
-                if debug:
-                    print(f"result: {result}---- {self.is_chatgpt_format(result)}")
-
-                # Ensure result is properly formatted as a dictionary
-                if isinstance(result, dict) and self.is_chatgpt_format(result):
-                    # If data already follows ChatGPT format, use it directly
-                    response_data = self.process_result(result, model_name)
-                else:
-                    # Calculate the current timestamp
-                    current_timestamp = int(time.time() * 1000)
-                    # Otherwise, calculate the tokens and return a structured response
-                    result_content = str(result) if not isinstance(result, dict) else result.get("content", str(result))
-                    prompt_tokens = self._calculate_tokens(str(data))
-                    completion_tokens = self._calculate_tokens(result_content)
-                    total_tokens = prompt_tokens + completion_tokens
-
-                    response_data = {
-                        "id": self._generate_id(),
-                        "object": "chat.completion",
-                        "created": current_timestamp,
-                        "model": data.get("model", "gpt-4o"),
-                        "choices": [{
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": result_content
-                            },
-                            "logprobs": None,
-                            "finish_reason": "stop"
-                        }],
-                        "usage": {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": total_tokens
+                # Calculate the current timestamp
+                current_timestamp = int(time.time() * 1000)
+                # Otherwise, calculate the tokens and return a structured response
+                result_content = str(result) if not isinstance(result, dict) else result.get("content", str(result))
+                prompt_tokens = request["messages"].prompt_tokens + dg.prompt_token_counter.REPLY_PRIMING_TOKENS
+                completion_tokens = self._calculate_tokens(result_content)
+                total_tokens = prompt_tokens + completion_tokens
+
+                response_data = {
+                    "id": self._generate_id(),
+                    "object": "chat.completion",
+                    "created": current_timestamp,
+                    "model": data.get("model", "gpt-4o"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": result_content
                         },
-                        "system_fingerprint": None
-                    }
+                        "logprobs": None,
+                        "finish_reason": "stop"
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": total_tokens
+                    },
+                    "system_fingerprint": None
+                }
 
-                # Print the response for debugging (you may remove this in production)
-                if debug:
-                    print(f"Response Data: {response_data}")
+            # Print the response for debugging (you may remove this in production)
+            if debug:
+                print(f"Response Data: {response_data}")
 
-                # Ensure we always return a dictionary for non-streaming responses
-                if isinstance(response_data, dict):
-                    return response_data
-                else:
-                    # Fallback: return error response
-                    return {
-                        "error": "Invalid response format",
-                        "message": str(response_data)[:200]
-                    }
+            # Ensure we always return a dictionary for non-streaming responses
+            if isinstance(response_data, dict):
+                return response_data
+            else:
+                # Fallback: return error response
+                return {
+                    "error": "Invalid response format",
+                    "message": str(response_data)[:200]
+                }
         except HTTPException:
             # 重新抛出HTTPException
             raise
         except Exception as e:
-            # 安全地记录模型调用失败
-            try:
-                if 'model' in locals():
-                    dg.record_call(model, False)
-            except:
-                pass  # 忽略记录错误
-
+            self._record_failure(request)
             if debug:
                 print(f"Response generation error: {e}")
             # 提供更详细的错误信息
             error_detail = f"内部服务器错误: {str(e)}"
-            # 如果是流式响应，我们需要返回一个流式的错误响应
-            if data.get("stream", False):
-                async def error_stream():
-                    error_message = f'{{"error": "{error_detail}"}}'
-                    yield f"data: {error_message}\n\n"
-                return StreamingResponse(error_stream(), media_type="text/event-stream")
-            else:
-                raise HTTPException(status_code=500, detail=error_detail) from e
+            raise HTTPException(status_code=500, detail=error_detail) from e
+
+    def _record_failure(self, request: Dict[str, Any]) -> None:
+        """安全地记录模型调用失败"""
+        try:
+            if request.get("model"):
+                dg.record_call(request["model"], False)
+        except Exception:
+            pass  # 忽略记录错误
+
+    def _prepare_chat_request(self, headers: Dict[str, str], data: Dict[str, Any]) -> Dict[str, Any]:
+        """校验消息、选择模型、检查Token并确定会话ID
+
+        Returns:
+            {"messages": 规范化后的 dg.ChatRequest, "model": 选择的模型, "session_id": 会话ID, "stream": 是否流式,
+             "include_usage": 流式结束时是否返回usage数据块}
+        """
+        # check model
+        model_name = data.get("model")
+
+        # 验证消息格式并检测内容类型
+        msgs = data.get("messages")
+        if not msgs:
+            raise HTTPException(status_code=400, detail="消息不能为空")
+
+        if not isinstance(msgs, list):
+            raise HTTPException(status_code=400, detail="消息必须是一个列表")
+
+        # 一次遍历完成过滤、多模态校验和token计数，结果一直传到上游请求构建
+        chat_request = dg.normalize_messages(msgs)
+        if not chat_request.messages:
+            raise HTTPException(status_code=400, detail="没有有效的消息可以处理")
+        # 图片URL在后台下载，与下面的模型选择、会话和token处理同时进行
+        dg.image_prefetcher.start(chat_request)
+        if debug and chat_request.errors:
+            print(f"忽略的无效内容: {chat_request.errors}")
+
+        # 按内容选择模型（不可用的模型换成auto），结果记录在请求上，prepare_chat_request 不再重复选择
+        try:
+            model_name = dg.select_model(chat_request, model_name or "auto")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # must has token ? token check
+        authorization = headers.get('Authorization')
+        token = os.getenv("TOKEN", "")
+        if token and authorization and token not in authorization:
+            raise HTTPException(status_code=401, detail="无效的Token")
+
+        # 获取会话ID - 支持session_id和user_id参数
+        session_id = data.get("session_id")
+        user_id = data.get("user_id")
+
+        # 如果没有提供session_id，但提供了user_id，则使用user_id作为session_id
+        if not session_id and user_id:
+            session_id = f"user_{user_id}"
+
+        # 都没有提供时是单次对话：session_id 为 None，不读取也不保存会话，
+        # 避免一次性请求（包括其中的base64图片）占用会话内存预算、影响命中率统计
+
+        # 检查是否需要流式响应
+        stream = data.get("stream", False)
+
+        if debug:
+            print(f"request model: {model_name}")
+            if token:
+                print(f"request token: {token}")
+            print(f"request messages: {chat_request.messages}")
+            print(f"session_id: {session_id}")
+            print(f"user_id: {user_id}")
+            print(f"stream: {stream}")
+
+        stream_options = data.get("stream_options")
+        include_usage = bool(stream and isinstance(stream_options, dict) and stream_options.get("include_usage"))
+
+        return {
+            "messages": chat_request,
+            "model": model_name,
+            "session_id": session_id,
+            "stream": stream,
+            "include_usage": include_usage
+        }
+
+    async def _stream_response(self, response, include_usage: bool = False):
+        """流式传输响应数据，确保每行正确格式化以便 SSE
+
+        全程处理字节：上游按网络读取成批给出完整的行（保留行尾换行），
+        不需要改写的行原样转发，一批行合并后一次交给Starlette发送，不再解码和重新编码。
+
+        Args:
+            response: degpt 返回的流式响应包装
+            include_usage: 客户端请求了 stream_options.include_usage，在 [DONE] 之前发送usage数据块
+        """
+        if isinstance(response, dg.StreamSessionRecorder):
+            response.include_usage = include_usage
 
-    async def _stream_response(self, response):
-        """流式传输响应数据，确保每行正确格式化以便 SSE"""
-        # 如果response是StreamingResponseWithSession对象，直接使用其iter_lines方法
-        if hasattr(response, 'iter_lines'):
-            # 使用 StreamingResponseWithSession 的 iter_lines 方法来累积内容并保存会话
+        # aiohttp连接池返回的异步迭代器，直接在事件循环中读取
+        if hasattr(response, '__anext__'):
             try:
-                # iter_lines() 内部处理了累积和会话保存
-                async for chunk in self._iter_lines_with_newline(response):
-                    yield chunk
+                async for batch in response:
+                    yield self._process_stream_batch(batch, response)
+                if include_usage and not response.usage_sent:
+                    # 上游没有发送 [DONE]
+                    yield self._usage_chunk(response)
             except Exception as e:
                 if debug:
-                    print(f"Error in _stream_response (StreamingResponseWithSession): {e}")
+                    print(f"Error in _stream_response (async): {e}")
                 yield f"data: {{\"error\": \"Stream processing error: {str(e)}\"}}\n\n"
             finally:
-                # 确保即使出错也能正确关闭原始响应
-                response.__exit__(None, None, None) # 调用 __exit__ 触发会话保存等逻辑
+                # 客户端断开或读取结束时把连接还给连接池
+                await response.aclose()
 
+        # requests同步响应（StreamingResponseWithSession）只在读取线程中读取，不在事件循环中阻塞
         else:
-            # 备用处理逻辑：如果传入的不是 StreamingResponseWithSession
-            # （虽然根据当前代码逻辑，不太可能走到这里）
             try:
-                # 直接转发来自后端API的SSE流，确保每行末尾有 \n
-                for chunk in response.iter_lines():
-                    if chunk:
-                        decoded_chunk = chunk.decode('utf-8')
-                        # 处理reasoning_content字段转换
-                        processed_chunk = self._process_stream_chunk(decoded_chunk)
-                        # 确保每行以 \n\n 结尾，符合 SSE 格式
-                        if not processed_chunk.endswith('\n'):
-                            processed_chunk += '\n'
-                        yield processed_chunk
+                async for chunk in self._iter_batches_threaded(response):
+                    yield chunk
+                if include_usage and not response.usage_sent:
+                    # 上游没有发送 [DONE]
+                    yield self._usage_chunk(response)
             except Exception as e:
                 if debug:
-                    print(f"Error in _stream_response (fallback): {e}")
-                yield f"data: {{\"error\": \"Stream error: {str(e)}\"}}\n\n"
+                    print(f"Error in _stream_response (StreamingResponseWithSession): {e}")
+                yield f"data: {{\"error\": \"Stream processing error: {str(e)}\"}}\n\n"
+            finally:
+                # 确保即使出错也能正确关闭原始响应；__exit__ 会写入会话，同样放到线程中
+                await asyncio.to_thread(response.__exit__, None, None, None)
+
+    def _usage_chunk(self, recorder) -> bytes:
+        """最后的usage数据块（choices为空），与OpenAI的 stream_options.include_usage 一致"""
+        recorder.usage_sent = True
+        meta = recorder.stream_meta or {}
+        chunk = {
+            "id": meta.get("id") or self._generate_id(),
+            "object": "chat.completion.chunk",
+            "created": meta.get("created") or int(time.time()),
+            "model": meta.get("model") or recorder.model,
+            "choices": [],
+            "usage": recorder.usage()
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n".encode('utf-8')
+
+    def _process_stream_batch(self, batch: List[bytes], recorder=None) -> bytes:
+        """处理一批完整的行，合并为一次发送"""
+        if len(batch) == 1:
+            return self._process_stream_chunk(batch[0], recorder)
+        return b"".join([self._process_stream_chunk(line, recorder) for line in batch])
 
-    async def _iter_lines_with_newline(self, response_wrapper):
+    async def _iter_batches_threaded(self, response_wrapper):
         """
-        异步包装 StreamingResponseWithSession.iter_lines，
-        确保每次 yield 的数据块以 \n\n 结尾，符合 SSE 规范。
+        异步包装 StreamingResponseWithSession.iter_batches，
         同时处理reasoning_content字段转换。
+
+        阻塞的socket读取放在独立的读取线程中，通过有界 asyncio.Queue 交给事件循环：
+        队列满时读取线程等待（背压），事件循环只在队列上 await，不会被慢速上游阻塞。
+        每次网络读取的所有行作为一批跨线程传递。
         """
-        loop = asyncio.get_event_loop()
-        # 在线程中运行同步的 iter_lines 以避免阻塞事件循环
-        iterator = await loop.run_in_executor(None, response_wrapper.iter_lines)
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stop = threading.Event()
+        end_of_stream = object()
+
+        def put(item) -> bool:
+            # 队列满时阻塞读取线程；消费者退出后放弃
+            while not stop.is_set():
+                future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+                try:
+                    future.result(timeout=1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    future.cancel()
+            return False
+
+        def reader():
+            try:
+                for batch in response_wrapper.iter_batches():
+                    if not put(batch):
+                        return
+                put(end_of_stream)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+            except Exception as e:
+                if not stop.is_set():
+                    put(e)
+
+        threading.Thread(target=reader, name="upstream-reader", daemon=True).start()
         try:
-            for chunk in iterator:
-                if chunk:
-                    decoded_chunk = chunk.decode('utf-8')
-                    # 处理reasoning_content字段转换
-                    processed_chunk = self._process_stream_chunk(decoded_chunk)
-                    # 确保符合 SSE 格式：每条消息以 \n\n 结尾
-                    # degpt.py 返回的已经是 data: ... 或 data: [DONE] 格式
-                    if not processed_chunk.endswith('\n'):
-                        processed_chunk += '\n'
-                    yield processed_chunk
-        except Exception as e:
-            # 重新抛出异常，让调用者处理
-            raise e
+            while True:
+                batch = await queue.get()
+                if batch is end_of_stream:
+                    break
+                if isinstance(batch, Exception):
+                    # 重新抛出异常，让调用者处理
+                    raise batch
+                # 处理reasoning_content字段转换，并记录回答内容用于保存会话
+                yield self._process_stream_batch(batch, response_wrapper)
         finally:
-            # 确保迭代器（如果需要）被正确关闭
-            # requests 的 iter_lines 通常不需要显式关闭，但保持谨慎
-            pass
+            # 通知读取线程退出；调用者关闭响应后阻塞中的读取也会结束
+            stop.set()
+
+    def _process_stream_chunk(self, chunk: bytes, recorder=None) -> bytes:
+        """处理流式数据块，将reasoning_content转换为content字段，并处理token计数
+
+        Args:
+            chunk: 一行SSE数据（字节，含行尾换行）
+            recorder: dg.StreamSessionRecorder，记录回答内容用于保存会话和计数（快速路径只解码需要的字符串）
 
-    def _process_stream_chunk(self, chunk: str) -> str:
-        """处理流式数据块，将reasoning_content转换为content字段，并处理token计数"""
+        Returns:
+            bytes: 以换行结尾的SSE行；未改写时就是传入的对象
+        """
         try:
-            if not chunk.startswith("data:"):
+            if not chunk.startswith(b"data:"):
                 return chunk
-                
-            data_str = chunk[5:].strip()
-            if not data_str:
+
+            data_bytes = chunk[5:].strip()
+            if not data_bytes:
                 return chunk
-                
+
             # 处理[DONE]事件，确保在流结束时提供token计数
-            if data_str == "[DONE]":
-                # 在[DONE]事件之前添加usage信息（如果没有的话）
-                # 这里可以返回一个usage事件，然后返回[DONE]
+            if data_bytes == b"[DONE]":
+                # 请求了include_usage时，在[DONE]之前发送usage数据块
+                if recorder is not None and recorder.include_usage and not recorder.usage_sent:
+                    return self._usage_chunk(recorder) + chunk
                 return chunk
-                
+
+            # 快速路径：绝大多数数据块只有一个choice的 delta.content，既不需要改写也不需要解析
+            # （每个流的第一帧完整解析一次，记录 id/created/model；带usage的帧和多个choice的帧也完整解析）
+            finish_count = data_bytes.count(b'"finish_reason"')
+            if (recorder is None or recorder.stream_meta is not None) and (
+                    finish_count == 0 or (finish_count == 1 and _FINISH_REASON_NULL.search(data_bytes))) \
+                    and b'"usage"' not in data_bytes and data_bytes.count(b'"delta"') <= 1:
+                reasoning_count = data_bytes.count(b'"reasoning_content"')
+                if reasoning_count == 0:
+                    if recorder is not None:
+                        recorder.record(_scan_delta_content(data_bytes))
+                    return chunk
+                if reasoning_count == 1 and not _CONTENT_KEY.search(data_bytes):
+                    # 只有思考内容：直接改键名，思考过程只计数不写入会话
+                    if recorder is not None:
+                        recorder.record_reasoning(_scan_delta_content(data_bytes, _REASONING_STRING))
+                    return chunk.replace(b'"reasoning_content"', b'"content"', 1)
+
             # 解析JSON数据
-            data = json.loads(data_str)
+            if recorder is not None and recorder.stream_meta is None:
+                recorder.stream_meta = {}
+            data = json.loads(data_bytes)
+            if not isinstance(data, dict):
+                return chunk
             modified = False
+            if recorder is not None:
+                if not recorder.stream_meta:
+                    recorder.stream_meta = {"id": data.get("id"), "created": data.get("created"),
+                                            "model": data.get("model")}
+                if isinstance(data.get("usage"), dict) and data["usage"].get("total_tokens"):
+                    recorder.upstream_usage = data["usage"]
+                    if not data.get("choices"):
+                        # 上游自己发送了usage数据块，[DONE] 之前不再重复发送
+                        recorder.usage_sent = True
             
             # 检查是否有choices和reasoning_content字段
             if "choices" in data and data["choices"]:
                 for choice in data["choices"]:
                     if "delta" in choice:
                         delta = choice["delta"]
+                        # 只把真正的回答写入会话，思考过程不保存
+                        if recorder is not None and delta.get("content"):
+                            recorder.record(delta["content"])
                         # 将reasoning_content转换为content
                         if "reasoning_content" in delta:
+                            if recorder is not None and isinstance(delta["reasoning_content"], str):
+                                recorder.record_reasoning(delta["reasoning_content"])
                             delta["content"] = delta.pop("reasoning_content")
                             modified = True
                             if debug:
@@ -1014,21 +1143,26 @@ class APIServer:
                         
                         # 检查是否需要在流结束时添加token计数
                         if choice.get("finish_reason") == "stop" and "usage" not in data:
-                            # 如果流结束但没有usage信息，添加一个基本的usage
-                            data["usage"] = {
-                                "prompt_tokens": 0,
-                                "completion_tokens": 0,
-                                "total_tokens": 0
-                            }
-                            modified = True
+                            if recorder is None:
+                                # 没有计数信息时保持原有格式，添加一个基本的usage
+                                data["usage"] = {
+                                    "prompt_tokens": 0,
+                                    "completion_tokens": 0,
+                                    "total_tokens": 0
+                                }
+                                modified = True
+                            elif not recorder.include_usage:
+                                # 请求了include_usage时由单独的usage数据块返回，否则附在结束帧上
+                                data["usage"] = recorder.usage()
+                                modified = True
             
             # 如果数据被修改，返回新的JSON；否则返回原始数据
             if modified:
-                return f"data: {json.dumps(data, ensure_ascii=False)}"
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n".encode('utf-8')
             else:
                 return chunk
             
-        except (json.JSONDecodeError, KeyError) as e:
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError) as e:
             if debug:
                 print(f"处理流式数据块失败: {e}, 原始数据: {chunk[:100]}...")
             # 如果处理失败，返回原始数据
@@ -1039,31 +1173,49 @@ class APIServer:
             return chunk
 
 
-    async def _stream_claude_response(self, response):
-        """简化的Claude流式响应转换器"""
+    @staticmethod
+    async def _iter_text_lines(chunks):
+        """把 _stream_response 输出的字节批次（或错误字符串）拆成逐行的字符串"""
+        async for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode('utf-8')
+            for line in chunk.splitlines():
+                yield line
+
+    async def _stream_claude_response(self, response, input_tokens: int = 0):
+        """简化的Claude流式响应转换器
+
+        Args:
+            response: _generate_response_optimized 返回的流式响应
+            input_tokens: message_start 中的prompt token数；结束时以OpenAI流的usage数据块为准
+        """
         message_id = f"msg_{int(time.time() * 1000)}"
         model_name = "claude-3-sonnet-20240229"
         
         try:
             # message_start事件
-            yield f"event: message_start\ndata: {{\"type\": \"message_start\", \"message\": {{\"id\": \"{message_id}\", \"type\": \"message\", \"role\": \"assistant\", \"content\": [], \"model\": \"{model_name}\", \"stop_reason\": null, \"stop_sequence\": null, \"usage\": {{\"input_tokens\": 0, \"output_tokens\": 0}}}}}}\n\n"
+            yield f"event: message_start\ndata: {{\"type\": \"message_start\", \"message\": {{\"id\": \"{message_id}\", \"type\": \"message\", \"role\": \"assistant\", \"content\": [], \"model\": \"{model_name}\", \"stop_reason\": null, \"stop_sequence\": null, \"usage\": {{\"input_tokens\": {input_tokens}, \"output_tokens\": 0}}}}}}\n\n"
             
             # content_block_start事件
             yield f"event: content_block_start\ndata: {{\"type\": \"content_block_start\", \"index\": 0, \"content_block\": {{\"type\": \"text\", \"text\": \"\"}}}}\n\n"
             
             # 处理流式内容
             output_tokens = 0
-            async for chunk in self._stream_response(response):
+            usage = None
+            # _generate_response_optimized 返回的是已经处理好SSE行的 StreamingResponse
+            chunks = response.body_iterator if isinstance(response, StreamingResponse) else self._stream_response(response)
+            async for chunk in self._iter_text_lines(chunks):
                 if chunk.startswith("data:") and chunk.strip() != "data: [DONE]":
                     data_str = chunk[5:].strip()
                     if data_str:
                         try:
                             openai_data = json.loads(data_str)
+                            if isinstance(openai_data.get("usage"), dict):
+                                usage = openai_data["usage"]
                             if "choices" in openai_data and openai_data["choices"]:
                                 choice = openai_data["choices"][0]
-                                if "delta" in choice and "content" in choice["delta"]:
+                                if "delta" in choice and choice["delta"].get("content"):
                                     content_delta = choice["delta"]["content"]
-                                    output_tokens += len(content_delta.split())
                                     
                                     # Claude格式的增量事件
                                     claude_delta = {
@@ -1082,8 +1234,11 @@ class APIServer:
             # content_block_stop事件
             yield f"event: content_block_stop\ndata: {{\"type\": \"content_block_stop\", \"index\": 0}}\n\n"
             
-            # message_delta事件
-            yield f"event: message_delta\ndata: {{\"type\": \"message_delta\", \"delta\": {{\"stop_reason\": \"end_turn\", \"stop_sequence\": null}}, \"usage\": {{\"output_tokens\": {output_tokens}}}}}\n\n"
+            # message_delta事件（usage来自OpenAI流最后的usage数据块）
+            if usage:
+                input_tokens = usage.get("prompt_tokens", input_tokens)
+                output_tokens = usage.get("completion_tokens", output_tokens)
+            yield f"event: message_delta\ndata: {{\"type\": \"message_delta\", \"delta\": {{\"stop_reason\": \"end_turn\", \"stop_sequence\": null}}, \"usage\": {{\"input_tokens\": {input_tokens}, \"output_tokens\": {output_tokens}}}}}\n\n"
             
             # message_stop事件
             yield f"event: message_stop\ndata: {{\"type\": \"message_stop\"}}\n\n"
@@ -1097,7 +1252,9 @@ class APIServer:
             yield f"event: error\ndata: {json.dumps(error_event, ensure_ascii=False)}\n\n"
 
     def _get_workers_count(self) -> int:
-        """Calculate optimal worker count"""
+        """Calculate optimal worker count (WORKERS overrides the calculation)"""
+        if os.getenv("WORKERS"):
+            return max(1, int(os.getenv("WORKERS")))
         try:
             cpu_cores = multiprocessing.cpu_count()
             recommended_workers = (2 * cpu_cores) + 1
@@ -1107,8 +1264,8 @@ class APIServer:
                 print(f"Worker count calculation failed: {e}, using default 4")
             return 4
 
-    def get_server_config(self, host: str = "0.0.0.0", port: int = 7860) -> uvicorn.Config:
-        """Get server configuration"""
+    def _get_server_options(self, host: str, port: int) -> Dict[str, Any]:
+        """Shared uvicorn options for single and multi worker mode"""
         workers = self._get_workers_count()
         if debug:
             print(f"Configuring server with {workers} workers")
@@ -1118,8 +1275,7 @@ class APIServer:
         else:
             loop_type = "uvloop"
 
-        return uvicorn.Config(
-            app=self.app,
+        return dict(
             host=host,
             port=port,
             workers=workers,
@@ -1131,11 +1287,29 @@ class APIServer:
             http="httptools"
         )
 
+    def get_server_config(self, host: str = "0.0.0.0", port: int = 7860) -> uvicorn.Config:
+        """Get server configuration"""
+        return uvicorn.Config(app=self.app, **self._get_server_options(host, port))
+
     def run(self, host: str = "0.0.0.0", port: int = 7860) -> None:
-        """Run the API server"""
-        config = self.get_server_config(host, port)
-        server = uvicorn.Server(config)
-        server.run()
+        """Run the API server
+
+        uvicorn.Server 会忽略 workers 参数，多worker时必须通过导入字符串启动，
+        由uvicorn的主进程监听端口并拉起各个worker进程（每个worker调用 create_app 初始化）。
+        worker之间通过本机共享状态文件同步模型缓存、模型统计和会话。
+        """
+        options = self._get_server_options(host, port)
+        if options["workers"] <= 1:
+            server = uvicorn.Server(uvicorn.Config(app=self.app, **options))
+            server.run()
+            return
+
+        # 主进程只负责管理worker，不需要定时任务和线程池
+        self.scheduler.shutdown(wait=False)
+        self.chat_executor.shutdown()
+        # worker进程继承环境变量，启用共享状态
+        os.environ["DEGPT_SHARED_STATE"] = "true"
+        uvicorn.run("more_core:create_app", factory=True, **options)
 
     def _reload_check(self) -> None:
         dg.reload_check()
@@ -1159,7 +1333,8 @@ class APIServer:
     def _reload_routes(self, new_routes: List[str]) -> None:
         """Reload only dynamic routes while preserving static ones"""
         # Define static route names
-        static_routes = {"root", "health", "models", "clear_session", "claude_messages", "claude_messages_v1"}
+        static_routes = {"root", "health", "models", "clear_session", "fork_session", "claude_messages",
+                         "claude_messages_v1"}
 
         # Remove only dynamic routes
         self.app.routes[:] = [
@@ -1177,6 +1352,12 @@ def create_server() -> APIServer:
     return APIServer(app)
 
 
+def create_app() -> FastAPI:
+    """App factory used by uvicorn worker processes in multi-worker mode"""
+    create_server()
+    return app
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "7860"))
     server = create_server()
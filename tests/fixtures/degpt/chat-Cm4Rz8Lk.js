@@ -0,0 +1,6 @@
+// 模型列表取自 docs/current_info.md 中记录的 /v1/models 输出，按 www.degpt.ai 的chunk结构重建（当前环境无法访问线上站点），用于 tests/test_js_bundle_scan.py
+import{d as e,r as t,_ as s}from"./vendor-CqL0f2Tn.js";
+const r={models:[{name:"DeepSeek V3.1",model:"deepseek-chat",tip:"DeepSeek V3.1",support:"text",desc:"Suitable for reasoning and writing"},{name:"DouBao 1.6 (TikTok)",model:"doubao-seed-1-6-250615",tip:"DouBao 1.6 (TikTok)",support:"image",desc:"Multimodal graphics and text, suitable for daily tasks"},{name:"Qwen3 (Ali Cloud)",model:"qwen3-235b-a22b",tip:"Qwen3 (Ali Cloud)",support:"image",desc:"Strong language skills"},{name:"Qwen3 Thinking (Ali Cloud)",model:"qwen3-235b-a22b",tip:"Qwen3 Thinking (Ali Cloud)",support:"image",desc:"Enhanced reasoning, suitable for complex tasks"},{name:"GPT-5 mini (OpenAI)",model:"gpt-5-mini",tip:"GPT-5 mini (OpenAI)",support:"image",desc:"Lightweight general-purpose model with fast response speed"},{name:"GPT-4o (OpenAI)",model:"gpt-4o",tip:"GPT-4o (OpenAI)",support:"image",desc:"Multimodal graphics and text, suitable for most tasks"},{name:"DeepSeek R1",model:"deepseek-reasoner",tip:"DeepSeek R1",support:"text",desc:"Strong writing and coding skills"},{name:"Gemini 2.5 Flash (Google)",model:"gemini-2.5-flash-preview-05-20",tip:"Gemini 2.5 Flash (Google)",support:"text",desc:"Multimodal graphics and text, quick response"},{name:"Grok 4 (Elon Musk)",model:"grok-4-0709",tip:"Grok 4 (Elon Musk)",support:"image",desc:"Expert in Q&A, lively expression style"},{name:"DouBao 1.6 Thinking (TikTok)",model:"doubao-seed-1-6-thinking-250615",tip:"DouBao 1.6 Thinking (TikTok)",support:"image",desc:"Multimodal graphics and text, reasoning enhancement"},{name:"GPT o3 (OpenAI)",model:"o3",tip:"GPT o3 (OpenAI)",support:"image",desc:"Using advanced reasoning"},{name:"GPT o4-mini high (OpenAI)",model:"o4-mini",tip:"GPT o4-mini high (OpenAI)",support:"image",desc:"Using advanced reasoning"},{name:"GPT-4.1 (OpenAI)",model:"gpt-4.1",tip:"GPT-4.1 (OpenAI)",support:"image",desc:"Good at fast coding and analysis"},{name:"GPT-5 (OpenAI)",model:"gpt-5",tip:"GPT-5 (OpenAI)",support:"image",desc:"Good at fast coding and analysis"},{name:"Claude 4 Opus (Anthropic)",model:"claude-opus-4-20250514",tip:"Claude 4 Opus (Anthropic)",support:"text",desc:"Strongest in coding, suitable for complex tasks"},{name:"Claude 4 Opus Thinking (Anthropic)",model:"claude-opus-4-20250514",tip:"Claude 4 Opus Thinking (Anthropic)",support:"text",desc:"Deep reasoning enhancement"},{name:"Grok 3 Thinking (Elon Musk)",model:"grok-3-mini",tip:"Grok 3 Thinking (Elon Musk)",support:"image",desc:"Strengthened logical reasoning and knowledge expression"},{name:"Gemini 2.5 Pro (Google)",model:"gemini-2.5-pro",tip:"Gemini 2.5 Pro (Google)",support:"text",desc:"Powerful multimodal capabilities, proficient in graphics, text, and code"}],defaultModel:"deepseek-chat"};
+const a=e({name:"Chat",setup(){const n=t(r.models[0]);return{n,r}}});
+function o(){return s(()=>import("./markdown-Xw7Kp3Ld.js"),[])}
+export{a as default,o as loadMarkdown};
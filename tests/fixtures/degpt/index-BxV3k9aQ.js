@@ -0,0 +1,10 @@
+// 按 www.degpt.ai 入口bundle的Vite产物结构重建（当前环境无法访问线上站点），用于 tests/test_js_bundle_scan.py
+const __vite__mapDeps=(i,m=__vite__mapDeps,d=(m.f||(m.f=["assets/chat-Cm4Rz8Lk.js","assets/vendor-CqL0f2Tn.js","assets/chat-Bq2Lx0Wd.css","assets/settings-Dp7Hs2Kc.js"])))=>i.map(i=>d[i]);
+import{d as e,r as t,c as n,o as r,a as o,_ as s}from"./vendor-CqL0f2Tn.js";
+const c=[{path:"/",name:"chat",component:()=>s(()=>import("./chat-Cm4Rz8Lk.js"),__vite__mapDeps([0,1,2]))},{path:"/settings",name:"settings",component:()=>s(()=>import("./settings-Dp7Hs2Kc.js"),__vite__mapDeps([3,1]))}];
+const l=new Worker(new URL("/assets/tokenizer.worker-Ba91fXe2.js",import.meta.url),{type:"module"});
+const u={baseURL:"/api",timeout:6e4,locale:"en-US"},p=`${u.baseURL}/v1/chat/completion/proxy`;
+function f(a,b){return a.replace(/\{(\w+)\}/g,(g,k)=>b[k]??"")}
+function h(a){return fetch(`/assets/i18n/${a}.json`).then(b=>b.json())}
+const m={background:"url(/assets/bg-Hk2P0sWq.png)",font:"url('/assets/inter-Fp8Qw2.woff2')"};
+e({setup(){const a=t(!1),b=n(()=>a.value?"dark":"light");return r(()=>{o.info("mounted",b.value)}),{a,b}}}).mount("#app");
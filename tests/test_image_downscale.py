@@ -0,0 +1,39 @@
+"""图片缩放：EXIF方向"""
+import base64
+import io
+
+import pytest
+
+import degpt as dg
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def jpeg_data_url(width, height, orientation=None):
+    img = Image.new("RGB", (width, height), (200, 120, 40))
+    # 加一些细节，避免纯色图片压缩后比缩放结果还小
+    for x in range(0, width, 7):
+        img.putpixel((x, x * height // width), (0, 0, 0))
+    exif = Image.Exif()
+    if orientation:
+        exif[dg.EXIF_ORIENTATION_TAG] = orientation
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=95, exif=exif)
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode("ascii")
+
+
+def decoded_size(data_url):
+    return Image.open(io.BytesIO(base64.b64decode(data_url.split(",", 1)[1]))).size
+
+
+@pytest.mark.parametrize("orientation, expected", [
+    (None, (1024, 768)),
+    (3, (1024, 768)),
+    (6, (768, 1024)),
+    (8, (768, 1024)),
+])
+def test_output_follows_exif_orientation(orientation, expected):
+    # 目标尺寸按文件头中的尺寸（旋转前）计算
+    data_url, width, height = dg._downscale_image(jpeg_data_url(4000, 3000, orientation), 1024, 768, 85)
+    assert (width, height) == expected
+    assert decoded_size(data_url) == expected
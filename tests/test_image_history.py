@@ -0,0 +1,109 @@
+"""旧图片的处理策略：按内容哈希复用描述"""
+import base64
+
+import degpt as dg
+
+DATA_URL = "data:image/png;base64," + base64.b64encode(b"\x89PNG" + b"\x00" * 64).decode("ascii")
+
+
+def image_message(url, text="看图"):
+    return {"role": "user", "content": [{"type": "text", "text": text},
+                                        {"type": "image_url", "image_url": {"url": url}}]}
+
+
+def turns(first_image_url):
+    return [image_message(first_image_url), {"role": "assistant", "content": "a0"},
+            {"role": "user", "content": "q1"}]
+
+
+def test_resent_base64_image_uses_description_of_stored_reference():
+    policy = dg.ImageHistoryPolicy(keep_turns=0, policy="describe")
+    digest = dg.ImageValidator.content_hash(DATA_URL)
+    policy.descriptions[digest] = "一只猫"
+    for url in (dg.IMAGE_REF_PREFIX + digest, DATA_URL):
+        messages = turns(url)
+        assert policy.apply(messages) == 1
+        assert messages[0]["content"][1] == {"type": "text", "text": "[之前的图片: 一只猫]"}
+    # 已算好的哈希直接使用
+    messages = turns(DATA_URL)
+    policy.descriptions["precomputed"] = "一只狗"
+    policy.apply(messages, {DATA_URL: "precomputed"})
+    assert messages[0]["content"][1]["text"] == "[之前的图片: 一只狗]"
+
+
+def test_apply_copies_only_changed_messages():
+    policy = dg.ImageHistoryPolicy(keep_turns=0, policy="placeholder")
+    messages = turns(DATA_URL)
+    original = list(messages)
+    policy.apply(messages)
+    assert messages[0] is not original[0]
+    assert messages[1:] == original[1:] and all(a is b for a, b in zip(messages[1:], original[1:]))
+    assert original[0]["content"][1]["type"] == "image_url"
+
+
+def describe_and_wait(policy, url):
+    text = policy._describe(url)
+    if policy._executor is not None:
+        policy._executor.shutdown(wait=True)
+        policy._executor = None
+    return text
+
+
+def test_failed_description_is_not_retried_until_retry_after(monkeypatch):
+    policy = dg.ImageHistoryPolicy(keep_turns=0, policy="describe")
+    calls = []
+
+    def fail(data_url):
+        calls.append(data_url)
+        raise dg.requests.exceptions.ConnectionError("upstream down")
+
+    monkeypatch.setattr(policy, "_request_description", fail)
+    for _ in range(3):
+        assert describe_and_wait(policy, DATA_URL) == dg.IMAGE_OMITTED_TEXT
+    assert len(calls) == 1 and policy.stats()["failures"] == 1
+    # 到期后重新尝试
+    digest = dg.ImageValidator.content_hash(DATA_URL)
+    policy.failed[digest] = 0
+    monkeypatch.setattr(policy, "_request_description", lambda data_url: "一只猫")
+    describe_and_wait(policy, DATA_URL)
+    assert policy.descriptions[digest] == "一只猫" and digest not in policy.failed
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, chunk_size=None):
+        return iter(self.lines)
+
+
+def test_description_request_is_not_counted_as_client_call(monkeypatch):
+    monkeypatch.setattr(dg, "cached_models", {"object": "list", "data": [
+        {"id": "deepseek-chat", "name": "DeepSeek V3.1", "support": "text"},
+        {"id": "gpt-4o", "name": "GPT-4o (OpenAI)", "support": "image"}]})
+    monkeypatch.setattr(dg, "MODEL_STATS", {})
+    monkeypatch.setattr(dg.token_manager, "get_token", lambda: "token")
+    requests_sent = []
+
+    def post(url, headers, json, timeout, stream):
+        requests_sent.append(json)
+        return FakeResponse([b'data: {"choices":[{"index":0,"delta":{"content":" \\u4e00\\u53ea\\u732b "}}]}',
+                             b"", b"data: [DONE]"])
+
+    monkeypatch.setattr(dg.http_session, "post", post)
+    policy = dg.ImageHistoryPolicy(keep_turns=0, policy="describe")
+    describe_and_wait(policy, DATA_URL)
+    assert policy.descriptions[dg.ImageValidator.content_hash(DATA_URL)] == "一只猫"
+    assert requests_sent[0]["model"] == "gpt-4o"
+    assert dg.MODEL_STATS == {}
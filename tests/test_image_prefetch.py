@@ -0,0 +1,95 @@
+"""图片URL预下载：内网地址、重定向和缓存条数"""
+import asyncio
+import struct
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import degpt as dg
+
+
+def png_bytes(width=2, height=2):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    raw = b"".join(b"\x00" + b"\x00\x00\x00" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/redirect"):
+            self.send_response(302)
+            self.send_header("Location", self.path.split("to=", 1)[1])
+            self.end_headers()
+            return
+        body = png_bytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def fetch(prefetcher, url):
+    return asyncio.run_coroutine_threadsafe(prefetcher.fetch(url), prefetcher._event_loop()).result(10)
+
+
+@pytest.fixture
+def make_prefetcher():
+    created = []
+
+    def make(**kwargs):
+        prefetcher = dg.ImagePrefetcher(mode="validate", timeout=5, **kwargs)
+        created.append(prefetcher)
+        return prefetcher
+    yield make
+    for prefetcher in created:
+        prefetcher.shutdown()
+
+
+def test_private_addresses_are_rejected(server, make_prefetcher):
+    prefetcher = make_prefetcher()
+    for url in (server + "/a.png", "http://169.254.169.254/latest/meta-data",
+                "http://[::ffff:127.0.0.1]/a.png", "file:///etc/passwd"):
+        result = fetch(prefetcher, url)
+        assert not result["valid"], url
+    # 域名解析到本机地址同样拒绝
+    port = server.rsplit(":", 1)[1]
+    assert not fetch(prefetcher, f"http://localhost:{port}/a.png")["valid"]
+
+
+def test_allow_private(server, make_prefetcher):
+    result = fetch(make_prefetcher(allow_private=True), server + "/a.png")
+    assert result["valid"] and (result["width"], result["height"]) == (2, 2)
+
+
+def test_redirects_are_checked_on_every_hop(server, make_prefetcher, monkeypatch):
+    # 把测试服务器所在的127.0.0.1当作公网地址
+    monkeypatch.setattr(dg, "is_public_address", lambda host: host == "127.0.0.1")
+    prefetcher = make_prefetcher()
+    assert fetch(prefetcher, server + "/redirect?to=/b.png")["valid"]
+    result = fetch(prefetcher, server + "/redirect?to=http://169.254.169.254/latest/meta-data")
+    assert not result["valid"] and "169.254.169.254" in result["error"]
+
+
+def test_cache_is_capped_by_entries(server, make_prefetcher):
+    prefetcher = make_prefetcher(allow_private=True, max_entries=3)
+    for i in range(5):
+        fetch(prefetcher, f"{server}/{i}.png")
+    # 只校验时结果不含图片内容，内存预算限制不住条数
+    assert prefetcher.stats()["cached"] == 3
+    assert prefetcher.stats()["cache_bytes"] == 0
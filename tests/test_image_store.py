@@ -0,0 +1,72 @@
+"""图片存储：解码保存、溢出到磁盘、按worker隔离与共享目录的清理"""
+import base64
+import os
+import time
+
+import degpt as dg
+
+
+def data_url(seed, size=1000):
+    return "data:image/png;base64," + base64.b64encode(bytes([seed]) * size).decode("ascii")
+
+
+def resolve(store, ref):
+    return store.get(ref[len(dg.IMAGE_REF_PREFIX):])
+
+
+def test_stores_decoded_bytes(tmp_path):
+    store = dg.ImageStore(str(tmp_path), memory_budget=10 ** 6, disk_budget=10 ** 6)
+    url = data_url(1)
+    ref = store.put(url)
+    assert ref.startswith(dg.IMAGE_REF_PREFIX)
+    assert store.put(url) == ref
+    assert store.stats()["memory_bytes"] == 1000
+    assert resolve(store, ref) == url
+
+
+def test_undecodable_data_url_is_kept_inline(tmp_path):
+    store = dg.ImageStore(str(tmp_path))
+    assert store.put("data:image/png;base64,@@@") == "data:image/png;base64,@@@"
+    assert store.put("https://example.com/a.png") == "https://example.com/a.png"
+
+
+def test_spills_to_worker_directory(tmp_path):
+    store = dg.ImageStore(str(tmp_path), memory_budget=1500, disk_budget=10 ** 6)
+    refs = [store.put(data_url(i)) for i in range(3)]
+    assert store.directory == str(tmp_path / f"worker-{os.getpid()}")
+    assert store.stats()["spilled"] == 2
+    assert len(os.listdir(store.directory)) == 2
+    assert [resolve(store, ref) for ref in refs] == [data_url(i) for i in range(3)]
+
+
+def test_startup_removes_dead_worker_directories(tmp_path):
+    dead = tmp_path / "worker-999999999"
+    dead.mkdir()
+    (dead / "x.img").write_bytes(b"data:image/png;base64\n")
+    alive = tmp_path / "worker-1"
+    alive.mkdir()
+    dg.ImageStore(str(tmp_path)).prepare()
+    assert not dead.exists()
+    assert alive.exists()
+
+
+def test_shared_directory_is_readable_by_other_workers(tmp_path):
+    writer = dg.ImageStore(str(tmp_path), memory_budget=0, disk_budget=10 ** 6, write_through=True)
+    ref = writer.put(data_url(7))
+    reader = dg.ImageStore(str(tmp_path), write_through=True)
+    assert resolve(reader, ref) == data_url(7)
+
+
+def test_shared_directory_prunes_stale_and_over_budget_files(tmp_path):
+    writer = dg.ImageStore(str(tmp_path), memory_budget=0, disk_budget=10 ** 6,
+                           write_through=True, max_age=60)
+    refs = [writer.put(data_url(i)) for i in range(3)]
+    paths = [writer._path(ref[len(dg.IMAGE_REF_PREFIX):]) for ref in refs]
+    old = time.time() - 120
+    os.utime(paths[0], (old, old))
+    os.utime(paths[1], (old + 100, old + 100))
+    # 新启动的worker：删除超过max_age未读取的文件，再按mtime裁剪到预算内
+    restarted = dg.ImageStore(str(tmp_path), disk_budget=1100, write_through=True, max_age=60)
+    restarted.prepare()
+    assert [os.path.exists(path) for path in paths] == [False, False, True]
+    assert restarted.stats()["disk_images"] == 1
@@ -0,0 +1,58 @@
+"""scan_js_bundle 与原来的 parse_models_from_js + extract_links（benchmarks.py）的结果对照"""
+from pathlib import Path
+
+import pytest
+
+import degpt as dg
+from benchmarks import extract_links, old_scan
+
+FIXTURES = Path(__file__).parent / "fixtures" / "degpt"
+SITE = "https://www.degpt.ai/"
+
+PAGES = [
+    ("index.html", SITE),
+    ("index-BxV3k9aQ.js", SITE + "assets/index-BxV3k9aQ.js"),
+    ("chat-Cm4Rz8Lk.js", SITE + "assets/chat-Cm4Rz8Lk.js"),
+]
+
+
+@pytest.mark.parametrize("name, url", PAGES)
+def test_same_models_and_superset_of_links(name, url):
+    content = (FIXTURES / name).read_text(encoding="utf-8")
+    old_models, old_links = old_scan(content, url)
+    models, links = dg.scan_js_bundle(content, url)
+    assert models == old_models
+    assert links >= old_links
+
+
+def test_fixture_pages_lead_to_the_models():
+    html = (FIXTURES / "index.html").read_text(encoding="utf-8")
+    _, links = dg.scan_js_bundle(html, SITE)
+    assert {SITE + "assets/index-BxV3k9aQ.js", SITE + "assets/vendor-CqL0f2Tn.js", SITE + "about.html"} <= links
+    # 其他域名的脚本不跟随
+    assert not any("googletagmanager" in link for link in links)
+
+    entry = (FIXTURES / "index-BxV3k9aQ.js").read_text(encoding="utf-8")
+    _, links = dg.scan_js_bundle(entry, PAGES[1][1])
+    assert SITE + "assets/chat-Cm4Rz8Lk.js" in links
+
+    chunk = (FIXTURES / "chat-Cm4Rz8Lk.js").read_text(encoding="utf-8")
+    models, links = dg.scan_js_bundle(chunk, PAGES[2][1])
+    assert len(models) == 18 and links == set()
+    assert models[0] == {"name": "DeepSeek V3.1", "model": "deepseek-chat", "tip": "DeepSeek V3.1",
+                         "support": "text", "desc": "Suitable for reasoning and writing"}
+
+
+def test_root_relative_paths_resolve_against_site_root():
+    url = SITE + "assets/index-BxV3k9aQ.js"
+    entry = (FIXTURES / "index-BxV3k9aQ.js").read_text(encoding="utf-8")
+    # new URL("/assets/...") 原实现没有识别
+    assert SITE + "assets/tokenizer.worker-Ba91fXe2.js" in dg.scan_js_bundle(entry, url)[1]
+    # 原实现去掉开头的 / 后按bundle所在目录解析，得到不存在的 /assets/assets/
+    content = 'import("/assets/chat-Cm4Rz8Lk.js")'
+    assert dg.scan_js_bundle(content, url)[1] == {SITE + "assets/chat-Cm4Rz8Lk.js"}
+    assert extract_links(content, url) == {SITE + "assets/assets/chat-Cm4Rz8Lk.js"}
+
+
+def test_extension_only_strings_are_not_links():
+    assert dg.scan_js_bundle('e.endsWith(".js")||t+"/.css"', SITE + "assets/a.js")[1] == set()
@@ -0,0 +1,78 @@
+"""模型发现：只采用第一个结果，缓存过期时后台刷新"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import degpt as dg
+
+BUNDLE = "const a={models:[{name:'%s',model:'%s',support:'text'}]};"
+PAGES = {
+    "/": '<html><script src="/assets/index-a.js"></script><script src="/assets/index-b.js"></script></html>',
+    "/assets/index-a.js": BUNDLE % ("A", "model-a"),
+    "/assets/index-b.js": BUNDLE % ("B", "model-b"),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def site():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+
+
+def test_crawl_uses_only_the_first_bundle_with_models(site):
+    crawler = dg.ModelCrawler(concurrency=4, timeout=10)
+    for _ in range(3):
+        models = crawler.crawl(site)
+        assert [m["model"] for m in models] in (["model-a"], ["model-b"])
+    assert crawler.model_url in (site + "assets/index-a.js", site + "assets/index-b.js")
+
+
+def test_stale_models_are_served_while_refreshing(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch():
+        started.set()
+        release.wait(5)
+
+    stale = {"object": "list", "data": [{"id": "stale-model"}]}
+    monkeypatch.setattr(dg, "cached_models", stale)
+    monkeypatch.setattr(dg, "shared_state", None)
+    monkeypatch.setattr(dg, "_fetch_and_update_models", slow_fetch)
+    monkeypatch.setattr(dg, "last_request_time", 0)
+    try:
+        begin = time.monotonic()
+        assert json.loads(dg.get_models())["data"] == [{"id": "stale-model"}]
+        assert time.monotonic() - begin < 1
+        assert started.wait(5)
+        # 刷新进行中再次过期也不会启动第二个刷新
+        dg.last_request_time = 0
+        dg.get_models()
+        assert dg._models_refreshing
+    finally:
+        release.set()
+    deadline = time.monotonic() + 5
+    while dg._models_refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not dg._models_refreshing
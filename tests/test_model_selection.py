@@ -0,0 +1,65 @@
+"""按请求内容选择模型：只选择一次，之后的阶段复用结果"""
+import time
+
+import pytest
+
+import degpt as dg
+
+MODELS = [
+    {"id": "deepseek-chat", "name": "DeepSeek V3.1", "support": "text"},
+    {"id": "doubao-seed-1-6-250615", "name": "DouBao 1.6 (TikTok)", "support": "image"},
+    {"id": "gpt-4o", "name": "GPT-4o (OpenAI)", "support": "image"},
+]
+IMAGE = {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}
+
+
+@pytest.fixture
+def models(monkeypatch):
+    monkeypatch.setattr(dg, "cached_models", {"object": "list", "data": list(MODELS)})
+    monkeypatch.setattr(dg, "MODEL_STATS", {})
+    monkeypatch.setattr(dg, "shared_state", None)
+    monkeypatch.setattr(dg, "last_request_time", time.time())
+    for model in MODELS:
+        dg.record_call(model["id"])
+    calls = []
+    get_models = dg.get_models
+    monkeypatch.setattr(dg, "get_models", lambda: calls.append(1) or get_models())
+    return calls
+
+
+def request(with_image=False):
+    content = [{"type": "text", "text": "看图"}, IMAGE] if with_image else "你好"
+    return dg.normalize_messages([{"role": "user", "content": content}])
+
+
+def test_text_request_keeps_available_model(models):
+    req = request()
+    assert dg.select_model(req, "deepseek-chat") == "deepseek-chat"
+    assert (req.model, req.model_for_images) == ("deepseek-chat", False)
+    assert dg.select_model(request(), "no-such-model") in {m["id"] for m in MODELS}
+    assert models == []
+
+
+def test_image_request_matches_by_name_and_returns_id(models):
+    req = request(with_image=True)
+    assert dg.select_model(req, "GPT-4o (OpenAI)") == "gpt-4o"
+    assert models == [1]
+
+
+def test_image_request_switches_text_model_to_image_model(models):
+    assert dg.select_model(request(with_image=True), "deepseek-chat") == "doubao-seed-1-6-250615"
+
+
+def test_reselect_after_images_are_dropped_uses_requested_model(models):
+    req = request(with_image=True)
+    assert dg.select_model(req, "deepseek-chat") == "doubao-seed-1-6-250615"
+    # 图片下载失败被移除后
+    req.replace_images({IMAGE["image_url"]["url"]: None}, dg.IMAGE_UNAVAILABLE_TEXT)
+    assert not req.has_images
+    assert dg.select_model(req, req.model) == "deepseek-chat"
+
+
+def test_no_image_model(models, monkeypatch):
+    monkeypatch.setattr(dg, "cached_models", {"object": "list", "data": [MODELS[0]]})
+    with pytest.raises(ValueError):
+        dg.select_model(request(with_image=True), "auto")
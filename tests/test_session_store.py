@@ -0,0 +1,152 @@
+"""会话存储：内存、SQLite、Redis（fakeredis）三种实现的公共行为"""
+import sys
+from collections import OrderedDict
+
+import pytest
+
+import degpt as dg
+
+TIMEOUT = 60
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def assistant(text):
+    return {"role": "assistant", "content": text}
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return dg.MemorySessionStore(OrderedDict(), timeout=TIMEOUT)
+    if request.param == "sqlite":
+        return dg.SQLiteSessionStore(str(tmp_path / "sessions.db"), timeout=TIMEOUT)
+    fakeredis = pytest.importorskip("fakeredis")
+    return dg.RedisSessionStore(timeout=TIMEOUT, client=fakeredis.FakeRedis())
+
+
+def expire(store, session_id):
+    """把会话的最后活跃时间改到超时之前"""
+    if isinstance(store, dg.MemorySessionStore):
+        store.storage[session_id]["last_activity"] -= TIMEOUT + 1
+    elif isinstance(store, dg.SQLiteSessionStore):
+        store._conn().execute("UPDATE sessions SET last_activity = last_activity - ? WHERE session_id = ?",
+                              (TIMEOUT + 1, session_id))
+    else:
+        store.client.delete(store._key(session_id))
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        dg.SessionStore()
+
+
+def test_load_missing_session_is_empty(store):
+    assert list(store.load("s1")) == []
+
+
+def test_append_and_load(store):
+    store.append("s1", [user("q0"), assistant("a0")])
+    store.append("s1", [user("q1"), assistant("a1")])
+    assert list(store.load("s1")) == [user("q0"), assistant("a0"), user("q1"), assistant("a1")]
+    assert list(store.load("s2")) == []
+
+
+def test_append_nothing_is_noop(store):
+    store.append("s1", [])
+    assert list(store.load("s1")) == []
+
+
+def test_fork_keeps_prefix_and_branches_independently(store):
+    store.append("s1", [user("q0"), assistant("a0"), user("q1"), assistant("a1")])
+    assert store.fork("s1", "s2", 2) == 2
+    store.append("s2", [user("b1"), assistant("b1")])
+    assert list(store.load("s2")) == [user("q0"), assistant("a0"), user("b1"), assistant("b1")]
+    assert list(store.load("s1")) == [user("q0"), assistant("a0"), user("q1"), assistant("a1")]
+
+
+def test_fork_whole_session_overwrites_target(store):
+    store.append("s1", [user("q0"), assistant("a0")])
+    store.append("s2", [user("old")])
+    assert store.fork("s1", "s2", sys.maxsize) == 2
+    assert list(store.load("s2")) == [user("q0"), assistant("a0")]
+
+
+def test_fork_missing_source_raises(store):
+    with pytest.raises(KeyError):
+        store.fork("missing", "s2", 2)
+    assert list(store.load("s2")) == []
+
+
+def test_memory_load_does_not_copy_history():
+    store = dg.MemorySessionStore(OrderedDict(), timeout=TIMEOUT)
+    store.append("s1", [user("q0"), assistant("a0")])
+    history = store.load("s1")
+    assert history is store.load("s1")
+    assert history.tail(1) == [assistant("a0")]
+    store.append("s1", [user("q1")])
+    # 已返回的历史不受后续追加影响
+    assert list(history) == [user("q0"), assistant("a0")]
+
+
+def test_delete(store):
+    store.append("s1", [user("q0")])
+    store.delete("s1")
+    store.delete("missing")
+    assert list(store.load("s1")) == []
+
+
+def test_expired_session_is_cleaned_up(store):
+    store.append("s1", [user("q0")])
+    store.append("s2", [user("q1")])
+    expire(store, "s1")
+    store.cleanup()
+    assert list(store.load("s1")) == []
+    assert list(store.load("s2")) == [user("q1")]
+
+
+def test_redis_ttl_is_refreshed_on_access():
+    fakeredis = pytest.importorskip("fakeredis")
+    store = dg.RedisSessionStore(timeout=TIMEOUT, client=fakeredis.FakeRedis())
+    store.append("s1", [user("q0")])
+    key = store._key("s1")
+    assert 0 < store.client.ttl(key) <= TIMEOUT
+    store.client.expire(key, 5)
+    store.load("s1")
+    assert store.client.ttl(key) > 5
+
+
+def test_memory_budget_evicts_least_recently_used():
+    store = dg.MemorySessionStore(OrderedDict(), timeout=TIMEOUT, budget_bytes=4096)
+    store.append("old", [user("x" * 1500)])
+    store.append("new", [user("y" * 1500)])
+    store.load("old")
+    store.append("newest", [user("z" * 1500)])
+    assert "new" not in store.storage
+    assert list(store.load("old")) == [user("x" * 1500)]
+    assert store.stats()["evictions"] == 1
+
+
+def test_resent_history_is_detected():
+    history = [user("q0"), assistant("a0"), user("q1"), assistant("a1")]
+    system = {"role": "system", "content": "sys"}
+    # 完整重发
+    messages = [system] + history + [user("q2")]
+    assert dg.resent_history_count(history, messages) == 4
+    assert dg.drop_resent_messages(messages, 4) == [system, user("q2")]
+    # 只重发了最近的部分
+    assert dg.resent_history_count(history, [user("q1"), assistant("a1"), user("q2")]) == 2
+    # 有状态客户端只发送新消息
+    assert dg.resent_history_count(history, [system, user("q2")]) == 0
+    # 最后一条总是新消息，即使与历史相同
+    assert dg.resent_history_count([user("继续")], [user("继续")]) == 0
+
+
+def test_resent_image_message_matches_stored_reference():
+    stored = {"role": "user", "content": [{"type": "text", "text": "看图"},
+                                          {"type": "image_url", "image_url": {"url": "degpt-image://abc"}}]}
+    resent = {"role": "user", "content": [{"type": "text", "text": "看图"},
+                                          {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}]}
+    assert dg.resent_history_count([stored, assistant("a0")], [resent, assistant("a0"), user("q1")]) == 2
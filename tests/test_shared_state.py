@@ -0,0 +1,59 @@
+"""多worker共享状态：模型调用统计批量写入"""
+import sqlite3
+import time
+
+import pytest
+
+import degpt as dg
+
+
+def test_record_call_does_not_wait_for_sqlite_lock(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = dg.SharedState(path)
+    state.load_model_stats()
+    # 其他worker持有写锁
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        started = time.monotonic()
+        for _ in range(100):
+            state.record_call("m", True)
+        assert time.monotonic() - started < 0.5
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+
+def test_pending_calls_are_merged_and_flushed(tmp_path):
+    path = str(tmp_path / "state.db")
+    worker1, worker2 = dg.SharedState(path), dg.SharedState(path)
+    worker1.record_call("m", True)
+    worker1.record_call("m", False)
+    worker2.record_call("m", True)
+    # 未写入的部分只有本进程可见
+    assert worker1.load_model_stats()["m"]["calls"] == 2
+    worker1.flush()
+    worker2.flush()
+    for worker in (worker1, worker2):
+        stats = worker.load_model_stats()["m"]
+        assert (stats["calls"], stats["fails"]) == (3, 1)
+        assert stats["last_fail"] is not None
+
+
+def test_failed_flush_keeps_pending_calls(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = dg.SharedState(path)
+    state.load_model_stats()
+    state.record_call("m", False)
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    state._conn().execute("PRAGMA busy_timeout = 10")
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            state.flush()
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    state.flush()
+    stats = dg.SharedState(path).load_model_stats()["m"]
+    assert (stats["calls"], stats["fails"]) == (1, 1)
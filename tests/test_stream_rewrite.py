@@ -0,0 +1,100 @@
+"""SSE数据块改写：字节快速路径与完整JSON解析的结果必须一致"""
+import json
+
+import pytest
+from fastapi import FastAPI
+
+import degpt as dg
+import more_core
+
+FRAMES = {
+    "content": {"choices": [{"index": 0, "delta": {"content": "你好"}, "finish_reason": None}]},
+    "content_no_finish_key": {"choices": [{"index": 0, "delta": {"content": "world"}}]},
+    "escaped_quotes": {"choices": [{"index": 0, "delta": {"content": 'he said "hi" \\ "usage"'},
+                                    "finish_reason": None}]},
+    "reasoning": {"choices": [{"index": 0, "delta": {"reasoning_content": "想一想"}, "finish_reason": None}]},
+    "reasoning_content_null": {"choices": [{"index": 0, "delta": {"content": None, "reasoning_content": "嗯"},
+                                            "finish_reason": None}]},
+    "role_only": {"choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]},
+    "stop": {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]},
+    "usage_only": {"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8}},
+    "n2": {"choices": [{"index": 0, "delta": {"content": "a"}, "finish_reason": None},
+                       {"index": 1, "delta": {"content": "b"}, "finish_reason": None}]},
+    "n2_no_finish_key": {"choices": [{"index": 0, "delta": {"content": "a"}},
+                                     {"index": 1, "delta": {"content": "b"}}]},
+    "n2_reasoning": {"choices": [{"index": 0, "delta": {"reasoning_content": "x"}, "finish_reason": None},
+                                 {"index": 1, "delta": {"reasoning_content": "y"}, "finish_reason": None}]},
+}
+META = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 1, "model": "m"}
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = more_core.APIServer(FastAPI())
+    yield server
+    server.scheduler.shutdown(wait=False)
+
+
+def encode(frame, compact=False):
+    separators = (",", ":") if compact else None
+    return b"data: " + json.dumps({**META, **frame}, ensure_ascii=False, separators=separators).encode() + b"\n"
+
+
+def recorder(include_usage=False):
+    rec = dg.StreamSessionRecorder(None, "m", prompt_tokens=5)
+    rec.include_usage = include_usage
+    rec.stream_meta = dict(META)
+    return rec
+
+
+def run(server, frames, include_usage=False, slow=False):
+    rec = recorder(include_usage)
+    out = []
+    for frame in frames:
+        if slow:
+            # stream_meta为None时不走快速路径（完整解析后重新记录）
+            rec.stream_meta = None
+        out.append(server._process_stream_chunk(frame, rec))
+    out.append(server._process_stream_chunk(b"data: [DONE]\n", rec))
+    return out, rec
+
+
+def parse(out):
+    return [json.loads(line[5:]) if line.strip() != b"data: [DONE]" else "[DONE]"
+            for chunk in out for line in chunk.splitlines() if line.strip()]
+
+
+def state(rec):
+    return rec.content_chunks, rec.reasoning_counter.flush(), rec.upstream_usage, rec.usage_sent
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("include_usage", [False, True])
+@pytest.mark.parametrize("name", list(FRAMES))
+def test_fast_path_matches_json_path(server, name, include_usage, compact):
+    frames = [encode(FRAMES["content"], compact), encode(FRAMES[name], compact), encode(FRAMES["stop"], compact)]
+    fast_out, fast = run(server, frames, include_usage)
+    slow_out, slow = run(server, frames, include_usage, slow=True)
+    assert parse(fast_out) == parse(slow_out)
+    assert state(fast) == state(slow)
+
+
+def test_upstream_usage_frame_is_not_duplicated(server):
+    frames = [encode(FRAMES["content"]), encode(FRAMES["stop"]), encode(FRAMES["usage_only"])]
+    out, rec = run(server, frames, include_usage=True)
+    usages = [chunk["usage"] for chunk in parse(out) if chunk != "[DONE]" and "usage" in chunk]
+    assert usages == [FRAMES["usage_only"]["usage"]]
+    assert rec.usage() == FRAMES["usage_only"]["usage"]
+
+
+def test_proxy_usage_frame_when_upstream_sends_none(server):
+    out, _ = run(server, [encode(FRAMES["content"]), encode(FRAMES["stop"])], include_usage=True)
+    chunks = parse(out)
+    assert chunks[-1] == "[DONE]"
+    assert chunks[-2]["choices"] == [] and chunks[-2]["usage"]["prompt_tokens"] == 5
+
+
+def test_reasoning_is_renamed_to_content(server):
+    out, rec = run(server, [encode(FRAMES["reasoning"])])
+    assert parse(out)[0]["choices"][0]["delta"] == {"content": "想一想"}
+    assert rec.content_chunks == [] and rec.reasoning_counter.flush() > 0